@@ -0,0 +1,100 @@
+"""
+    Benchmark of the concurrent page prefetch of paginated catalog listings.
+
+    Starts a local stub of the GISMGR listing endpoint with a fixed latency
+    per request and compares following links[rel=next] one page at a time
+    with utils.transport.collect_pages, for a growing number of pages.
+
+    Usage, from the plugin folder:
+        python scripts/bench_pagination.py [latency_seconds]
+"""
+import os
+import sys
+import json
+import time
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.transport import HttpTransport, collect_pages
+
+PAGE_SIZE = 10
+LATENCY = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(LATENCY)
+        parsed = urlparse(self.path)
+        query = dict(parse_qsl(parsed.query))
+        total = int(query['total'])
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', PAGE_SIZE))
+        items = [{'code': 'R{:05d}'.format(i), 'caption': 'Raster {}'.format(i)}
+                 for i in range(offset, min(offset + limit, total))]
+        links = [{'rel': 'self', 'href': self._url(total, offset, limit, query)}]
+        if offset + limit < total:
+            links.append({'rel': 'next', 'href': self._url(total, offset + limit, limit, query)})
+        response = {'items': items, 'links': links}
+        if query.get('count') == '1':
+            response['totalItems'] = total
+        body = json.dumps({'message': 'OK', 'response': response}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _url(self, total, offset, limit, query):
+        return 'http://{}:{}/rasters?total={}&count={}&offset={}&limit={}'.format(
+            *self.server.server_address, total, query.get('count', '0'), offset, limit)
+
+    def log_message(self, *args):
+        pass
+
+def serial_pages(url, fetch):
+    pages = [fetch(url)]
+    while pages[-1]['links'][-1]['rel'] == 'next':
+        pages.append(fetch(pages[-1]['links'][-1]['href']))
+    return pages
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    transport = HttpTransport(max_per_host=16)
+
+    def fetch(url):
+        return transport.get(url).json()['response']
+
+    def codes(pages):
+        return [item['code'] for page in pages for item in page['items']]
+
+    print('latency {:.0f} ms per request, {} items per page'.format(LATENCY * 1000, PAGE_SIZE))
+    print('{:>6} {:>10} {:>14} {:>14} {:>9} {:>9}'.format(
+        'pages', 'serial [s]', 'total known [s]', 'windowed [s]', 'x known', 'x window'))
+    for n_pages in [2, 5, 10, 20, 50]:
+        total = n_pages * PAGE_SIZE
+        base = 'http://{}:{}/rasters?total={}'.format(*server.server_address, total)
+
+        t0 = time.perf_counter()
+        reference = codes(serial_pages(base + '&count=0&offset=0&limit={}'.format(PAGE_SIZE), fetch))
+        t_serial = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        counted = codes(collect_pages(base + '&count=1&offset=0&limit={}'.format(PAGE_SIZE), fetch))
+        t_counted = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        windowed = codes(collect_pages(base + '&count=0&offset=0&limit={}'.format(PAGE_SIZE), fetch))
+        t_windowed = time.perf_counter() - t0
+
+        assert counted == reference and windowed == reference, 'merged listing out of order'
+        print('{:>6} {:>10.3f} {:>14.3f} {:>14.3f} {:>8.1f}x {:>8.1f}x'.format(
+            n_pages, t_serial, t_counted, t_windowed, t_serial / t_counted, t_serial / t_windowed))
+
+    print(transport.stats())
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+    Benchmark of the output profiles of the downloaded rasters.
+
+    Writes the same WaPOR raster with every profile of
+    utils.wapordl_ext.OUTPUT_PROFILES and compares the write time, the file
+    size, the time to read the whole raster and the time to read a series
+    of small overview windows, which is what QGIS does while panning a
+    zoomed out map.
+
+    Usage, from the plugin folder:
+        python scripts/bench_profiles.py [path/to/wapor.tif]
+
+    Without a file, one dekad of L2-AETI-D is downloaded for a small
+    bounding box first.
+"""
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+from osgeo import gdal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.wapordl_ext import wapor_map, OUTPUT_PROFILES, __profile_options__, __apply_profile__
+
+PAN_WINDOWS = 50
+PAN_PIXELS = 256
+
+def sample(folder):
+    fps = wapor_map([35.0, 32.0, 36.0, 33.0], 'L2-AETI-D', ['2023-01-01', '2023-01-10'], folder,
+                    seperate_unscale=True, file_name='bench', profile='lzw')
+    return fps[0]
+
+def write(src_fn, out_fn, profile):
+    src = gdal.Open(src_fn)
+    dtype = src.GetRasterBand(1).DataType
+    t0 = time.perf_counter()
+    ds = gdal.Translate(out_fn, src, options=gdal.TranslateOptions(creationOptions=__profile_options__(profile, dtype)))
+    ds = None
+    __apply_profile__(out_fn, profile)
+    return time.perf_counter() - t0
+
+def read_full(fn):
+    t0 = time.perf_counter()
+    ds = gdal.Open(fn)
+    _ = ds.GetRasterBand(1).ReadAsArray()
+    return time.perf_counter() - t0
+
+def read_pan(fn, seed=0):
+    """
+        Reads windows of a quarter of the raster decimated to 256 pixels,
+        GDAL uses the overviews when there are. The block cache is left on,
+        like in QGIS, the blocks of a dataset are dropped when it is closed.
+    """
+    rng = np.random.default_rng(seed)
+    t0 = time.perf_counter()
+    ds = gdal.Open(fn)
+    band = ds.GetRasterBand(1)
+    width, height = max(ds.RasterXSize // 2, 1), max(ds.RasterYSize // 2, 1)
+    for _ in range(PAN_WINDOWS):
+        xoff = int(rng.integers(0, ds.RasterXSize - width + 1))
+        yoff = int(rng.integers(0, ds.RasterYSize - height + 1))
+        _ = band.ReadAsArray(xoff, yoff, width, height,
+                             buf_xsize=min(PAN_PIXELS, width), buf_ysize=min(PAN_PIXELS, height))
+    return time.perf_counter() - t0
+
+def main():
+    gdal.UseExceptions()
+    with tempfile.TemporaryDirectory() as folder:
+        src_fn = sys.argv[1] if len(sys.argv) > 1 else sample(folder)
+        ds = gdal.Open(src_fn)
+        print('{} ({} x {}, {})'.format(os.path.basename(src_fn), ds.RasterXSize, ds.RasterYSize,
+                                        gdal.GetDataTypeName(ds.GetRasterBand(1).DataType)))
+        ds = None
+
+        print('{:>8} {:>10} {:>10} {:>10} {:>10}'.format('profile', 'write [s]', 'size [MB]', 'full [s]', 'pan [s]'))
+        for profile in OUTPUT_PROFILES:
+            out_fn = os.path.join(folder, 'profile_{}.tif'.format(profile))
+            t_write = write(src_fn, out_fn, profile)
+            size = os.path.getsize(out_fn) / 1e6
+            t_full = min(read_full(out_fn) for _ in range(3))
+            t_pan = min(read_pan(out_fn) for _ in range(3))
+            print('{:>8} {:>10.3f} {:>10.2f} {:>10.3f} {:>10.3f}'.format(profile, t_write, size, t_full, t_pan))
+
+if __name__ == '__main__':
+    main()
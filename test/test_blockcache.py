@@ -0,0 +1,227 @@
+# coding=utf-8
+"""Tests of the on-disk cache of the byte ranges of the remote COGs.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from utils.blockcache import BlockCache, RemoteFileChanged, STREAM_CHUNK
+from utils.transport import HttpTransport
+from utilities import start_http_server, stop_http_server, range_response
+
+BLOCK = 1024
+
+
+class BlockCacheTest(unittest.TestCase):
+    """Test the blocks are read once from the remote server."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.cache_dir = tempfile.mkdtemp()
+        self.content = os.urandom(10 * BLOCK + 100)
+        self.etag = '"v1"'
+        self.head_length = True
+        self.changing = False
+        self.ranges = []
+        self.lock = threading.Lock()
+        self.server, self.url = start_http_server(self.respond)
+        self.cache = self.block_cache()
+
+    def tearDown(self):
+        """Runs after each test."""
+        self.cache.close()
+        stop_http_server(self.server)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def block_cache(self, **kwargs):
+        kwargs.setdefault('block_size', BLOCK)
+        kwargs.setdefault('allowed_hosts', ('127.0.0.1',))
+        return BlockCache(cache_dir=self.cache_dir, transport=HttpTransport(retries=0), **kwargs)
+
+    def respond(self, handler):
+        if handler.path.startswith('/missing'):
+            return 404, {}, b''
+        if handler.command == 'GET':
+            with self.lock:
+                self.ranges.append(handler.headers.get('Range'))
+                if self.changing:
+                    self.content = os.urandom(len(self.content))
+                    self.etag = '"v{}"'.format(len(self.ranges) + 1)
+        status, headers, body = range_response(handler, self.content, self.etag)
+        if handler.command == 'HEAD' and not self.head_length:
+            headers['Content-Length'] = None
+        return status, headers, body
+
+    def test_read(self):
+        """Ranges are served from the blocks, whatever their alignment."""
+        url = self.url + '/file.tif'
+        for start, end in [(0, 99), (1000, 3000), (BLOCK, 2 * BLOCK - 1), (10 * BLOCK, None),
+                           (5000, 50000)]:
+            data, size = self.cache.read(url, start, end)
+            self.assertEqual(size, len(self.content))
+            stop = len(self.content) if end is None else end + 1
+            self.assertEqual(data, self.content[start:stop])
+
+    def test_blocks_are_fetched_once(self):
+        """Only the missing blocks are requested, consecutive ones together."""
+        url = self.url + '/file.tif'
+        self.cache.read(url, 0, BLOCK - 1)
+        self.cache.read(url, 3 * BLOCK, 4 * BLOCK - 1)
+        self.cache.read(url, 0, 5 * BLOCK - 1)
+        self.assertEqual(self.ranges, ['bytes=0-{}'.format(BLOCK - 1),
+                                       'bytes={}-{}'.format(3 * BLOCK, 4 * BLOCK - 1),
+                                       'bytes={}-{}'.format(BLOCK, 3 * BLOCK - 1),
+                                       'bytes={}-{}'.format(4 * BLOCK, 5 * BLOCK - 1)])
+        stats = self.cache.stats()
+        self.assertEqual(stats['misses'], 5)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['size'], 5 * BLOCK)
+
+    def test_blocks_survive_the_session(self):
+        """A new cache on the same folder serves the stored blocks."""
+        url = self.url + '/file.tif'
+        self.cache.read(url, 0, 3 * BLOCK)
+        self.cache.close()
+        self.cache = self.block_cache()
+        data, _ = self.cache.read(url, 100, 2000)
+        self.assertEqual(data, self.content[100:2001])
+        self.assertEqual(len(self.ranges), 1)
+
+    def test_changed_etag(self):
+        """The blocks of an older version are dropped once it is revalidated."""
+        self.cache = self.block_cache(validate_ttl=0)
+        url = self.url + '/file.tif'
+        self.cache.read(url, 0, BLOCK - 1)
+        self.content = os.urandom(len(self.content))
+        self.etag = '"v2"'
+        data, _ = self.cache.read(url, 0, BLOCK - 1)
+        self.assertEqual(data, self.content[:BLOCK])
+        self.assertEqual(self.cache.stats()['size'], BLOCK)
+
+    def test_changed_during_read(self):
+        """A file that changes during a read is read again from the new version, not mixed with the old one."""
+        url = self.url + '/file.tif'
+        self.cache.read(url, 0, BLOCK - 1)
+        self.content = os.urandom(len(self.content))
+        self.etag = '"v2"'
+        data, _ = self.cache.read(url, 0, 3 * BLOCK - 1)
+        self.assertEqual(data, self.content[:3 * BLOCK])
+        self.assertEqual(self.ranges[1:], ['bytes={}-{}'.format(BLOCK, 3 * BLOCK - 1), 'bytes=0-{}'.format(BLOCK - 1)])
+        self.assertEqual(self.cache.read(url, 0, 3 * BLOCK - 1)[0], self.content[:3 * BLOCK])
+
+    def test_changing_during_read(self):
+        """A file that keeps changing fails the read."""
+        url = self.url + '/file.tif'
+        self.cache.read(url, 0, BLOCK - 1)
+        self.changing = True
+        with self.assertRaises(RemoteFileChanged):
+            self.cache.read(url, 0, 3 * BLOCK - 1)
+        self.assertTrue(issubclass(RemoteFileChanged, requests.RequestException))
+
+    def test_downloaded_per_url(self):
+        """The downloaded bytes are counted per remote URL."""
+        first, second = self.url + '/first.tif', self.url + '/second.tif'
+        self.cache.read(first, 0, BLOCK - 1)
+        self.cache.read(second, 0, 2 * BLOCK - 1)
+        self.cache.read(first, 0, BLOCK - 1)
+        self.assertEqual(self.cache.downloaded([first]), BLOCK)
+        self.assertEqual(self.cache.downloaded([first, second, first]), 3 * BLOCK)
+        self.assertEqual(self.cache.downloaded([self.url + '/other.tif']), 0)
+
+    def test_eviction(self):
+        """The least recently used blocks are evicted beyond max_bytes."""
+        self.cache = self.block_cache(max_bytes=4 * BLOCK)
+        url = self.url + '/file.tif'
+        for i in range(8):
+            self.cache.read(url, i * BLOCK, i * BLOCK)
+        stats = self.cache.stats()
+        self.assertLessEqual(stats['size'], 4 * BLOCK)
+        self.assertGreater(stats['evicted'], 0)
+        del self.ranges[:]
+        self.cache.read(url, 7 * BLOCK, 7 * BLOCK)
+        self.assertEqual(self.ranges, [])
+
+    def test_missing_file(self):
+        """Files that do not exist are not cached."""
+        self.assertEqual(self.cache.read(self.url + '/missing.tif', 0, 10), (None, None))
+
+    def test_head_without_length(self):
+        """Without a Content-Length in the HEAD response the size is read from a one byte range."""
+        self.head_length = False
+        data, size = self.cache.read(self.url + '/file.tif', 0, 99)
+        self.assertEqual(size, len(self.content))
+        self.assertEqual(data, self.content[:100])
+        self.assertEqual(self.ranges, ['bytes=0-0', 'bytes=0-{}'.format(BLOCK - 1)])
+
+    def test_local_server(self):
+        """The local URL answers HEAD and range requests like the remote one."""
+        local = self.cache.local_url(self.url + '/file.tif?token=1')
+        self.assertTrue(local.startswith('http://127.0.0.1:'))
+        self.assertNotEqual(local.split('/')[2], self.url.split('/')[2])
+        self.assertIn('/{}/http/'.format(self.cache._token), local)
+        self.assertTrue(local.endswith('/file.tif?token=1'))
+        head = requests.head(local, timeout=5)
+        self.assertEqual(int(head.headers['Content-Length']), len(self.content))
+        resp = requests.get(local, headers={'Range': 'bytes=1000-1999'}, timeout=5)
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 1000-1999/{}'.format(len(self.content)))
+        self.assertEqual(resp.content, self.content[1000:2000])
+        resp = requests.get(local, headers={'Range': 'bytes=20000-'}, timeout=5)
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(requests.get(local, timeout=5).content, self.content)
+        self.assertEqual(requests.head(self.cache.local_url(self.url + '/missing.tif'), timeout=5).status_code,
+                         404)
+
+    def test_passthrough(self):
+        """Requests that are not a plain range are streamed from the remote server."""
+        self.content = os.urandom(STREAM_CHUNK * 3 + 7)
+        local = self.cache.local_url(self.url + '/file.tif')
+        resp = requests.get(local, headers={'Range': 'bytes=-100'}, timeout=5)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, self.content)
+        self.assertEqual(requests.get(local, timeout=5).content, self.content)
+        self.assertEqual(self.cache.stats()['bytes_downloaded'], 2 * len(self.content))
+
+    def test_token(self):
+        """Requests without the token of the session or to other hosts are refused."""
+        local = self.cache.local_url(self.url + '/file.tif')
+        for path in [local.replace(self.cache._token, 'x' * 32),
+                     local.replace('/{}/'.format(self.cache._token), '/'),
+                     local.replace('127.0.0.1:{}'.format(self.server.server_address[1]), 'example.com')]:
+            self.assertEqual(requests.get(path, timeout=5).status_code, 403)
+            self.assertEqual(requests.head(path, timeout=5).status_code, 403)
+        self.assertEqual(self.ranges, [])
+
+    def test_allowed_hosts(self):
+        """Only the WaPOR hosts are served by default, other URLs are read directly."""
+        cache = BlockCache(cache_dir=self.cache_dir)
+        url = self.url + '/file.tif'
+        self.assertEqual(cache.local_url(url), url)
+        self.assertTrue(cache.allows('https://storage.googleapis.com/fao-gismgr-wapor-3-data/x.tif'))
+        self.assertTrue(cache.allows('https://data.apps.fao.org/static/data/c3s/x.tif'))
+        self.assertFalse(cache.allows('ftp://storage.googleapis.com/x.tif'))
+        self.assertFalse(cache.allows('https://storage.googleapis.com.example.com/x.tif'))
+
+    def test_disabled(self):
+        """A disabled cache reads the remote URLs directly."""
+        url = self.url + '/file.tif'
+        self.assertEqual(self.block_cache(enabled=False).local_url(url), url)
+        self.assertEqual(self.cache.local_url('/vsimem/file.tif'), '/vsimem/file.tif')
+
+
+if __name__ == "__main__":
+    unittest.main()
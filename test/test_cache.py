@@ -0,0 +1,247 @@
+# coding=utf-8
+"""Tests of the on-disk cache and metadata index of the GISMGR catalog.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from utils.cache import CatalogCache, MetadataIndex
+from utils.transport import HttpTransport
+from utilities import start_http_server, stop_http_server
+
+
+class CatalogCacheTest(unittest.TestCase):
+    """Test the catalog responses are served from disk and revalidated."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.cache_dir = tempfile.mkdtemp()
+        self.requests = []
+        self.etag = '"v1"'
+        self.error = None
+        self.server, self.url = start_http_server(self.respond)
+
+    def tearDown(self):
+        """Runs after each test."""
+        stop_http_server(self.server)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def cache(self, **kwargs):
+        transport = HttpTransport(retries=1, backoff=0.01)
+        return CatalogCache(self.cache_dir, transport=transport, **kwargs)
+
+    def respond(self, handler):
+        self.requests.append(dict(handler.headers))
+        if self.error is not None:
+            return self.error
+        if handler.headers.get('If-None-Match') == self.etag:
+            return 304, {'ETag': self.etag}, b''
+        body = json.dumps({'response': {'code': handler.path}}).encode()
+        return 200, {'ETag': self.etag, 'Content-Type': 'application/json'}, body
+
+    def test_fresh_entry_is_a_hit(self):
+        """A response younger than its TTL does not hit the server."""
+        cache = self.cache()
+        url = self.url + '/v1/workspaces/WAPOR-3/mapsets'
+        first = cache.get_json(url)
+        second = cache.get_json(url)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(cache.stats, {'hits': 1, 'revalidated': 0, 'misses': 1})
+
+    def test_cache_survives_the_session(self):
+        """A new cache on the same folder serves the stored responses."""
+        url = self.url + '/v1/workspaces'
+        self.cache().get_json(url)
+        cache = self.cache()
+        self.assertEqual(cache.get_json(url), {'response': {'code': '/v1/workspaces'}})
+        self.assertEqual(len(self.requests), 1)
+
+    def test_expired_entry_is_revalidated(self):
+        """An expired response is revalidated with its ETag."""
+        cache = self.cache(ttls={'mapsets': 0})
+        url = self.url + '/v1/workspaces/WAPOR-3/mapsets'
+        first = cache.get_json(url)
+        self.assertEqual(cache.get_json(url), first)
+        self.assertEqual(self.requests[1].get('If-None-Match'), '"v1"')
+        self.assertEqual(cache.stats['revalidated'], 1)
+
+        self.etag = '"v2"'
+        cache.get_json(url)
+        self.assertEqual(cache.stats['misses'], 2)
+
+    def test_stale_entry_when_unreachable(self):
+        """The stale response is served when the server is not reachable."""
+        cache = self.cache(ttls={'cubes': 0})
+        url = self.url + '/v1/workspaces/WAPOR-2/cubes'
+        first = cache.get_json(url)
+        stop_http_server(self.server)
+        self.assertEqual(cache.get_json(url, timeout=1), first)
+        with self.assertRaises(requests.ConnectionError):
+            cache.get_json(self.url + '/v1/workspaces/WAPOR-2/measures', timeout=1)
+
+    def test_stale_entry_on_error(self):
+        """The stale response is served when the server answers an error or something else than JSON."""
+        cache = self.cache(ttls={'cubes': 0})
+        url = self.url + '/v1/workspaces/WAPOR-2/cubes'
+        first = cache.get_json(url)
+        for error in [(502, {'Content-Type': 'text/html'}, b'<html>Bad Gateway</html>'),
+                      (404, {'Content-Type': 'application/json'}, b'{"status": 404}'),
+                      (200, {'Content-Type': 'text/html'}, b'<html>Maintenance</html>')]:
+            self.error = error
+            self.assertEqual(cache.get_json(url), first)
+
+    def test_error_without_entry(self):
+        """Without an entry the JSON of an error is returned uncached, other errors raise."""
+        cache = self.cache()
+        url = self.url + '/v1/workspaces/WAPOR-9'
+        self.error = (404, {'Content-Type': 'application/json'}, b'{"status": 404}')
+        self.assertEqual(cache.get_json(url), {'status': 404})
+        self.error = (503, {'Content-Type': 'text/html'}, b'<html>Unavailable</html>')
+        with self.assertRaises(requests.HTTPError) as raised:
+            cache.get_json(url)
+        self.assertEqual(raised.exception.response.status_code, 503)
+        self.error = (200, {'Content-Type': 'text/html'}, b'<html>Maintenance</html>')
+        with self.assertRaises(ValueError):
+            cache.get_json(url)
+        self.error = None
+        self.assertEqual(cache.get_json(url), {'response': {'code': '/v1/workspaces/WAPOR-9'}})
+        self.assertEqual(cache.stats['hits'], 0)
+
+    def test_concurrent_stats(self):
+        """The counters are not lost when threads update them at the same time."""
+        cache = self.cache()
+        url = self.url + '/v1/workspaces'
+        cache.get_json(url)
+
+        def hits():
+            for _ in range(200):
+                cache.get_json(url)
+
+        threads = [threading.Thread(target=hits) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.stats, {'hits': 1600, 'revalidated': 0, 'misses': 1})
+
+    def test_params_are_part_of_the_key(self):
+        """Queries differing only in their parameters are cached apart."""
+        cache = self.cache()
+        url = self.url + '/v1/workspaces/WAPOR-3/mapsets'
+        first = cache.get_json(url, {'offset': 0})
+        second = cache.get_json(url, {'offset': 10})
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_refresh_prefix(self):
+        """Refresh drops only the entries under the prefix."""
+        cache = self.cache()
+        mapsets = self.url + '/v1/workspaces/WAPOR-3/mapsets'
+        cubes = self.url + '/v1/workspaces/WAPOR-2/cubes'
+        cache.get_json(mapsets)
+        cache.get_json(cubes)
+        cache.refresh(self.url + '/v1/workspaces/WAPOR-3')
+        cache.get_json(mapsets)
+        cache.get_json(cubes)
+        self.assertEqual(len(self.requests), 3)
+        cache.refresh()
+        cache.get_json(cubes)
+        self.assertEqual(len(self.requests), 4)
+
+    def test_ttl_for(self):
+        """The TTL is the one of the last collection in the path."""
+        cache = self.cache(default_ttl=60)
+        self.assertEqual(cache.ttl_for('https://x/v1/workspaces'), 7 * 24 * 3600)
+        self.assertEqual(cache.ttl_for('https://x/v1/workspaces/WAPOR-3/mapsets/L1-AETI-D'),
+                         24 * 3600)
+        self.assertEqual(cache.ttl_for('https://x/v1/workspaces/WAPOR-3/mapsets/L1-AETI-D/rasters'),
+                         6 * 3600)
+        self.assertEqual(cache.ttl_for('https://x/v1/other'), 60)
+
+
+class MetadataIndexTest(unittest.TestCase):
+    """Test the variable metadata is loaded once and persisted with a TTL."""
+
+    COLLECTION = 'https://data.apps.fao.org/gismgr/api/v2/catalog/workspaces/WAPOR-3/mapsets'
+
+    def setUp(self):
+        """Runs before each test."""
+        self.cache_dir = tempfile.mkdtemp()
+        self.loads = []
+        self.variables = {'L1-AETI-D': {'code': 'L1-AETI-D', 'scale': 0.1}}
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def loader(self, collection):
+        self.loads.append(collection)
+        time.sleep(0.05)
+        return json.loads(json.dumps(self.variables))
+
+    def test_loaded_once(self):
+        """Concurrent lookups share a single load of the collection."""
+        index = MetadataIndex(self.loader, self.cache_dir)
+        threads = [threading.Thread(target=index.get, args=(self.COLLECTION, 'L1-AETI-D'))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.loads), 1)
+
+    def test_copies(self):
+        """Callers get copies they can modify."""
+        index = MetadataIndex(self.loader, self.cache_dir)
+        index.get(self.COLLECTION, 'L1-AETI-D')['scale'] = 1
+        self.assertEqual(index.get(self.COLLECTION, 'L1-AETI-D')['scale'], 0.1)
+
+    def test_persisted_with_ttl(self):
+        """A new session reads the index from disk until it expires."""
+        MetadataIndex(self.loader, self.cache_dir).get(self.COLLECTION, 'L1-AETI-D')
+        MetadataIndex(self.loader, self.cache_dir).get(self.COLLECTION, 'L1-AETI-D')
+        self.assertEqual(len(self.loads), 1)
+
+        index = MetadataIndex(self.loader, self.cache_dir, ttl=0.01)
+        time.sleep(0.02)
+        index.get(self.COLLECTION, 'L1-AETI-D')
+        self.assertEqual(len(self.loads), 2)
+
+    def test_unknown_code(self):
+        """An unknown code reloads the collection once per session."""
+        MetadataIndex(self.loader, self.cache_dir).get(self.COLLECTION, 'L1-AETI-D')
+        self.variables['L1-NPP-D'] = {'code': 'L1-NPP-D', 'scale': 0.001}
+        index = MetadataIndex(self.loader, self.cache_dir)
+        self.assertEqual(index.get(self.COLLECTION, 'L1-NPP-D')['scale'], 0.001)
+        with self.assertRaises(KeyError):
+            index.get(self.COLLECTION, 'L2-NPP-D')
+        self.assertEqual(len(self.loads), 2)
+
+    def test_refresh(self):
+        """Refresh drops the index from memory and disk."""
+        index = MetadataIndex(self.loader, self.cache_dir)
+        index.get(self.COLLECTION, 'L1-AETI-D')
+        index.refresh()
+        index.get(self.COLLECTION, 'L1-AETI-D')
+        MetadataIndex(self.loader, self.cache_dir).get(self.COLLECTION, 'L1-AETI-D')
+        self.assertEqual(len(self.loads), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# coding=utf-8
+"""Tests of the canonical hashes of the download regions and requests.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import shapely
+
+from utils.hashing import region_hash, region_wkb, request_hash
+
+
+def feature_collection(coordinates, properties):
+    """Returns a GeoJSON FeatureCollection with a polygon."""
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'properties': properties,
+                          'geometry': {'type': 'Polygon', 'coordinates': [coordinates]}}]}
+
+
+class RequestHashTest(unittest.TestCase):
+    """Test the canonical hashes of the regions and requests."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.ring = [[30.0, 29.0], [31.0, 29.0], [31.0, 30.0], [30.0, 30.0], [30.0, 29.0]]
+        self.polygon = shapely.Polygon(self.ring)
+        self.period = ['2021-01-01', '2021-12-31']
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, name, content):
+        path = os.path.join(self.folder, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(content, f)
+        return path
+
+    def test_equal_geometries(self):
+        """Equal geometries in a different vertex order or with a z give the same hash."""
+        reordered = shapely.Polygon(self.ring[2:-1] + self.ring[:3])
+        reversed_ring = shapely.Polygon(self.ring[::-1])
+        with_z = shapely.Polygon([coordinate + [100.0] for coordinate in self.ring])
+        expected = request_hash(self.polygon, 'L2-AETI-D', self.period)
+        for geometry in [reordered, reversed_ring, with_z, shapely.to_wkb(reordered)]:
+            self.assertEqual(request_hash(geometry, 'L2-AETI-D', self.period), expected)
+        self.assertEqual(region_wkb(reordered), region_wkb(self.polygon))
+        self.assertEqual(region_hash(reversed_ring), region_hash(self.polygon))
+
+        moved = shapely.Polygon([[x + 0.001, y] for x, y in self.ring])
+        self.assertNotEqual(request_hash(moved, 'L2-AETI-D', self.period), expected)
+
+    def test_geojson_files(self):
+        """GeoJSON files of the same geometry give the same hash whatever their properties."""
+        first = self.write('first.geojson', feature_collection(self.ring, {'name': 'a'}))
+        second = self.write('second.geojson', feature_collection(self.ring[::-1], {'name': 'b', 'id': 1}))
+        other = self.write('other.geojson', feature_collection([[x + 1, y] for x, y in self.ring], {}))
+        self.assertEqual(request_hash(first, 'L2-AETI-D', self.period),
+                         request_hash(second, 'L2-AETI-D', self.period))
+        self.assertNotEqual(request_hash(first, 'L2-AETI-D', self.period),
+                            request_hash(other, 'L2-AETI-D', self.period))
+
+    def test_bounding_box(self):
+        """Bounding-boxes equal up to the float noise give the same hash."""
+        bb = [30.0, 29.0, 31.0, 30.0]
+        self.assertEqual(request_hash(bb, 'L2-AETI-D', self.period),
+                         request_hash([30, 29, 31.00000000001, 30], 'L2-AETI-D', self.period))
+        self.assertNotEqual(request_hash(bb, 'L2-AETI-D', self.period),
+                            request_hash([30.0, 29.0, 31.0, 30.1], 'L2-AETI-D', self.period))
+        self.assertNotEqual(request_hash(bb, 'L2-AETI-D', self.period),
+                            request_hash('BKA', 'L2-AETI-D', self.period))
+
+    def test_every_parameter(self):
+        """Changing any parameter of the request changes its hash."""
+        base = dict(region=[30.0, 29.0, 31.0, 30.0], variable='L2-AETI-D', period=self.period)
+        changes = {'region': [30.0, 29.0, 31.0, 31.0],
+                   'variable': 'L2-T-D',
+                   'period': ['2021-01-01', '2021-06-30'],
+                   'overview': 2,
+                   'unit_conversion': 'dekad',
+                   'extension': '.nc',
+                   'seperate_unscale': True,
+                   'dtype_policy': 'compact',
+                   'profile': 'zstd',
+                   'time_cube': True,
+                   'grid': 'L2-AETI-D'}
+        hashes = {request_hash(**base)}
+        for name, value in changes.items():
+            hashes.add(request_hash(**dict(base, **{name: value})))
+        self.assertEqual(len(hashes), len(changes) + 1)
+
+    def test_defaults(self):
+        """The explicit default settings give the same hash as the omitted ones."""
+        self.assertEqual(request_hash('BKA', 'L3-AETI-D', self.period),
+                         request_hash('BKA', 'L3-AETI-D', tuple(self.period), overview='NONE',
+                                      unit_conversion='none', extension='.tif', seperate_unscale=False,
+                                      dtype_policy='exact', profile=None, time_cube=False, grid=None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+# coding=utf-8
+"""Tests of the local SQLite inventory of the catalog rasters.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from utils.inventory import RasterInventory
+
+URL = 'https://storage.googleapis.com/fao-gismgr-wapor-3-data/DATA/WAPOR-3/MAPSET/L2-AETI-D/{}.tif'
+
+
+def dekads(year):
+    """Returns the rasters of the dekads of a year."""
+    rasters = list()
+    for month in range(1, 13):
+        for start, end in [(1, 10), (11, 20), (21, 28)]:
+            code = 'WAPOR-3.L2-AETI-D.{}-{:02d}-D{}'.format(year, month, start // 10 + 1)
+            rasters.append((code, '{}-{:02d}-{:02d}'.format(year, month, start),
+                            '{}-{:02d}-{:02d}T00:00:00'.format(year, month, end), URL.format(code)))
+    return rasters
+
+
+class RasterInventoryTest(unittest.TestCase):
+    """Test the synchronisation and the queries of the inventory."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.cache_dir = tempfile.mkdtemp()
+        self.inventory = RasterInventory(cache_dir=self.cache_dir)
+
+    def tearDown(self):
+        """Runs after each test."""
+        if self.inventory._conn is not None:
+            self.inventory._conn.close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_urls_by_period(self):
+        """The URLs of the rasters overlapping a period are returned in time order."""
+        rasters = dekads(2021)
+        self.inventory.update('L2-AETI-D', None, rasters[::-1], full=True)
+        self.assertEqual(self.inventory.urls('L2-AETI-D'), [raster[3] for raster in rasters])
+        self.assertEqual(self.inventory.urls('L2-AETI-D', period=['2021-01-15', '2021-02-05']),
+                         [raster[3] for raster in rasters[1:4]])
+        ## Dates with a time compare as dates.
+        self.assertEqual(self.inventory.urls('L2-AETI-D', period=['2021-12-21T12:00:00', '2022-06-01 00:00']),
+                         [rasters[-1][3]])
+        self.assertEqual(self.inventory.urls('L2-AETI-D', period=['2020-01-01', '2020-12-31']), [])
+        self.assertEqual(self.inventory.latest('L2-AETI-D'), '2021-12-21')
+
+    def test_regions(self):
+        """The rasters of the L3 regions are kept apart from those of the mapset."""
+        self.inventory.update('L3-AETI-D', 'BKA', dekads(2021)[:3], full=True)
+        self.assertTrue(self.inventory.has('L3-AETI-D', 'BKA'))
+        self.assertFalse(self.inventory.has('L3-AETI-D', 'AWA'))
+        self.assertFalse(self.inventory.has('L3-AETI-D'))
+        self.assertEqual(len(self.inventory.urls('L3-AETI-D', 'BKA')), 3)
+        self.assertEqual(self.inventory.urls('L3-AETI-D', 'AWA'), [])
+
+    def test_incremental_sync(self):
+        """An incremental sync adds the new rasters and keeps the known ones."""
+        rasters = dekads(2021)
+        self.assertTrue(self.inventory.needs_sync('L2-AETI-D'))
+        self.assertTrue(self.inventory.needs_full_sync('L2-AETI-D'))
+        self.inventory.update('L2-AETI-D', None, rasters[:30])
+        self.assertFalse(self.inventory.needs_sync('L2-AETI-D'))
+        self.assertTrue(self.inventory.needs_full_sync('L2-AETI-D'))
+
+        self.inventory.update('L2-AETI-D', None, rasters[29:], full=True)
+        self.assertFalse(self.inventory.needs_full_sync('L2-AETI-D'))
+        self.assertEqual(len(self.inventory.urls('L2-AETI-D')), 7)
+
+        self.inventory.update('L2-AETI-D', None, rasters[30:])
+        self.assertFalse(self.inventory.needs_full_sync('L2-AETI-D'))
+
+    def test_full_sync(self):
+        """A full sync drops the rasters no longer listed and updates the republished ones."""
+        rasters = dekads(2021)
+        self.inventory.update('L2-AETI-D', None, rasters)
+        republished = [(code, start, end, url + '?v=2') for code, start, end, url in rasters[1:]]
+        self.inventory.update('L2-AETI-D', None, republished, full=True)
+        self.assertEqual(self.inventory.urls('L2-AETI-D'), [raster[3] for raster in republished])
+
+    def test_ttl(self):
+        """The mapsets are synchronised again once their ttl has passed."""
+        inventory = RasterInventory(cache_dir=self.cache_dir, sync_ttl=0.05, full_sync_ttl=0.2)
+        inventory.update('L2-AETI-D', None, dekads(2021), full=True)
+        self.assertFalse(inventory.needs_sync('L2-AETI-D'))
+        time.sleep(0.1)
+        self.assertTrue(inventory.needs_sync('L2-AETI-D'))
+        self.assertFalse(inventory.needs_full_sync('L2-AETI-D'))
+        time.sleep(0.15)
+        self.assertTrue(inventory.needs_full_sync('L2-AETI-D'))
+        inventory._conn.close()
+
+    def test_refresh(self):
+        """Refreshing drops the inventory of a mapset, or all of it."""
+        self.inventory.update('L2-AETI-D', None, dekads(2021), full=True)
+        self.inventory.update('L2-T-D', None, dekads(2021), full=True)
+        self.inventory.refresh('L2-AETI-D')
+        self.assertFalse(self.inventory.has('L2-AETI-D'))
+        self.assertTrue(self.inventory.has('L2-T-D'))
+        self.inventory.refresh()
+        self.assertEqual(self.inventory.urls('L2-T-D'), [])
+
+    def test_persistence(self):
+        """The inventory is kept on disk across instances."""
+        self.inventory.update('L2-AETI-D', None, dekads(2021), full=True)
+        self.inventory._conn.close()
+        self.inventory = RasterInventory(cache_dir=self.cache_dir)
+        self.assertEqual(len(self.inventory.urls('L2-AETI-D')), 36)
+        self.assertFalse(self.inventory.needs_full_sync('L2-AETI-D'))
+
+    def test_old_schema(self):
+        """A database without the full sync column is migrated and fully synced again."""
+        conn = sqlite3.connect(os.path.join(self.cache_dir, 'inventory.sqlite'))
+        conn.execute('CREATE TABLE syncs (mapset TEXT, region TEXT, synced REAL, PRIMARY KEY (mapset, region))')
+        conn.execute('INSERT INTO syncs VALUES (?, ?, ?)', ('L2-AETI-D', '', time.time()))
+        conn.commit()
+        conn.close()
+        self.assertFalse(self.inventory.needs_sync('L2-AETI-D'))
+        self.assertTrue(self.inventory.needs_full_sync('L2-AETI-D'))
+
+    def test_valid_urls(self):
+        """Only the URLs checked to exist are known."""
+        urls = ['https://example.com/{}.tif'.format(i) for i in range(1200)]
+        self.inventory.add_valid_urls(urls[:600])
+        self.assertEqual(self.inventory.valid_urls(urls), set(urls[:600]))
+        self.assertEqual(self.inventory.valid_urls([]), set())
+
+    def test_valid_urls(self):
+        """Only the URLs checked to exist are known."""
+        urls = ['https://example.com/{}.tif'.format(i) for i in range(1200)]
+        self.inventory.add_valid_urls(urls[:600])
+        self.assertEqual(self.inventory.valid_urls(urls), set(urls[:600]))
+        self.assertEqual(self.inventory.valid_urls([]), set())
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# coding=utf-8
+"""Tests of the crash-safe journal of the download jobs.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import json
+import shutil
+import tempfile
+import unittest
+
+from utils.journal import JobJournal, DONE, FAILED, PENDING
+
+
+class JobJournalTest(unittest.TestCase):
+    """Test the state transitions of the jobs and their resume."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.cache_dir = tempfile.mkdtemp()
+        self.journal = JobJournal(cache_dir=self.cache_dir)
+        self.params = {'mapset': 'L2-AETI-D', 'period': ['2020-01-01', '2021-12-31']}
+        self.units = ['2020-01-01/2020-12-31', '2021-01-01/2021-12-31']
+
+    def tearDown(self):
+        """Runs after each test."""
+        self.journal._conn.close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_open_job_reuses_unfinished(self):
+        """The same kind and parameters give the same unfinished job."""
+        job_id = self.journal.open_job('wapor3-download', self.params)
+        self.assertEqual(job_id, self.journal.open_job('wapor3-download', dict(reversed(list(self.params.items())))))
+        self.assertNotEqual(job_id, self.journal.open_job('wapor3-download', dict(self.params, mapset='L2-T-D')))
+        self.assertNotEqual(job_id, self.journal.open_job('wapor2-crop', self.params))
+
+    def test_units_transitions(self):
+        """Units go from pending to done or failed, and the job closes once all are done."""
+        job_id = self.journal.open_job('wapor3-download', self.params)
+        self.journal.plan(job_id, self.units)
+        self.assertEqual(self.journal.pending(job_id), self.units)
+
+        self.journal.mark(job_id, self.units[0], DONE, json.dumps(['a.tif']))
+        self.journal.mark(job_id, self.units[1], FAILED, 'timeout')
+        self.assertEqual(self.journal.pending(job_id), self.units[1:])
+        self.assertFalse(self.journal.close_job(job_id))
+        self.assertEqual([job for job, _ in self.journal.unfinished('wapor3-download')], [job_id])
+
+        self.journal.mark(job_id, self.units[1], DONE, json.dumps(['b.tif']))
+        self.assertTrue(self.journal.close_job(job_id))
+        self.assertEqual(self.journal.unfinished('wapor3-download'), [])
+        self.assertEqual(self.journal.completed('wapor3-download', self.params),
+                         [json.dumps(['a.tif']), json.dumps(['b.tif'])])
+
+        ## A finished job is not reopened.
+        self.assertNotEqual(job_id, self.journal.open_job('wapor3-download', self.params))
+
+    def test_plan_keeps_state(self):
+        """Planning the units again keeps the state of the recorded ones."""
+        job_id = self.journal.open_job('wapor3-download', self.params)
+        self.journal.plan(job_id, self.units)
+        self.journal.mark(job_id, self.units[0], DONE)
+        self.journal.plan(job_id, self.units)
+        self.assertEqual(self.journal.pending(job_id), self.units[1:])
+        self.journal.mark(job_id, self.units[0], PENDING)
+        self.assertEqual(self.journal.pending(job_id), self.units)
+
+    def test_abandon(self):
+        """An abandoned job is neither unfinished nor completed."""
+        job_id = self.journal.open_job('wapor3-download', self.params)
+        self.journal.plan(job_id, self.units)
+        self.journal.abandon(job_id)
+        self.assertEqual(self.journal.unfinished(), [])
+        self.assertIsNone(self.journal.completed('wapor3-download', self.params))
+        self.assertNotEqual(job_id, self.journal.open_job('wapor3-download', self.params))
+
+    def test_resume_after_restart(self):
+        """A new journal on the same folder resumes the pending units."""
+        job_id = self.journal.open_job('wapor3-download', self.params)
+        self.journal.plan(job_id, self.units)
+        self.journal.mark(job_id, self.units[0], DONE)
+        self.journal._conn.close()
+
+        self.journal = JobJournal(cache_dir=self.cache_dir)
+        self.assertEqual(self.journal.unfinished('wapor3-download'), [(job_id, self.params)])
+        self.assertEqual(self.journal.open_job('wapor3-download', self.params), job_id)
+        self.assertEqual(self.journal.pending(job_id), self.units[1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
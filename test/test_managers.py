@@ -0,0 +1,87 @@
+# coding=utf-8
+"""Tests of the catalog listings of the API managers.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import unittest
+
+from unittest import mock
+
+import requests
+
+try:
+    from utils.managers import Wapor3APIManager
+except ImportError:
+    Wapor3APIManager = None
+
+URL = 'https://data.apps.fao.org/gismgr/api/v2/catalog/workspaces'
+
+
+class FakeCache:
+    """Catalog cache answering with the given pages, or raising the given exception."""
+
+    def __init__(self, pages=None, exception=None):
+        self.pages = pages or []
+        self.exception = exception
+        self.urls = []
+
+    def get_json(self, url, params=None, timeout=5, retries=None):
+        self.urls.append(url)
+        if self.exception is not None:
+            raise self.exception
+        return {'response': self.pages[len(self.urls) - 1]}
+
+
+@unittest.skipIf(Wapor3APIManager is None, 'QGIS is not available')
+class QueryListingTest(unittest.TestCase):
+    """Test the results of query_listing for the failures of the server."""
+
+    def manager(self, cache):
+        manager = Wapor3APIManager(cache=cache)
+        manager.transport = mock.Mock()
+        return manager
+
+    def test_pages(self):
+        """The items of all the pages are listed by caption."""
+        pages = [{'items': [{'caption': 'A', 'code': 'a'}],
+                  'links': [{'rel': 'next', 'href': URL + '?cursor=1'}]},
+                 {'items': [{'caption': 'B', 'code': 'b'}], 'links': []}]
+        cache = FakeCache(pages)
+        self.assertEqual(self.manager(cache).query_listing(URL), {'A': 'a', 'B': 'b'})
+        self.assertEqual(cache.urls, [URL, URL + '?cursor=1'])
+
+    def test_connection_error(self):
+        """Without connection the listing is None."""
+        for exception in [requests.ConnectionError('down'), requests.Timeout('slow')]:
+            self.assertIsNone(self.manager(FakeCache(exception=exception)).query_listing(URL))
+
+    def test_invalid_response(self):
+        """A response that is not JSON gives -1 without asking the server again."""
+        cache = FakeCache(exception=requests.JSONDecodeError('Expecting value', '<html>', 0))
+        manager = self.manager(cache)
+        self.assertEqual(manager.query_listing(URL), -1)
+        self.assertEqual(cache.urls, [URL])
+        manager.transport.get.assert_not_called()
+
+    def test_error_answer(self):
+        """An error answer that is not JSON gives -1."""
+        resp = requests.Response()
+        resp.status_code, resp.reason, resp.url = 503, 'Service Unavailable', URL
+        cache = FakeCache(exception=requests.HTTPError('503 Server Error', response=resp))
+        self.assertEqual(self.manager(cache).query_listing(URL), -1)
+
+    def test_unexpected_content(self):
+        """A JSON response without items gives the placeholder listing."""
+        self.assertEqual(self.manager(FakeCache([{'links': []}])).query_listing(URL), {'---': None})
+
+
+if __name__ == "__main__":
+    unittest.main()
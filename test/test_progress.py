@@ -0,0 +1,146 @@
+# coding=utf-8
+"""Tests of the progress reports and the cancellation of the downloads.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import time
+import unittest
+
+from utils.progress import CancelToken, DownloadCancelled, Progress
+
+
+class CancelTokenTest(unittest.TestCase):
+    """Test the cancellation shared through a token."""
+
+    def test_cancel(self):
+        """A cancelled token raises on check."""
+        token = CancelToken()
+        self.assertFalse(token.cancelled)
+        token.check()
+        token.cancel()
+        self.assertTrue(token.cancelled)
+        with self.assertRaises(DownloadCancelled):
+            token.check()
+
+    def test_parent(self):
+        """Cancelling the parent cancels its children, not the other way round."""
+        parent = CancelToken()
+        children = [CancelToken(parent) for _ in range(2)]
+        children[0].cancel()
+        self.assertFalse(parent.cancelled)
+        self.assertFalse(children[1].cancelled)
+        parent.cancel()
+        self.assertTrue(children[1].cancelled)
+        with self.assertRaises(DownloadCancelled):
+            children[1].check()
+
+
+class ProgressTest(unittest.TestCase):
+    """Test the GDAL progress functions built by Progress."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.reports = []
+
+    def progress(self, **kwargs):
+        kwargs.setdefault('interval', 0)
+        return Progress(self.reports.append, **kwargs)
+
+    def test_callback_range(self):
+        """The completion of a stage is mapped to its share of the download."""
+        callback = self.progress().callback(20, 60, 'warp')
+        for complete in [0, 0.5, 1]:
+            self.assertEqual(callback(complete, '', None), 1)
+        self.assertEqual([report['percent'] for report in self.reports], [20, 40, 60])
+        self.assertEqual({report['stage'] for report in self.reports}, {'warp'})
+
+    def test_part_callbacks_average(self):
+        """The progress of parts running at the same time is their mean."""
+        callbacks = self.progress().part_callbacks(0, 80, 4, 'warp')
+        callbacks[0](1.0)
+        callbacks[2](0.5)
+        callbacks[0](1.0)
+        callbacks[1](1.0)
+        callbacks[3](1.0)
+        callbacks[2](1.0)
+        self.assertEqual([report['percent'] for report in self.reports], [20, 30, 30, 50, 70, 80])
+
+    def test_cancelled_callbacks_return_zero(self):
+        """GDAL is stopped once the token is cancelled."""
+        progress = self.progress()
+        callbacks = [progress.callback(0, 50)] + progress.part_callbacks(50, 100, 2)
+        self.assertEqual([callback(0.1) for callback in callbacks], [1, 1, 1])
+        progress.token.cancel()
+        self.assertEqual([callback(0.2) for callback in callbacks], [0, 0, 0])
+        with self.assertRaises(DownloadCancelled):
+            progress.check()
+
+    def test_shared_token(self):
+        """Cancelling the shared token stops every download holding it."""
+        token = CancelToken()
+        callbacks = [self.progress(token=token).callback() for _ in range(3)]
+        token.cancel()
+        self.assertEqual([callback(0.5) for callback in callbacks], [0, 0, 0])
+
+    def test_interval(self):
+        """Reports are throttled, except the one of the end of the download."""
+        callback = self.progress(interval=60).callback()
+        for complete in [0.1, 0.2, 0.3, 1.0]:
+            callback(complete)
+        self.assertEqual([report['percent'] for report in self.reports], [10, 100])
+
+    def test_bytes(self):
+        """The bytes downloaded since the start are reported with the speed."""
+        downloaded = [1000]
+        progress = self.progress(bytes_counter=lambda: downloaded[0])
+        time.sleep(0.01)
+        downloaded[0] += 2000000
+        progress.callback()(0.5)
+        self.assertEqual(self.reports[0]['bytes'], 2000000)
+        self.assertGreater(self.reports[0]['mb_per_s'], 0)
+
+    def test_count_bytes(self):
+        """The bytes are counted from the moment the counter is set."""
+        downloaded = [5000]
+        progress = self.progress()
+        progress.callback()(0.1)
+        progress.count_bytes(lambda: downloaded[0])
+        downloaded[0] += 300
+        progress.callback()(0.2)
+        self.assertEqual([report['bytes'] for report in self.reports], [0, 300])
+
+    def test_children_average(self):
+        """The progress of concurrent downloads is their mean."""
+        children = self.progress().children(2)
+        children[0].callback()(1.0)
+        children[1].callback()(0.5)
+        self.assertEqual([report['percent'] for report in self.reports], [50, 75])
+
+    def test_children_tokens(self):
+        """Cancelling a child leaves the others, cancelling the parent stops all of them."""
+        progress = self.progress()
+        children = progress.children(3)
+        children[0].token.cancel()
+        self.assertFalse(progress.token.cancelled)
+        self.assertEqual([child.callback()(0.5) for child in children], [0, 1, 1])
+        progress.token.cancel()
+        self.assertEqual([child.callback()(0.5) for child in children], [0, 0, 0])
+
+    def test_without_report(self):
+        """Without a report function the callbacks only check the token."""
+        progress = Progress()
+        self.assertEqual(progress.callback()(0.5), 1)
+        progress.token.cancel()
+        self.assertEqual(progress.callback()(0.5), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
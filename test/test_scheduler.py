@@ -0,0 +1,152 @@
+# coding=utf-8
+"""Tests of the priority scheduler of the downloads.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import queue
+import threading
+import time
+import unittest
+
+from utils.scheduler import DownloadScheduler, INTERACTIVE, BATCH, RUNNING, QUEUED, DONE, CANCELLED
+
+
+class Job:
+    """Runnable that records its start and waits to be released."""
+
+    def __init__(self, name, started, release=None):
+        self.name = name
+        self.started = started
+        self.release = release if release is not None else threading.Event()
+        self.cancelled = False
+
+    def run(self):
+        self.started.append(self.name)
+        self.release.wait(5)
+
+    def cancel(self):
+        self.cancelled = True
+        self.release.set()
+
+
+class DownloadSchedulerTest(unittest.TestCase):
+    """Test the priority ordering and the limits of the scheduler."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.started = list()
+        self.scheduler = None
+
+    def tearDown(self):
+        """Runs after each test."""
+        if self.scheduler is not None:
+            self.scheduler.cancel_all()
+            self.wait_for(lambda: self.scheduler.active() == 0)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline, 'Timed out waiting for the scheduler')
+            time.sleep(0.01)
+
+    def states(self):
+        return {job['name']: job['state'] for job in self.scheduler.snapshot()}
+
+    def test_interactive_before_batch(self):
+        """Queued interactive jobs run before the batch ones, in submit order."""
+        self.scheduler = DownloadScheduler(max_workers=1, reserved=0)
+        blocker = Job('blocker', self.started)
+        self.scheduler.submit(blocker, 'blocker', BATCH, host='a')
+        self.wait_for(lambda: self.started == ['blocker'])
+
+        release = threading.Event()
+        release.set()
+        for name, priority in [('batch1', BATCH), ('interactive1', INTERACTIVE),
+                               ('batch2', BATCH), ('interactive2', INTERACTIVE)]:
+            self.scheduler.submit(Job(name, self.started, release), name, priority, host='a')
+        self.assertEqual([job['name'] for job in self.scheduler.snapshot()],
+                         ['blocker', 'interactive1', 'interactive2', 'batch1', 'batch2'])
+
+        blocker.release.set()
+        self.wait_for(lambda: self.scheduler.active() == 0)
+        self.assertEqual(self.started, ['blocker', 'interactive1', 'interactive2', 'batch1', 'batch2'])
+
+    def test_host_limit(self):
+        """Batch jobs of a host do not run over its limit, other hosts still run."""
+        self.scheduler = DownloadScheduler(max_workers=4, reserved=0, host_limits={'a': 2})
+        jobs = [Job('a{}'.format(i), self.started) for i in range(3)] + [Job('b0', self.started)]
+        for job in jobs:
+            self.scheduler.submit(job, job.name, BATCH, host=job.name[0])
+        self.wait_for(lambda: len(self.started) == 3)
+        self.assertEqual(self.states(), {'a0': RUNNING, 'a1': RUNNING, 'a2': QUEUED, 'b0': RUNNING})
+
+        jobs[0].release.set()
+        self.wait_for(lambda: self.states()['a2'] == RUNNING)
+        self.assertEqual(self.states()['a0'], DONE)
+
+    def test_reserved_worker(self):
+        """Batch jobs leave the reserved workers to the interactive ones."""
+        self.scheduler = DownloadScheduler(max_workers=2, reserved=1, default_host_limit=1)
+        batch = [Job('batch{}'.format(i), self.started) for i in range(2)]
+        for job in batch:
+            self.scheduler.submit(job, job.name, BATCH, host='a')
+        self.wait_for(lambda: len(self.started) == 1)
+        self.assertEqual(self.states()['batch1'], QUEUED)
+
+        ## The interactive job uses the reserved worker even over the host cap.
+        self.scheduler.submit(Job('interactive', self.started), 'interactive', INTERACTIVE, host='a')
+        self.wait_for(lambda: len(self.started) == 2)
+        self.assertEqual(self.states()['interactive'], RUNNING)
+        self.assertEqual(self.states()['batch1'], QUEUED)
+
+    def test_fair_share(self):
+        """Among jobs of the same priority, the owner with fewer running jobs goes first."""
+        self.scheduler = DownloadScheduler(max_workers=2, reserved=0, default_host_limit=2)
+        first = Job('big0', self.started)
+        self.scheduler.submit(first, 'big0', BATCH, host='a', owner='big')
+        self.scheduler.submit(Job('big1', self.started), 'big1', BATCH, host='a', owner='big')
+        self.wait_for(lambda: len(self.started) == 2)
+        self.scheduler.submit(Job('big2', self.started), 'big2', BATCH, host='a', owner='big')
+        self.scheduler.submit(Job('small0', self.started), 'small0', BATCH, host='a', owner='small')
+
+        first.release.set()
+        self.wait_for(lambda: len(self.started) == 3)
+        self.assertEqual(self.started[-1], 'small0')
+
+    def test_queue_full(self):
+        """Submitting over max_queued waiting jobs raises queue.Full."""
+        self.scheduler = DownloadScheduler(max_workers=1, max_queued=2, reserved=0)
+        for i in range(3):
+            self.scheduler.submit(Job(str(i), self.started), str(i), BATCH)
+        self.wait_for(lambda: len(self.started) == 1)
+        with self.assertRaises(queue.Full):
+            self.scheduler.submit(Job('3', self.started), '3', BATCH)
+
+    def test_cancel(self):
+        """Cancelling removes a queued job and stops a running one."""
+        self.scheduler = DownloadScheduler(max_workers=1, reserved=0)
+        running = Job('running', self.started)
+        queued = Job('queued', self.started)
+        running_id = self.scheduler.submit(running, 'running', BATCH)
+        queued_id = self.scheduler.submit(queued, 'queued', BATCH)
+        self.wait_for(lambda: self.started == ['running'])
+
+        self.scheduler.cancel(queued_id)
+        self.assertEqual(self.states()['queued'], CANCELLED)
+        self.scheduler.cancel(running_id)
+        self.wait_for(lambda: self.scheduler.active() == 0)
+        self.assertTrue(running.cancelled)
+        self.assertEqual(self.states(), {'running': CANCELLED, 'queued': CANCELLED})
+        self.assertEqual(self.started, ['running'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,257 @@
+# coding=utf-8
+"""Tests of the shared HTTP transport.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import random
+import threading
+import time
+import unittest
+
+import requests
+
+from urllib.parse import urlparse, parse_qsl
+
+from utils.transport import HttpTransport, collect_pages, _page_urls
+from utilities import start_http_server, stop_http_server
+
+BASE = 'https://data.apps.fao.org/gismgr/api/v2/catalog/workspaces/WAPOR-3/mapsets'
+
+
+class HttpTransportTest(unittest.TestCase):
+    """Test the retries and the host limits of the transport."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.statuses = []
+        self.headers = {}
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.delay = 0
+        self.lock = threading.Lock()
+        self.server, self.url = start_http_server(self.respond)
+
+    def tearDown(self):
+        """Runs after each test."""
+        stop_http_server(self.server)
+
+    def respond(self, handler):
+        with self.lock:
+            self.calls.append(handler.command)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            status = self.statuses.pop(0) if self.statuses else 200
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        headers = self.headers if status != 200 else {}
+        return status, headers, b'{}'
+
+    def transport(self, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        kwargs.setdefault('timeout', 5)
+        return HttpTransport(**kwargs)
+
+    def test_retry_statuses(self):
+        """429 and 5xx answers are retried until a good one."""
+        self.statuses = [503, 429, 502]
+        transport = self.transport()
+        resp = transport.get(self.url + '/catalog')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(self.calls), 4)
+        self.assertEqual(transport.stats()['retries'], 3)
+
+    def test_retries_exhausted(self):
+        """The last response is returned once the retries are exhausted."""
+        self.statuses = [500] * 5
+        transport = self.transport(retries=2)
+        self.assertEqual(transport.get(self.url).status_code, 500)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        """Client errors are returned at once."""
+        self.statuses = [404]
+        self.assertEqual(self.transport().get(self.url).status_code, 404)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_posts_are_not_retried(self):
+        """POSTs are sent once unless retries are given, HEADs are retried."""
+        self.statuses = [503, 503]
+        transport = self.transport()
+        self.assertEqual(transport.post(self.url, json={}).status_code, 503)
+        self.assertEqual(self.calls, ['POST'])
+        self.assertEqual(transport.request('POST', self.url, retries=1, json={}).status_code, 200)
+        self.assertEqual(self.calls, ['POST', 'POST', 'POST'])
+
+        self.statuses = [502]
+        self.assertEqual(transport.head(self.url).status_code, 200)
+        self.assertEqual(self.calls[3:], ['HEAD', 'HEAD'])
+
+    def test_retries_override(self):
+        """The retries of a request override those of the transport."""
+        self.statuses = [500] * 5
+        self.assertEqual(self.transport(retries=4).get(self.url, retries=1).status_code, 500)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_retry_after(self):
+        """The Retry-After header sets the delay, capped by max_backoff."""
+        self.statuses = [429]
+        self.headers = {'Retry-After': '1'}
+        start = time.time()
+        self.transport(backoff=0).get(self.url)
+        self.assertGreaterEqual(time.time() - start, 1)
+
+        self.statuses = [429]
+        self.headers = {'Retry-After': '120'}
+        start = time.time()
+        self.transport(backoff=0, max_backoff=0.2).get(self.url)
+        self.assertLess(time.time() - start, 5)
+
+    def test_connection_errors(self):
+        """Connection errors are retried and raised once exhausted."""
+        stop_http_server(self.server)
+        transport = self.transport(retries=2)
+        with self.assertRaises(requests.ConnectionError):
+            transport.get(self.url)
+        self.assertEqual(transport.stats()['requests'], 3)
+
+    def test_host_limit(self):
+        """No more concurrent requests than the limit reach a host."""
+        self.delay = 0.1
+        transport = self.transport()
+        transport.set_host_limit('127.0.0.1:{}'.format(self.server.server_address[1]), 2)
+        threads = [threading.Thread(target=transport.get, args=(self.url,)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.calls), 6)
+        self.assertLessEqual(self.max_active, 2)
+
+    def test_connections_are_reused(self):
+        """Sequential requests share one keep-alive connection."""
+        transport = self.transport()
+        for _ in range(5):
+            transport.get(self.url)
+        stats = transport.stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused_connections'], 4)
+
+
+class Listing:
+    """Paginated listing answering like the GISMGR catalog."""
+
+    def __init__(self, items, total_key=None, total=None, offsets=True, delay=0.0):
+        self.items = items
+        self.total_key = total_key
+        self.total = total if total is not None else items
+        self.offsets = offsets
+        self.delay = delay
+        self.fetched = list()
+        self._lock = threading.Lock()
+
+    def url(self, offset, limit=10):
+        if self.offsets:
+            return '{}?overview=false&offset={}&limit={}'.format(BASE, offset, limit)
+        return '{}?cursor={}'.format(BASE, offset)
+
+    def fetch(self, url):
+        with self._lock:
+            self.fetched.append(url)
+        query = dict(parse_qsl(urlparse(url).query))
+        offset = int(query.get('offset', query.get('cursor', 0)))
+        limit = int(query.get('limit', 10))
+        if self.delay > 0:
+            time.sleep(random.uniform(0, self.delay))
+        page = {'items': list(range(offset, min(offset + limit, self.items))), 'links': []}
+        if offset + limit < self.items:
+            page['links'].append({'rel': 'next', 'href': self.url(offset + limit, limit)})
+        if self.total_key == 'count':
+            page['count'] = len(page['items'])
+        elif self.total_key is not None:
+            page[self.total_key] = self.total
+        return page
+
+
+class CollectPagesTest(unittest.TestCase):
+    """Test the concurrent collection of the paginated listings."""
+
+    def setUp(self):
+        """Runs before each test."""
+        random.seed(42)
+
+    def collect(self, listing, **kwargs):
+        pages = collect_pages(listing.url(0), listing.fetch, **kwargs)
+        return [item for page in pages for item in page['items']]
+
+    def test_total_items(self):
+        """With the total the pages are planned and fetched once each."""
+        for key in ['totalItems', 'totalCount']:
+            listing = Listing(95, total_key=key)
+            self.assertEqual(self.collect(listing), list(range(95)))
+            self.assertEqual(len(listing.fetched), 10)
+            self.assertEqual(len(set(listing.fetched)), 10)
+
+    def test_count_is_not_total(self):
+        """The count of the items of a page is not taken as the total."""
+        listing = Listing(95, total_key='count')
+        self.assertEqual(self.collect(listing), list(range(95)))
+
+    def test_wrong_total(self):
+        """The next links are followed past a total that is too low."""
+        listing = Listing(95, total_key='totalItems', total=30)
+        self.assertEqual(self.collect(listing), list(range(95)))
+        self.assertEqual(len(set(listing.fetched)), len(listing.fetched))
+
+    def test_total_too_high(self):
+        """With a total that is too high the planned pages stop at the window of the last page."""
+        listing = Listing(35, total_key='totalItems', total=95)
+        pages = collect_pages(listing.url(0), listing.fetch, max_workers=4)
+        self.assertEqual([item for page in pages for item in page['items']], list(range(35)))
+        self.assertEqual(len(pages), 4)
+        self.assertLessEqual(len(listing.fetched), 5)
+
+    def test_without_total(self):
+        """Without the total the next links are followed, no page past the last one is fetched."""
+        for items in [5, 10, 11, 80, 81, 333]:
+            listing = Listing(items)
+            self.assertEqual(self.collect(listing, max_workers=4), list(range(items)))
+            self.assertEqual(listing.fetched, [listing.url(offset) for offset in range(0, max(items, 1), 10)])
+
+    def test_concurrent_order(self):
+        """Pages finishing out of order are still returned in order."""
+        for key in ['totalItems', None]:
+            listing = Listing(200, total_key=key, delay=0.02)
+            self.assertEqual(self.collect(listing), list(range(200)))
+
+    def test_without_offsets(self):
+        """Listings without offset and limit are followed one page at a time."""
+        listing = Listing(55, total_key='totalItems', offsets=False)
+        self.assertEqual(self.collect(listing), list(range(55)))
+        self.assertEqual(len(listing.fetched), 6)
+
+    def test_single_worker(self):
+        """With a single worker the next links are followed in order."""
+        listing = Listing(55, total_key='totalItems')
+        self.assertEqual(self.collect(listing, max_workers=1), list(range(55)))
+        self.assertEqual(listing.fetched, [listing.url(offset) for offset in range(0, 55, 10)])
+
+    def test_page_urls(self):
+        """The page URLs keep the other query parameters and move the offset."""
+        urls = _page_urls('{}?overview=false&Offset=10&limit=10'.format(BASE), 40)
+        self.assertEqual(urls, ['{}?overview=false&Offset={}&limit=10'.format(BASE, offset)
+                                for offset in [10, 20, 30]])
+
+
+if __name__ == "__main__":
+    unittest.main()
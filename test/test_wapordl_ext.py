@@ -0,0 +1,1102 @@
+# coding=utf-8
+"""Tests of the download functions of wapordl_ext.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import collections
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from unittest import mock
+
+from utilities import start_http_server, stop_http_server, range_response
+
+try:
+    import numpy as np
+    import shapely
+    from osgeo import gdal
+    from utils import wapordl_ext
+    from utils.blockcache import BlockCache
+    from utils.inventory import RasterInventory
+    from utils.progress import DownloadCancelled, Progress
+except ImportError:
+    gdal = None
+else:
+    gdal.UseExceptions()
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+
+SERIAL = itertools.count()
+
+
+def raster_bytes(array, geotransform=(30.0, 0.01, 0.0, 10.0, 0.0, -0.01), nodata=None,
+                 scale=None, offset=None, data_type=None, epsg=4326, block=16):
+    """Returns the bytes of a tiled single band GeoTIFF holding array."""
+    fn = '/vsimem/raster_{}.tif'.format(next(SERIAL))
+    data_type = data_type or gdal.GDT_Int16
+    ysize, xsize = array.shape
+    ds = gdal.GetDriverByName('GTiff').Create(fn, xsize, ysize, 1, data_type,
+                                              ['TILED=YES', 'BLOCKXSIZE={}'.format(block),
+                                               'BLOCKYSIZE={}'.format(block)])
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection('EPSG:{}'.format(epsg))
+    band = ds.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    if scale is not None:
+        band.SetScale(scale)
+    if offset is not None:
+        band.SetOffset(offset)
+    band.WriteArray(array)
+    ds = None
+    f = gdal.VSIFOpenL(fn, 'rb')
+    content = gdal.VSIFReadL(1, gdal.VSIStatL(fn).size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(fn)
+    return content
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class RasterServerTest(unittest.TestCase):
+    """Base of the tests reading rasters through /vsicurl/ from a local server."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs before the tests of the class."""
+        cls.files = dict()
+        cls.cache_dir = tempfile.mkdtemp()
+        cls.block_cache = mock.patch.object(wapordl_ext, 'BLOCK_CACHE', BlockCache(cache_dir=cls.cache_dir,
+                                                                               allowed_hosts=('127.0.0.1',)))
+        cls.block_cache.start()
+        cls.server, cls.url = start_http_server(
+            lambda handler: range_response(handler, cls.files[handler.path.split('?')[0]])
+            if handler.path.split('?')[0] in cls.files else (404, {}, b''))
+
+    @classmethod
+    def tearDownClass(cls):
+        """Runs after the tests of the class."""
+        stop_http_server(cls.server)
+        wapordl_ext.BLOCK_CACHE.close()
+        cls.block_cache.stop()
+        shutil.rmtree(cls.cache_dir, ignore_errors=True)
+
+    def serve(self, content, name=None):
+        """Serves content under a new URL, which is returned."""
+        path = '/{}/{}'.format(next(SERIAL), name or 'file.tif')
+        self.files[path] = content
+        return self.url + path
+
+    def mkdtemp(self):
+        """Returns a temporary folder removed after the test."""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        return folder
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class UrlExistsTest(unittest.TestCase):
+    """Test the existence checks of the agERA5 files."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.calls = []
+        self.lock = threading.Lock()
+        self.server, self.url = start_http_server(self.respond)
+
+    def tearDown(self):
+        """Runs after each test."""
+        stop_http_server(self.server)
+
+    def respond(self, handler):
+        with self.lock:
+            self.calls.append((handler.command, handler.path, handler.headers.get('Range')))
+        if handler.path.startswith('/missing'):
+            return 404, {}, b''
+        if handler.path.startswith('/nohead') and handler.command == 'HEAD':
+            return 405, {}, b''
+        if handler.headers.get('Range') == 'bytes=0-0':
+            return 206, {'Content-Range': 'bytes 0-0/1000'}, b'I'
+        return 200, {'Content-Length': '1000'}, b'I' * 1000
+
+    def test_head(self):
+        """A HEAD request is enough when the server allows it."""
+        self.assertTrue(wapordl_ext.__url_exists__(self.url + '/file.tif'))
+        self.assertFalse(wapordl_ext.__url_exists__(self.url + '/missing.tif'))
+        self.assertEqual([call[0] for call in self.calls], ['HEAD', 'HEAD'])
+
+    def test_ranged_get_fallback(self):
+        """Without HEAD a single byte is requested instead of the file."""
+        self.assertTrue(wapordl_ext.__url_exists__(self.url + '/nohead/file.tif'))
+        self.assertEqual(self.calls, [('HEAD', '/nohead/file.tif', None),
+                                      ('GET', '/nohead/file.tif', 'bytes=0-0')])
+
+    def test_valid_urls_are_remembered(self):
+        """The URLs found to exist are not checked again."""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        inventory = RasterInventory(cache_dir=cache_dir)
+        checked = []
+
+        def url_exists(url):
+            with self.lock:
+                checked.append(url)
+            return not url.endswith('D03.tif')
+
+        with mock.patch.object(wapordl_ext, 'RASTER_INVENTORY', inventory), \
+             mock.patch.object(wapordl_ext, '__url_exists__', url_exists):
+            urls = wapordl_ext.generate_urls_agERA5('AGERA5-ET0-D', period=['2021-01-01', '2021-02-28'])
+            self.assertEqual(len(checked), 6)
+            self.assertEqual(len(urls), 5)
+            self.assertFalse(any(url.endswith('D03.tif') for url in urls))
+            self.assertEqual(wapordl_ext.generate_urls_agERA5('AGERA5-ET0-D', period=['2021-01-01', '2021-02-28']),
+                             urls)
+            self.assertEqual(len(checked), 7)
+        inventory._conn.close()
+
+
+class TemplateVrtTest(RasterServerTest):
+    """Test the VRT written from a single template matches BuildVRT."""
+
+    def check_template(self, **kwargs):
+        arrays = [np.arange(40 * 24, dtype='int16').reshape(24, 40) * (i + 1) for i in range(3)]
+        urls = [('2021-0{}-01'.format(i + 1), self.serve(raster_bytes(array, **kwargs)))
+                for i, array in enumerate(arrays)]
+        info = gdal.Info(wapordl_ext.__vsi_path__(urls[0][1]), format='json')
+        folder = self.mkdtemp()
+
+        template = wapordl_ext.__template_vrt__(folder + '/template.vrt', urls, info)
+        built = gdal.BuildVRT(folder + '/built.vrt', [wapordl_ext.__vsi_path__(url) for _, url in urls],
+                              separate=True)
+        self.assertEqual(template.RasterCount, built.RasterCount)
+        self.assertEqual(template.GetGeoTransform(), built.GetGeoTransform())
+        self.assertTrue(template.GetSpatialRef().IsSame(built.GetSpatialRef()))
+        for i in range(1, template.RasterCount + 1):
+            band, expected = template.GetRasterBand(i), built.GetRasterBand(i)
+            self.assertEqual(band.DataType, expected.DataType)
+            self.assertEqual(band.GetNoDataValue(), expected.GetNoDataValue())
+            self.assertEqual(band.GetScale(), expected.GetScale())
+            self.assertEqual(band.GetOffset(), expected.GetOffset())
+            self.assertEqual(band.GetBlockSize(), expected.GetBlockSize())
+            np.testing.assert_array_equal(band.ReadAsArray(), arrays[i - 1])
+            np.testing.assert_array_equal(band.ReadAsArray(), expected.ReadAsArray())
+
+    def test_plain(self):
+        """Rasters without nodata, scale or offset."""
+        self.check_template()
+
+    def test_nodata_scale_offset(self):
+        """Nodata, scale and offset are copied to every band."""
+        self.check_template(nodata=-9999, scale=0.1, offset=2.0)
+
+    def test_projected(self):
+        """The coordinate system of a projected grid is kept."""
+        self.check_template(geotransform=(500000.0, 20.0, 0.0, 1000000.0, 0.0, -20.0), epsg=32636)
+
+
+class CogDlTest(RasterServerTest):
+    """Test the downloads of cog_dl."""
+
+    WARP_KWARGS = {'xRes': 0.01, 'yRes': 0.01, 'outputBounds': [30.05, 9.8, 30.3, 9.95]}
+
+    def urls(self, n=4, **kwargs):
+        self.arrays = [np.arange(40 * 24, dtype='int16').reshape(24, 40) + 100 * i for i in range(n)]
+        return [({'start_date': '2021-0{}-01'.format(i + 1)}, self.serve(raster_bytes(array, **kwargs)))
+                for i, array in enumerate(self.arrays)]
+
+    def read(self, fn):
+        ds = gdal.Open(fn)
+        bands = [ds.GetRasterBand(i + 1) for i in range(ds.RasterCount)]
+        return (ds.GetGeoTransform(), [band.ReadAsArray() for band in bands],
+                [band.GetMetadata() for band in bands], [band.GetNoDataValue() for band in bands])
+
+    def test_parallel_bands(self):
+        """Warping the bands in parallel gives the single-pass output."""
+        urls = self.urls(nodata=-9999)
+        folder = self.mkdtemp()
+        single, _ = wapordl_ext.cog_dl(urls, folder + '/single.tif', warp_kwargs=self.WARP_KWARGS)
+        parallel, _ = wapordl_ext.cog_dl(urls, folder + '/parallel.tif', warp_kwargs=self.WARP_KWARGS,
+                                         band_workers=4)
+        expected, actual = self.read(single), self.read(parallel)
+        self.assertEqual(actual[0], expected[0])
+        for array, expected_array in zip(actual[1], expected[1]):
+            np.testing.assert_array_equal(array, expected_array)
+        self.assertEqual(actual[2:], expected[2:])
+        np.testing.assert_array_equal(expected[1][2], self.arrays[2][5:20, 5:30])
+        self.assertEqual(sorted(os.listdir(folder)), ['parallel.tif', 'single.tif'])
+
+    def test_blocks_are_cached(self):
+        """A second download of the same rasters is read from the block cache."""
+        urls = self.urls()
+        folder = self.mkdtemp()
+        wapordl_ext.cog_dl(urls, folder + '/first.tif', warp_kwargs=self.WARP_KWARGS)
+        before = wapordl_ext.BLOCK_CACHE.stats()
+        wapordl_ext.cog_dl(urls, folder + '/second.tif', warp_kwargs=self.WARP_KWARGS)
+        after = wapordl_ext.BLOCK_CACHE.stats()
+        self.assertGreater(after['hits'], before['hits'])
+        self.assertEqual(after['misses'], before['misses'])
+
+    def test_unstitched_bands(self):
+        """Without stitching a VRT of the single-band files is returned."""
+        urls = self.urls()
+        folder = self.mkdtemp()
+        out_fn, _ = wapordl_ext.cog_dl(urls, folder + '/bands.tif', warp_kwargs=self.WARP_KWARGS,
+                                       band_workers=2, stitch=False)
+        self.assertTrue(out_fn.endswith('_bands.vrt'))
+        _, arrays, metadata, _ = self.read(out_fn)
+        self.assertEqual(len(arrays), 4)
+        np.testing.assert_array_equal(arrays[3], self.arrays[3][5:20, 5:30])
+        self.assertEqual(metadata[3], {'start_date': '2021-04-01'})
+
+        parts_dir, = [fn for fn in os.listdir(folder) if os.path.isdir(os.path.join(folder, fn))]
+        self.assertTrue(parts_dir.startswith('bands_bands_'))
+        self.assertEqual(len(os.listdir(os.path.join(folder, parts_dir))), 4)
+        wapordl_ext.__remove_parts__(out_fn, gdal.Open(out_fn).GetFileList())
+        self.assertEqual(os.listdir(folder), [])
+
+    def test_cancel(self):
+        """A cancelled warp raises and leaves no partial files behind."""
+        urls = self.urls()
+        for band_workers in [1, 4]:
+            folder = self.mkdtemp()
+            progress = Progress(lambda report: progress.token.cancel(), interval=0)
+            with self.assertRaises(DownloadCancelled):
+                wapordl_ext.cog_dl(urls, folder + '/cancelled.tif', warp_kwargs=self.WARP_KWARGS,
+                                   band_workers=band_workers, progress=progress)
+            self.assertEqual(os.listdir(folder), [])
+
+    def test_progress(self):
+        """The warp reports its progress up to the end of the download stage."""
+        reports = []
+        folder = self.mkdtemp()
+        wapordl_ext.cog_dl(self.urls(), folder + '/progress.tif', warp_kwargs=self.WARP_KWARGS,
+                           band_workers=2, progress=Progress(reports.append, interval=0))
+        percents = [report['percent'] for report in reports]
+        self.assertEqual(percents[-1], 85)
+        self.assertEqual({report['stage'] for report in reports}, {'warp', 'stitch'})
+
+    def write_cutline(self, folder):
+        fn = os.path.join(folder, 'field.geojson')
+        with open(fn, 'w', encoding='utf-8') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [{
+                'type': 'Feature', 'properties': {},
+                'geometry': {'type': 'Polygon', 'coordinates': [[[30.052, 9.81], [30.29, 9.83], [30.2, 9.948],
+                                                                 [30.1, 9.9], [30.052, 9.81]]]}}]}, f)
+        return fn
+
+    def test_cutline_mask(self):
+        """The rasterized cutline masks the pixels a warp cutline masks."""
+        urls = self.urls(nodata=-9999)
+        folder = self.mkdtemp()
+        cutline = self.write_cutline(folder)
+        expected, _ = wapordl_ext.cog_dl(urls, folder + '/warp_cutline.tif',
+                                         warp_kwargs=dict(self.WARP_KWARGS, cutlineDSName=cutline))
+        expected = self.read(expected)
+        self.assertTrue((expected[1][0] == -9999).any())
+        for band_workers in [1, 4]:
+            out_fn, _ = wapordl_ext.cog_dl(urls, folder + '/mask_{}.tif'.format(band_workers),
+                                           warp_kwargs=self.WARP_KWARGS, cutline=cutline,
+                                           band_workers=band_workers)
+            actual = self.read(out_fn)
+            self.assertEqual(actual[0], expected[0])
+            for array, expected_array in zip(actual[1], expected[1]):
+                np.testing.assert_array_equal(array, expected_array)
+
+    def test_stream_stats(self):
+        """The streamed statistics are those of the warped and masked rasters, in the converted units."""
+        urls = self.urls(nodata=-9999, scale=0.1, offset=1.0)
+        for md, _ in urls:
+            md.update({'units': 'mm/day', 'temporal_resolution': 'Dekad', 'number_of_days': 10})
+        folder = self.mkdtemp()
+        cutline = self.write_cutline(folder)
+        out_fn, _ = wapordl_ext.cog_dl(urls, folder + '/masked.tif', warp_kwargs=self.WARP_KWARGS, cutline=cutline)
+        _, arrays, _, _ = self.read(out_fn)
+        for band_workers in [1, 3]:
+            converted = [(dict(md), url) for md, url in urls]
+            stats = wapordl_ext.__stream_stats__(converted, self.WARP_KWARGS, 'NONE', cutline, 'dekad',
+                                                 ['mean', 'std', 'count', 'minimum', 'p50'],
+                                                 band_workers=band_workers)
+            self.assertEqual(len(stats), 4)
+            for result, array in zip(stats, arrays):
+                values = (array[array != -9999] * 0.1 + 1.0) * 10
+                self.assertEqual(result['count'], values.size)
+                self.assertAlmostEqual(result['mean'], values.mean())
+                self.assertAlmostEqual(result['std'], values.std())
+                self.assertAlmostEqual(result['minimum'], values.min())
+                self.assertAlmostEqual(result['p50'], np.percentile(values, 50), delta=1.0)
+            self.assertEqual(converted[0][0]['units'], 'mm/dekad')
+
+    def test_cutline_mask_is_cached(self):
+        """The mask of a grid is rasterized once."""
+        cutline = self.write_cutline(self.mkdtemp())
+        args = (cutline, wapordl_ext.__region_hash__(cutline), 25, 15, (30.05, 0.01, 0.0, 9.95, 0.0, -0.01),
+                gdal.osr.SRS_WKT_WGS84_LAT_LONG)
+        mask = wapordl_ext.__cutline_mask__(*args)
+        self.assertIs(wapordl_ext.__cutline_mask__(*args), mask)
+        self.assertEqual(mask.shape, (15, 25))
+        self.assertFalse(mask.flags.writeable)
+        self.assertTrue(mask[8, 12])
+        self.assertFalse(mask[0, 0])
+
+    def test_aligned_bounds(self):
+        """The bounds grow to the nearest multiples of the resolution."""
+        np.testing.assert_allclose(wapordl_ext.__aligned_bounds__([30.052, 9.81, 30.29, 9.948], 0.01, 0.01),
+                                   [30.05, 9.81, 30.29, 9.95])
+        np.testing.assert_allclose(wapordl_ext.__aligned_bounds__([500010, 1000005, 500090, 1000095], 20, 20),
+                                   [500000, 1000000, 500100, 1000100])
+
+
+class WaporMapTest(RasterServerTest):
+    """Test the incremental downloads of wapor_map."""
+
+    REGION = [30.05, 9.8, 30.3, 9.95]
+    METADATA = {'long_name': 'Actual EvapoTranspiration and Interception', 'units': 'mm/day'}
+
+    def setUp(self):
+        """Runs before each test."""
+        self.served = dict()
+        self.requested = []
+        patches = [mock.patch.object(wapordl_ext, 'generate_urls_v3', self.generate_urls),
+                   mock.patch.object(wapordl_ext, 'collect_metadata', lambda variable: dict(self.METADATA))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def generate_urls(self, variable, l3_region=None, period=None):
+        urls = list()
+        for month in range(1, 13):
+            for dekad in range(1, 4):
+                start = '2021-{:02d}-{:02d}'.format(month, 10 * dekad - 9)
+                if period is not None and not period[0] <= start <= period[1]:
+                    continue
+                if start not in self.served:
+                    array = np.full((24, 40), month * 10 + dekad, dtype='int16')
+                    name = 'WAPOR-3.{}.2021-{:02d}-D{}.tif'.format(variable, month, dekad)
+                    self.served[start] = self.serve(raster_bytes(array, nodata=-9999, scale=0.1), name)
+                urls.append(self.served[start])
+        self.requested.append(urls)
+        return tuple(urls)
+
+    def wapor_map(self, folder, period, region=None, **kwargs):
+        kwargs.setdefault('seperate_unscale', True)
+        kwargs.setdefault('incremental', True)
+        region = self.REGION if region is None else region
+        return wapordl_ext.wapor_map(region, 'L1-AETI-D', period, folder, file_name='test', **kwargs)
+
+    def test_parallel_bands(self):
+        """Bands are warped in a single pass by default, in parallel only when asked, without leftovers."""
+        self.assertEqual(wapordl_ext.BAND_WORKERS, 1)
+        folders = [self.mkdtemp(), self.mkdtemp()]
+        single = self.wapor_map(folders[0], ['2021-01-01', '2021-01-31'], incremental=False)
+        parallel = self.wapor_map(folders[1], ['2021-01-01', '2021-01-31'], incremental=False, band_workers=3)
+        for folder, fps in zip(folders, [single, parallel]):
+            self.assertEqual(sorted(os.listdir(folder)), [os.path.basename(fp) for fp in fps])
+        for fp, other in zip(single, parallel):
+            np.testing.assert_array_equal(gdal.Open(fp).ReadAsArray(), gdal.Open(other).ReadAsArray())
+
+    def test_no_files_found(self):
+        """A period without rasters raises NoFilesFound, which is a ValueError."""
+        with self.assertRaises(wapordl_ext.NoFilesFound):
+            self.wapor_map(self.mkdtemp(), ['2020-01-01', '2020-12-31'], incremental=False)
+        self.assertTrue(issubclass(wapordl_ext.NoFilesFound, ValueError))
+
+    def test_existing_dates(self):
+        """Only the files of the same variable, region and settings are found."""
+        folder = self.mkdtemp()
+        fps = self.wapor_map(folder, ['2021-01-01', '2021-01-31'])
+        self.assertEqual(len(fps), 3)
+        region_hash = wapordl_ext.__region_hash__(self.REGION)
+        existing = wapordl_ext.__existing_dates__(folder, 'test', 'L1-AETI-D', region_hash, 'NONE', 'none')
+        self.assertEqual([date.strftime('%Y-%m-%d') for date in sorted(existing)],
+                         ['2021-01-01', '2021-01-11', '2021-01-21'])
+        self.assertEqual(existing[wapordl_ext.pd.Timestamp('2021-01-21')][0], wapordl_ext.pd.Timestamp('2021-01-31'))
+        self.assertEqual(sorted(x[1] for x in existing.values()), fps)
+
+        self.assertEqual(wapordl_ext.__existing_dates__(folder, 'test', 'L1-AETI-D', region_hash, 'NONE', 'day'), {})
+        self.assertEqual(wapordl_ext.__existing_dates__(folder, 'test', 'L1-AETI-D', region_hash, 0, 'none'), {})
+        self.assertEqual(wapordl_ext.__existing_dates__(folder, 'test', 'L1-AETI-D', 'other', 'NONE', 'none'), {})
+        self.assertEqual(wapordl_ext.__existing_dates__(folder, 'other', 'L1-AETI-D', region_hash, 'NONE', 'none'), {})
+        self.assertEqual(wapordl_ext.__existing_dates__(folder + '/missing', 'test', 'L1-AETI-D', region_hash, 'NONE',
+                                                        'none'), {})
+
+    def test_unpadded_dates(self):
+        """Dates are compared once parsed, so unpadded dates in the files or the period still match."""
+        folder = self.mkdtemp()
+        fps = self.wapor_map(folder, ['2021-01-01', '2021-01-31'])
+        ds = gdal.Open(fps[1], gdal.GA_Update)
+        ds.GetRasterBand(1).SetMetadataItem('start_date', '2021-1-11')
+        ds = None
+        existing = wapordl_ext.__existing_dates__(folder, 'test', 'L1-AETI-D', wapordl_ext.__region_hash__(self.REGION),
+                                                  'NONE', 'none')
+        self.assertIn(wapordl_ext.pd.Timestamp('2021-01-11'), existing)
+        with mock.patch.object(wapordl_ext, 'cog_dl') as cog_dl:
+            self.assertEqual(self.wapor_map(folder, ['2021-01-05', '2021-1-31 23:59']), fps)
+        cog_dl.assert_not_called()
+
+    def test_skip_dates(self):
+        """wapor_dl only downloads the rasters whose start date is not skipped, as text or parsed."""
+        folder = self.mkdtemp()
+        with mock.patch.object(wapordl_ext, 'cog_dl', wraps=wapordl_ext.cog_dl) as cog_dl:
+            wapordl_ext.wapor_dl(self.REGION, 'L1-AETI-D', period=['2021-01-01', '2021-01-31'], folder=folder,
+                                 file_name='test', req_stats=None,
+                                 skip_dates={'2021-01-11', wapordl_ext.pd.Timestamp('2021-01-21')})
+        self.assertEqual([md['start_date'] for md, _ in cog_dl.call_args[0][0]], ['2021-01-01'])
+
+        with mock.patch.object(wapordl_ext, 'cog_dl') as cog_dl:
+            self.assertIsNone(wapordl_ext.wapor_dl(self.REGION, 'L1-AETI-D', period=['2021-01-01', '2021-01-31'],
+                                                   folder=folder, file_name='test',
+                                                   skip_dates={'2021-01-01', '2021-1-11', '2021-01-21'}))
+        cog_dl.assert_not_called()
+
+    def test_only_missing_dates(self):
+        """A longer period only downloads the dates that are missing."""
+        folder = self.mkdtemp()
+        first = self.wapor_map(folder, ['2021-01-01', '2021-01-31'])
+        mtimes = {fp: os.path.getmtime(fp) for fp in first}
+        with mock.patch.object(wapordl_ext, 'cog_dl', wraps=wapordl_ext.cog_dl) as cog_dl:
+            fps = self.wapor_map(folder, ['2021-01-01', '2021-02-28'])
+        self.assertEqual(len(cog_dl.call_args[0][0]), 3)
+        self.assertEqual(len(fps), 6)
+        self.assertEqual({fp: os.path.getmtime(fp) for fp in first}, mtimes)
+        ds = gdal.Open(fps[4])
+        self.assertEqual(ds.GetRasterBand(1).GetMetadata()['start_date'], '2021-02-11')
+        np.testing.assert_allclose(ds.ReadAsArray(), 2.2)
+
+        with mock.patch.object(wapordl_ext, 'cog_dl') as cog_dl:
+            self.assertEqual(self.wapor_map(folder, ['2021-01-11', '2021-02-15']), fps[1:5])
+        cog_dl.assert_not_called()
+
+    def test_compact(self):
+        """The compact policy writes the unscaled files as Float32, an unknown policy is refused."""
+        fps = self.wapor_map(self.mkdtemp(), ['2021-01-01', '2021-01-10'], incremental=False,
+                             dtype_policy='compact')
+        ds = gdal.Open(fps[0])
+        self.assertEqual(ds.GetRasterBand(1).DataType, gdal.GDT_Float32)
+        with self.assertRaises(ValueError):
+            self.wapor_map(self.mkdtemp(), ['2021-01-01', '2021-01-10'], dtype_policy='small')
+
+    def test_profile(self):
+        """The unscaled files are written with the profile, an unknown profile is refused."""
+        fps = self.wapor_map(self.mkdtemp(), ['2021-01-01', '2021-01-10'], incremental=False, profile='cog')
+        ds = gdal.Open(fps[0])
+        self.assertEqual(ds.GetMetadata('IMAGE_STRUCTURE').get('LAYOUT'), 'COG')
+        with self.assertRaises(ValueError):
+            self.wapor_map(self.mkdtemp(), ['2021-01-01', '2021-01-10'], profile='jpeg')
+
+    def test_time_cube(self):
+        """The bands are written to a single NetCDF time cube without stitching them first."""
+        folder = self.mkdtemp()
+        nc_fn = self.wapor_map(folder, ['2021-01-01', '2021-02-28'], extension='.nc', time_cube=True)
+        self.assertEqual(os.listdir(folder), [os.path.basename(nc_fn)])
+        series = wapordl_ext.cube_series(nc_fn, 30.1, 9.9)
+        self.assertEqual(list(series.index.strftime('%Y-%m-%d')),
+                         ['2021-01-01', '2021-01-11', '2021-01-21', '2021-02-01', '2021-02-11', '2021-02-21'])
+
+
+    def test_not_incremental(self):
+        """Without incremental all the dates are downloaded again."""
+        folder = self.mkdtemp()
+        self.wapor_map(folder, ['2021-01-01', '2021-01-31'])
+        with mock.patch.object(wapordl_ext, 'cog_dl', wraps=wapordl_ext.cog_dl) as cog_dl:
+            fps = self.wapor_map(folder, ['2021-01-01', '2021-02-28'], incremental=False)
+        self.assertEqual(len(cog_dl.call_args[0][0]), 6)
+        self.assertEqual(len(fps), 6)
+
+    def test_geometry_region(self):
+        """A geometry gives the same files as the GeoJSON file of the same region."""
+        polygon = shapely.Polygon([[30.052, 9.81], [30.29, 9.83], [30.2, 9.948], [30.1, 9.9], [30.052, 9.81]])
+        folder = self.mkdtemp()
+        geojson = os.path.join(folder, 'region.geojson')
+        with open(geojson, 'w', encoding='utf-8') as f:
+            f.write(shapely.to_geojson(polygon))
+        expected = self.wapor_map(self.mkdtemp(), ['2021-01-01', '2021-01-10'], geojson, incremental=False)
+        for region in [polygon, shapely.to_wkb(polygon)]:
+            fps = self.wapor_map(self.mkdtemp(), ['2021-01-01', '2021-01-10'], region, incremental=False)
+            np.testing.assert_array_equal(gdal.Open(fps[0]).ReadAsArray(), gdal.Open(expected[0]).ReadAsArray())
+        cutline = wapordl_ext.__geometry_cutline__(polygon)[1]
+        self.assertEqual(wapordl_ext.__cutline_files__[cutline], 0)
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class WaporMapMultiTest(unittest.TestCase):
+    """Test the shared pixel grid of wapor_map_multi."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.calls = []
+        self.failing = set()
+        self.lock = threading.Lock()
+        self.info = {'geoTransform': [-30.0, 0.0025, 0.0, 40.0, 0.0, -0.0025], 'size': [24000, 24000],
+                     'coordinateSystem': {'wkt': gdal.osr.SRS_WKT_WGS84_LAT_LONG}}
+        patches = [mock.patch.object(wapordl_ext, 'generate_urls_v3', lambda *args, **kwargs: ('grid.tif',)),
+                   mock.patch.object(wapordl_ext, '__raster_info__', lambda url: self.info),
+                   mock.patch.object(wapordl_ext, 'wapor_map', self.wapor_map)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def wapor_map(self, region, variable, period, folder, **kwargs):
+        with self.lock:
+            self.calls.append((variable, kwargs))
+        if variable in self.failing:
+            raise RuntimeError('Download of {} failed'.format(variable))
+        if len(self.failing) > 0:
+            kwargs['progress'].token._event.wait(5)
+            kwargs['progress'].check()
+        return ['{}.tif'.format(variable)]
+
+    def test_grid(self):
+        """All the variables are warped onto the snapped grid of the grid variable."""
+        results = wapordl_ext.wapor_map_multi([30.001, 9.8017, 30.2993, 9.95], ['L2-AETI-D', 'L2-T-D'],
+                                              ['2021-01-01', '2021-01-31'], '/tmp', band_workers=8)
+        self.assertEqual(results, {'L2-AETI-D': ['L2-AETI-D.tif'], 'L2-T-D': ['L2-T-D.tif']})
+        grids = [kwargs['grid'] for _, kwargs in self.calls]
+        self.assertEqual(grids[0], grids[1])
+        self.assertEqual((grids[0]['xRes'], grids[0]['yRes']), (0.0025, 0.0025))
+        np.testing.assert_allclose(grids[0]['outputBounds'], [30.0, 9.8, 30.3, 9.95])
+        self.assertEqual([kwargs['band_workers'] for _, kwargs in self.calls], [4, 4])
+
+    def test_overview_grid(self):
+        """The pixels of an overview are a multiple of the native ones."""
+        wapordl_ext.wapor_map_multi([30.0, 9.8, 30.3, 9.95], ['L2-AETI-D', 'L2-RET-D'],
+                                    ['2021-01-01', '2021-01-31'], '/tmp', overview=1, grid_variable='L2-RET-D')
+        grid = self.calls[0][1]['grid']
+        self.assertEqual((grid['xRes'], grid['yRes']), (0.01, 0.01))
+
+    def test_l3_grid(self):
+        """L3 variables share a grid in the UTM metres of the grid variable."""
+        srs = gdal.osr.SpatialReference()
+        srs.ImportFromEPSG(32636)
+        self.info = {'geoTransform': [700000.0, 20.0, 0.0, 3770000.0, 0.0, -20.0], 'size': [2000, 3000],
+                     'coordinateSystem': {'wkt': srs.ExportToWkt()}}
+        wapordl_ext.wapor_map_multi([35.85, 33.70, 35.95, 33.80], ['L3-AETI-D', 'L3-T-D'],
+                                    ['2021-01-01', '2021-01-31'], '/tmp')
+        grid = self.calls[0][1]['grid']
+        self.assertEqual((grid['xRes'], grid['yRes']), (20.0, 20.0))
+        self.assertEqual(grid['dstSRS'], self.info['coordinateSystem']['wkt'])
+        self.assertEqual(grid['outputBoundsSRS'], grid['dstSRS'])
+        xmin, ymin, xmax, ymax = grid['outputBounds']
+        self.assertTrue(700000 < xmin < xmax < 800000 and 3700000 < ymin < ymax < 3800000)
+        self.assertTrue(all(bound % 20 == 0 for bound in grid['outputBounds']))
+
+        self.calls = []
+        wapordl_ext.wapor_map_multi('BKA', ['L3-AETI-D', 'L3-T-D'], ['2021-01-01', '2021-01-31'], '/tmp')
+        np.testing.assert_allclose(self.calls[0][1]['grid']['outputBounds'], [700000, 3710000, 740000, 3770000])
+
+    def test_mixed_levels(self):
+        """L3 variables can not share a grid with the other levels."""
+        with self.assertRaises(ValueError):
+            wapordl_ext.wapor_map_multi('BKA', ['L3-AETI-D', 'L2-RET-D'], ['2021-01-01', '2021-01-31'], '/tmp')
+        self.assertEqual(self.calls, [])
+
+    def test_invalid_variables(self):
+        """The variables must be distinct and include the grid variable."""
+        for variables, grid_variable in [([], None), (['L2-T-D', 'L2-T-D'], None), (['L2-T-D'], 'L2-AETI-D')]:
+            with self.assertRaises(ValueError):
+                wapordl_ext.wapor_map_multi([30.0, 9.8, 30.3, 9.95], variables, ['2021-01-01', '2021-01-31'],
+                                            '/tmp', grid_variable=grid_variable)
+        self.assertEqual(self.calls, [])
+
+    def test_failure_cancels_the_others(self):
+        """A failed variable stops the downloads of the others."""
+        self.failing = {'L2-T-D'}
+        progress = Progress()
+        with self.assertRaises(RuntimeError):
+            wapordl_ext.wapor_map_multi([30.0, 9.8, 30.3, 9.95], ['L2-T-D', 'L2-AETI-D'],
+                                        ['2021-01-01', '2021-01-31'], '/tmp', progress=progress)
+        self.assertTrue(all(kwargs['progress'].token.cancelled for _, kwargs in self.calls))
+        self.assertFalse(progress.token.cancelled)
+
+    def test_later_failure_cancels_the_earlier(self):
+        """A failed variable stops the variables listed before it without waiting for them."""
+        self.failing = {'L2-AETI-D'}
+        start = time.time()
+        with self.assertRaises(RuntimeError):
+            wapordl_ext.wapor_map_multi([30.0, 9.8, 30.3, 9.95], ['L2-T-D', 'L2-AETI-D'],
+                                        ['2021-01-01', '2021-01-31'], '/tmp')
+        self.assertLess(time.time() - start, 4)
+        self.assertTrue(all(kwargs['progress'].token.cancelled for _, kwargs in self.calls))
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class GeometryCutlineTest(unittest.TestCase):
+    """Test the geometries given as region are written once as cutline."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.ring = [[30.0, 29.0], [31.0, 29.0], [31.0, 30.0], [30.0, 30.0], [30.0, 29.0]]
+        self.polygon = shapely.Polygon(self.ring)
+
+    def read(self, cutline):
+        f = gdal.VSIFOpenL(cutline, 'rb')
+        content = gdal.VSIFReadL(1, gdal.VSIStatL(cutline).size, f)
+        gdal.VSIFCloseL(f)
+        return shapely.from_geojson(content.decode())
+
+    def test_same_geometry_same_cutline(self):
+        """Equal geometries, as shapely or WKB, share one bounded /vsimem/ cutline."""
+        geometry, cutline = wapordl_ext.__geometry_cutline__(self.polygon)
+        self.assertTrue(cutline.startswith('/vsimem/'))
+        self.assertTrue(self.read(cutline).equals(self.polygon))
+        reordered = shapely.Polygon(self.ring[2:-1] + self.ring[:3])
+        with_z = shapely.Polygon([coordinate + [100.0] for coordinate in self.ring])
+        for region in [reordered, with_z, shapely.to_wkb(self.polygon)]:
+            self.assertEqual(wapordl_ext.__geometry_cutline__(region)[1], cutline)
+        self.assertIn(cutline, wapordl_ext.__cutline_files__)
+
+    def test_collections(self):
+        """The polygons of a collection are merged, other geometries are dropped."""
+        other = shapely.box(32.0, 29.0, 33.0, 30.0)
+        collection = shapely.GeometryCollection([self.polygon, shapely.LineString([[0, 0], [1, 1]]),
+                                                 shapely.MultiPolygon([other])])
+        geometry, cutline = wapordl_ext.__geometry_cutline__(collection)
+        self.assertEqual(geometry.geom_type, 'MultiPolygon')
+        self.assertAlmostEqual(self.read(cutline).area, 2.0)
+        with self.assertRaises(ValueError):
+            wapordl_ext.__geometry_cutline__(shapely.MultiPoint([[0, 0], [1, 1]]))
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class WriteCutlineTest(unittest.TestCase):
+    """Test the /vsimem/ cutlines are bounded and the pinned ones are kept."""
+
+    def setUp(self):
+        """Runs before each test."""
+        files = collections.OrderedDict()
+        for patch in [mock.patch.object(wapordl_ext, 'VSIMEM_CUTLINES', 3),
+                      mock.patch.object(wapordl_ext, '__cutline_files__', files)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(lambda: [gdal.Unlink(cutline) for cutline in list(files)])
+        self.serial = next(SERIAL)
+
+    def write(self, i):
+        cutline = '/vsimem/test_cutline_{}_{}.geojson'.format(self.serial, i)
+        return wapordl_ext.__write_cutline__(cutline, shapely.box(30.0, 9.0, 30.0 + i + 1, 10.0))
+
+    def exist(self, cutlines):
+        return [gdal.VSIStatL(cutline) is not None for cutline in cutlines]
+
+    def test_least_recently_used(self):
+        """Past VSIMEM_CUTLINES the least recently used cutline is unlinked."""
+        cutlines = [self.write(i) for i in range(3)]
+        self.write(0)
+        cutlines.append(self.write(3))
+        self.assertEqual(self.exist(cutlines), [True, False, True, True])
+        f = gdal.VSIFOpenL(cutlines[0], 'rb')
+        content = gdal.VSIFReadL(1, gdal.VSIStatL(cutlines[0]).size, f)
+        gdal.VSIFCloseL(f)
+        self.assertTrue(shapely.from_geojson(content.decode()).equals(shapely.box(30.0, 9.0, 31.0, 10.0)))
+
+    def test_pinned(self):
+        """Pinned cutlines are kept until they are unpinned."""
+        cutlines = [self.write(i) for i in range(3)]
+        wapordl_ext.__pin_cutlines__(cutlines[:1])
+        wapordl_ext.__pin_cutlines__(cutlines[:1])
+        cutlines += [self.write(i) for i in range(3, 6)]
+        self.assertEqual(self.exist(cutlines), [True, False, False, False, True, True])
+        wapordl_ext.__pin_cutlines__(cutlines[:1], -1)
+        self.write(6)
+        self.assertTrue(self.exist(cutlines[:1])[0])
+        wapordl_ext.__pin_cutlines__(cutlines[:1] + ['/vsimem/unknown.geojson'], -1)
+        for i in range(7, 10):
+            self.write(i)
+        self.assertEqual(self.exist(cutlines[:1]), [False])
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class SimplifiedCutlineTest(unittest.TestCase):
+    """Test the region is simplified to the pixel size before it is used as cutline."""
+
+    GEOTRANSFORM = (30.05, 0.01, 0.0, 10.0, 0.0, -0.01)
+
+    def setUp(self):
+        """Runs before each test."""
+        self.circle = shapely.Point(30.175, 9.875).buffer(0.1, quad_segs=1000)
+        self.region = 'region_{}.geojson'.format(next(SERIAL))
+
+    def mask(self, cutline):
+        return wapordl_ext.__cutline_mask__(cutline, cutline, 25, 25, self.GEOTRANSFORM,
+                                            gdal.osr.SRS_WKT_WGS84_LAT_LONG)
+
+    def test_simplified(self):
+        """The vertices the pixels can not resolve are dropped."""
+        cutline = wapordl_ext.__simplified_cutline__(self.region, self.circle, 'circle', 0.0025)
+        self.assertTrue(cutline.startswith('/vsimem/'))
+        f = gdal.VSIFOpenL(cutline, 'rb')
+        simplified = shapely.from_geojson(gdal.VSIFReadL(1, gdal.VSIStatL(cutline).size, f).decode())
+        gdal.VSIFCloseL(f)
+        self.assertLess(shapely.get_num_coordinates(simplified), 100)
+        self.assertLess(self.circle.symmetric_difference(simplified).area, 0.0025 * self.circle.length)
+
+        original = '/vsimem/{}'.format(self.region)
+        gdal.FileFromMemBuffer(original, shapely.to_geojson(self.circle))
+        self.addCleanup(gdal.Unlink, original)
+        self.assertLessEqual(np.sum(self.mask(cutline) != self.mask(original)), 4)
+
+    def test_nothing_to_simplify(self):
+        """A region without vertices to drop is used as is."""
+        square = shapely.box(30.1, 9.8, 30.2, 9.9)
+        self.assertEqual(wapordl_ext.__simplified_cutline__(self.region, square, 'square', 0.0025), self.region)
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class SplitUnscaleTest(unittest.TestCase):
+    """Test the bands of a download are unscaled to one file per date in a single pass."""
+
+    DATES = ['2021-01-01', '2021-01-11', '2021-01-21']
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+        self.fn = '/vsimem/split_{}.tif'.format(next(SERIAL))
+        self.addCleanup(gdal.Unlink, self.fn)
+        rng = np.random.default_rng(0)
+        self.arrays = [rng.integers(0, 1000, (40, 24)).astype('int16') for _ in self.DATES]
+        for array in self.arrays:
+            array[3:5, 7:9] = -9999
+        ds = gdal.GetDriverByName('GTiff').Create(self.fn, 24, 40, len(self.DATES), gdal.GDT_Int16,
+                                                  ['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+        ds.SetGeoTransform((30.0, 0.01, 0.0, 10.0, 0.0, -0.01))
+        ds.SetProjection('EPSG:4326')
+        ds.SetMetadata({'long_name': 'Actual EvapoTranspiration and Interception'})
+        for band_number, (date, array) in enumerate(zip(self.DATES, self.arrays), 1):
+            band = ds.GetRasterBand(band_number)
+            band.SetNoDataValue(-9999)
+            band.SetScale(0.1 * band_number)
+            band.SetOffset(band_number)
+            band.SetMetadata({'start_date': date})
+            band.WriteArray(array)
+        ds = None
+
+    def test_split_unscale(self):
+        """Every band is written unscaled, keeping its nodata, in strips aligned to the blocks."""
+        with mock.patch.object(wapordl_ext, 'SPLIT_CHUNK_BYTES', 3 * 24 * 8 * 20):
+            fps = wapordl_ext.__split_unscale__(gdal.Open(self.fn), os.path.join(self.folder, 'aeti.tif'),
+                                                Progress())
+        self.assertEqual([os.path.basename(fp) for fp in fps],
+                         ['aeti_{}.tif'.format(date) for date in self.DATES])
+        for band_number, (fp, array) in enumerate(zip(fps, self.arrays), 1):
+            ds = gdal.Open(fp)
+            band = ds.GetRasterBand(1)
+            self.assertEqual(band.DataType, gdal.GDT_Float64)
+            self.assertEqual(band.GetNoDataValue(), -9999)
+            self.assertEqual(band.GetMetadata()['start_date'], self.DATES[band_number - 1])
+            expected = np.where(array == -9999, -9999, array * 0.1 * band_number + band_number)
+            np.testing.assert_allclose(band.ReadAsArray(), expected)
+
+    def test_compact(self):
+        """With the compact policy scaled bands are Float32 and bands without scale keep their type."""
+        ds = gdal.Open(self.fn, gdal.GA_Update)
+        ds.GetRasterBand(3).SetScale(1)
+        ds.GetRasterBand(3).SetOffset(0)
+        ds = None
+        fps = wapordl_ext.__split_unscale__(gdal.Open(self.fn), os.path.join(self.folder, 'aeti.tif'),
+                                            Progress(), dtype_policy='compact')
+        data_types = [gdal.Open(fp).ReadAsArray().dtype for fp in fps]
+        self.assertEqual(data_types, [np.float32, np.float32, np.int16])
+        ds = gdal.Open(fps[1])
+        expected = np.where(self.arrays[1] == -9999, -9999, self.arrays[1] * 0.2 + 2)
+        np.testing.assert_allclose(ds.GetRasterBand(1).ReadAsArray(), expected, rtol=1e-6)
+        ds = gdal.Open(fps[2])
+        np.testing.assert_array_equal(ds.GetRasterBand(1).ReadAsArray(), self.arrays[2])
+
+    def test_cancel(self):
+        """A cancelled split removes its partial outputs."""
+        progress = Progress()
+        progress.token.cancel()
+        with self.assertRaises(DownloadCancelled):
+            wapordl_ext.__split_unscale__(gdal.Open(self.fn), os.path.join(self.folder, 'aeti.tif'), progress)
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class ConvertBlocksTest(unittest.TestCase):
+    """Test the block-wise unit conversion."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.in_fn = '/vsimem/convert_{}.tif'.format(next(SERIAL))
+        self.out_fn = '/vsimem/converted_{}.tif'.format(next(SERIAL))
+        self.addCleanup(gdal.Unlink, self.in_fn)
+        self.addCleanup(lambda: gdal.VSIStatL(self.out_fn) is None or gdal.Unlink(self.out_fn))
+        rng = np.random.default_rng(0)
+        self.arrays = [rng.integers(0, 1000, (50, 40)).astype('int16') for _ in range(3)]
+        for array in self.arrays:
+            array[10:12, 30:33] = -9999
+        ds = gdal.GetDriverByName('GTiff').Create(self.in_fn, 40, 50, 3, gdal.GDT_Int16,
+                                                  ['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+        ds.SetGeoTransform((30.0, 0.01, 0.0, 10.0, 0.0, -0.01))
+        ds.SetProjection('EPSG:4326')
+        for band_number, array in enumerate(self.arrays, 1):
+            band = ds.GetRasterBand(band_number)
+            band.SetNoDataValue(-9999)
+            band.SetScale(0.1)
+            band.WriteArray(array)
+        ds = None
+
+    def test_convert_blocks(self):
+        """Every window is multiplied by the factor of its band, rounded for integer outputs."""
+        factors = [10, 1 / 3, 31]
+        with mock.patch.object(wapordl_ext, 'CONVERT_CHUNK_BYTES', 3 * 16 * 16 * 8):
+            out = wapordl_ext.__convert_blocks__(self.in_fn, self.out_fn, factors, gdal.GDT_Int32, workers=4)
+        out.FlushCache()
+        for band_number, (array, factor) in enumerate(zip(self.arrays, factors), 1):
+            band = out.GetRasterBand(band_number)
+            self.assertEqual(band.DataType, gdal.GDT_Int32)
+            self.assertEqual((band.GetNoDataValue(), band.GetScale()), (-9999, 0.1))
+            expected = np.where(array == -9999, -9999, np.rint(array * factor))
+            np.testing.assert_array_equal(band.ReadAsArray(), expected)
+
+    def test_cancel(self):
+        """A conversion cancelled by its callback removes the partial output."""
+        with mock.patch.object(wapordl_ext, 'CONVERT_CHUNK_BYTES', 3 * 16 * 16 * 8):
+            with self.assertRaises(RuntimeError):
+                wapordl_ext.__convert_blocks__(self.in_fn, self.out_fn, [1, 2, 3], gdal.GDT_Float64,
+                                               workers=2, progress_callback=lambda fraction: 0)
+        self.assertIsNone(gdal.VSIStatL(self.out_fn))
+
+    def test_unit_convertor(self):
+        """The factors follow the units of every band and are recorded in its metadata."""
+        urls = [({'units': 'mm/day', 'temporal_resolution': 'Dekad', 'number_of_days': days,
+                  'start_date': date}, 'L1-AETI-D')
+                for days, date in [(10, '2021-01-01'), (10, '2021-01-11'), (11, '2021-01-21')]]
+        warp = gdal.Open(self.in_fn)
+        warp, filen = wapordl_ext.unit_convertor(urls, self.in_fn, self.out_fn, 'dekad', warp,
+                                                 dtype=gdal.GDT_Float32)
+        self.assertEqual(filen, self.out_fn)
+        self.assertEqual([md['units_conversion_factor'] for md, _ in urls], [10, 10, 11])
+        self.assertEqual(urls[2][0]['units'], 'mm/dekad')
+        self.assertEqual(warp.GetRasterBand(1).DataType, gdal.GDT_Float32)
+        np.testing.assert_array_equal(warp.GetRasterBand(3).ReadAsArray(),
+                                      np.where(self.arrays[2] == -9999, -9999, self.arrays[2] * 11))
+
+    def urls(self):
+        return [({'units': 'mm/day', 'temporal_resolution': 'Dekad', 'number_of_days': 10,
+                  'start_date': date}, 'L1-AETI-D') for date in ['2021-01-01', '2021-01-11', '2021-01-21']]
+
+    def test_compact_integer(self):
+        """With the compact policy integer data keeps its pixels, the factor goes into the scale."""
+        warp = gdal.Open(self.in_fn, gdal.GA_Update)
+        warp, filen = wapordl_ext.unit_convertor(self.urls(), self.in_fn, self.out_fn, 'month', warp,
+                                                 dtype_policy='compact')
+        warp = None
+        self.assertEqual(filen, self.in_fn)
+        self.assertIsNone(gdal.VSIStatL(self.out_fn))
+        ds = gdal.Open(filen)
+        band = ds.GetRasterBand(2)
+        self.assertEqual(band.DataType, gdal.GDT_Int16)
+        self.assertAlmostEqual(band.GetScale(), 3.1)
+        np.testing.assert_array_equal(band.ReadAsArray(), self.arrays[1])
+
+    def test_compact_float(self):
+        """With the compact policy float data is converted to Float32."""
+        float_fn = '/vsimem/float_{}.tif'.format(next(SERIAL))
+        self.addCleanup(gdal.Unlink, float_fn)
+        gdal.Translate(float_fn, self.in_fn, outputType=gdal.GDT_Float64, unscale=True)
+        warp = gdal.Open(float_fn, gdal.GA_Update)
+        warp, filen = wapordl_ext.unit_convertor(self.urls(), float_fn, self.out_fn, 'dekad', warp,
+                                                 dtype_policy='compact')
+        self.assertEqual(filen, self.out_fn)
+        self.assertEqual(warp.GetRasterBand(1).DataType, gdal.GDT_Float32)
+        expected = np.where(self.arrays[0] == -9999, -9999, self.arrays[0] * 0.1 * 10)
+        np.testing.assert_allclose(warp.GetRasterBand(1).ReadAsArray(), expected, rtol=1e-6)
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class OutputProfileTest(unittest.TestCase):
+    """Test the layout of the files written with the output profiles."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+
+    def write(self, profile, data_type=gdal.GDT_Int16 if gdal else None, size=1100):
+        fn = os.path.join(self.folder, '{}.tif'.format(profile))
+        ds = gdal.GetDriverByName('GTiff').Create(fn, size, size, 1, data_type,
+                                                  wapordl_ext.__profile_options__(profile, data_type))
+        ds.SetGeoTransform((30.0, 0.001, 0.0, 10.0, 0.0, -0.001))
+        ds.SetProjection('EPSG:4326')
+        ds.GetRasterBand(1).WriteArray(np.arange(size * size).reshape(size, size) % 1000)
+        ds = None
+        wapordl_ext.__apply_profile__(fn, profile)
+        return fn
+
+    def test_options(self):
+        """The predictor follows the data type and the COG profile is first written as a tiled GeoTIFF."""
+        self.assertEqual(wapordl_ext.DEFAULT_PROFILE, 'tiled')
+        self.assertEqual(wapordl_ext.__profile_options__('lzw', gdal.GDT_Int16), ['COMPRESS=LZW'])
+        self.assertIn('BIGTIFF=IF_SAFER', wapordl_ext.__profile_options__('tiled', gdal.GDT_Int16))
+        self.assertIn('PREDICTOR=2', wapordl_ext.__profile_options__('tiled', gdal.GDT_Int16))
+        self.assertIn('PREDICTOR=3', wapordl_ext.__profile_options__('tiled', gdal.GDT_Float32))
+        self.assertIn('TILED=YES', wapordl_ext.__profile_options__('cog', gdal.GDT_Int16))
+        self.assertEqual(wapordl_ext.__overview_resampling__('L2-LCC-A'), 'NEAREST')
+        self.assertEqual(wapordl_ext.__overview_resampling__('L2-AETI-D'), 'AVERAGE')
+
+    def test_zstd_fallback(self):
+        """Without ZSTD in GDAL the zstd profile uses DEFLATE."""
+        driver = mock.Mock()
+        driver.GetMetadataItem.return_value = '<CreationOptionList>DEFLATE LZW</CreationOptionList>'
+        with mock.patch.object(wapordl_ext.gdal, 'GetDriverByName', return_value=driver):
+            options = wapordl_ext.__profile_options__('zstd', gdal.GDT_Int16)
+        self.assertIn('COMPRESS=DEFLATE', options)
+        self.assertNotIn('COMPRESS=ZSTD', options)
+
+    def test_layouts(self):
+        """The tiled profile has internal overviews down to a tile, lzw stays untiled, cog is a COG."""
+        ds = gdal.Open(self.write('tiled'))
+        band = ds.GetRasterBand(1)
+        self.assertEqual(band.GetBlockSize(), [256, 256])
+        self.assertEqual([band.GetOverview(i).XSize for i in range(band.GetOverviewCount())], [550, 275])
+        self.assertEqual(ds.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'], 'DEFLATE')
+
+        ds = gdal.Open(self.write('lzw'))
+        self.assertEqual(ds.GetRasterBand(1).GetOverviewCount(), 0)
+        self.assertEqual(ds.GetRasterBand(1).GetBlockSize()[0], 1100)
+
+        fn = self.write('cog')
+        ds = gdal.Open(fn)
+        self.assertEqual(ds.GetMetadata('IMAGE_STRUCTURE').get('LAYOUT'), 'COG')
+        self.assertEqual(ds.GetRasterBand(1).GetBlockSize(), [512, 512])
+        self.assertGreater(ds.GetRasterBand(1).GetOverviewCount(), 0)
+        self.assertFalse(os.path.exists(fn.replace('.tif', '_cog.tif')))
+        np.testing.assert_array_equal(ds.ReadAsArray(), np.arange(1100 * 1100).reshape(1100, 1100) % 1000)
+
+    def test_cog_in_tif_folder(self):
+        """Only the extension of the file is replaced when naming the temporary COG."""
+        self.folder = os.path.join(self.folder, 'maps.tif')
+        os.makedirs(self.folder)
+        fn = self.write('cog', size=300)
+        self.assertEqual(gdal.Open(fn).GetMetadata('IMAGE_STRUCTURE').get('LAYOUT'), 'COG')
+        self.assertEqual(os.listdir(self.folder), ['cog.tif'])
+
+
+@unittest.skipIf(gdal is None or gdal.GetDriverByName('netCDF') is None, 'GDAL netCDF is not available')
+class TimeCubeTest(unittest.TestCase):
+    """Test the NetCDF time cubes written with the multidimensional API."""
+
+    DATES = [('2021-01-01', '2021-01-10'), ('2021-01-11', '2021-01-20'), ('2021-01-21', '2021-01-31')]
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+        self.fn = '/vsimem/cube_{}.tif'.format(next(SERIAL))
+        self.addCleanup(gdal.Unlink, self.fn)
+        rng = np.random.default_rng(0)
+        self.arrays = [rng.integers(0, 1000, (40, 24)).astype('int16') for _ in self.DATES]
+        for array in self.arrays:
+            array[3, 7] = -9999
+        ds = gdal.GetDriverByName('GTiff').Create(self.fn, 24, 40, len(self.DATES), gdal.GDT_Int16)
+        ds.SetGeoTransform((30.0, 0.01, 0.0, 10.0, 0.0, -0.01))
+        ds.SetProjection('EPSG:4326')
+        for band_number, ((start, end), array) in enumerate(zip(self.DATES, self.arrays), 1):
+            band = ds.GetRasterBand(band_number)
+            band.SetNoDataValue(-9999)
+            band.SetScale(0.1)
+            band.SetMetadata({'start_date': start, 'end_date': end, 'units': 'mm/day'})
+            band.WriteArray(array)
+        ds = None
+
+    def write(self, **kwargs):
+        nc_fn = os.path.join(self.folder, 'cube.nc')
+        return wapordl_ext.__write_time_cube__(gdal.Open(self.fn), nc_fn, 'L1-AETI-D', Progress(),
+                                               chunks=(2, 16, 16), **kwargs)
+
+    def test_packed(self):
+        """Integer bands sharing their scale keep their type with the scale on the cube."""
+        ds = gdal.OpenEx(self.write(), gdal.OF_MULTIDIM_RASTER)
+        group = ds.GetRootGroup()
+        data = group.OpenMDArray('L1_AETI_D')
+        self.assertEqual(data.GetDataType().GetNumericDataType(), gdal.GDT_Int16)
+        self.assertAlmostEqual(data.GetScale(), 0.1)
+        self.assertEqual(data.GetBlockSize(), [2, 16, 16])
+        self.assertEqual([dim.GetIndexingVariable().GetName() for dim in data.GetDimensions()], ['time', 'y', 'x'])
+        np.testing.assert_array_equal(data.ReadAsArray(), np.stack(self.arrays))
+        np.testing.assert_array_equal(group.OpenMDArray('time').ReadAsArray(), [18628, 18638, 18648])
+        np.testing.assert_array_equal(group.OpenMDArray('time_bnds').ReadAsArray()[:, 1], [18637, 18647, 18658])
+        np.testing.assert_allclose(group.OpenMDArray('x').ReadAsArray()[:2], [30.005, 30.015])
+        np.testing.assert_allclose(group.OpenMDArray('y').ReadAsArray()[:2], [9.995, 9.985])
+
+        series = wapordl_ext.cube_series(os.path.join(self.folder, 'cube.nc'), 30.075, 9.965)
+        self.assertEqual(list(series.index.strftime('%Y-%m-%d')), [start for start, _ in self.DATES])
+        np.testing.assert_array_equal(series.values, [np.nan] * 3)
+        series = wapordl_ext.cube_series(os.path.join(self.folder, 'cube.nc'), 30.005, 9.995, 'L1-AETI-D')
+        np.testing.assert_allclose(series.values, [array[0, 0] * 0.1 for array in self.arrays], rtol=1e-6)
+
+    def test_unscaled(self):
+        """Bands with different scales are unscaled, to Float32 with the compact policy."""
+        ds = gdal.Open(self.fn, gdal.GA_Update)
+        ds.GetRasterBand(2).SetScale(0.01)
+        ds = None
+        ds = gdal.OpenEx(self.write(dtype_policy='compact'), gdal.OF_MULTIDIM_RASTER)
+        data = ds.GetRootGroup().OpenMDArray('L1_AETI_D')
+        self.assertEqual(data.GetDataType().GetNumericDataType(), gdal.GDT_Float32)
+        expected = np.where(self.arrays[1] == -9999, -9999, self.arrays[1] * 0.01)
+        np.testing.assert_allclose(data.ReadAsArray()[1], expected, rtol=1e-6)
+
+    def test_cancel(self):
+        """A cancelled cube is removed."""
+        progress = Progress()
+        progress.token.cancel()
+        with self.assertRaises(DownloadCancelled):
+            wapordl_ext.__write_time_cube__(gdal.Open(self.fn), os.path.join(self.folder, 'cube.nc'),
+                                            'L1-AETI-D', progress)
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class SparseVrtTest(unittest.TestCase):
+    """Test the VRTs merging the files downloaded per feature."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, fn, value, x0):
+        with open(os.path.join(self.folder, fn), 'wb') as f:
+            f.write(raster_bytes(np.full((10, 10), value, dtype='int16'), nodata=-9999,
+                                 geotransform=(x0, 0.01, 0.0, 10.0, 0.0, -0.01)))
+
+    def test_merge_by_date(self):
+        """One VRT per date references the files of every feature."""
+        for date, offset in [('2021-01-01', 0), ('2021-01-11', 10)]:
+            self.write('field_1_L2-AETI-D_{}.tif'.format(date), 1 + offset, 30.0)
+            self.write('field_2_L2-AETI-D_{}.tif'.format(date), 2 + offset, 30.5)
+        self.write('field_1_L2-T-D_2021-01-01.tif', 5, 30.0)
+        self.write('field_3_L2-AETI-D_2021-01-01.tif', 7, 31.0)
+
+        vrt_fns = wapordl_ext.sparse_vrt(self.folder, ['field_1', 'field_2'], 'L2-AETI-D', 'fields')
+        self.assertEqual([os.path.basename(fn) for fn in vrt_fns],
+                         ['fields_L2-AETI-D_2021-01-01.vrt', 'fields_L2-AETI-D_2021-01-11.vrt'])
+        ds = gdal.Open(vrt_fns[1])
+        self.assertEqual(len(ds.GetFileList()), 3)
+        self.assertEqual((ds.RasterXSize, ds.RasterYSize), (60, 10))
+        array = ds.ReadAsArray()
+        self.assertTrue((array[:, :10] == 11).all())
+        self.assertTrue((array[:, 10:50] == -9999).all())
+        self.assertTrue((array[:, 50:] == 12).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+# coding=utf-8
+"""Tests of the streaming zonal statistics.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import unittest
+
+import numpy as np
+
+from utils.zonalstats import RunningStats, valid_statistic, needs_histogram, HISTOGRAM_BINS
+
+
+class RunningStatsTest(unittest.TestCase):
+    """Test the streaming statistics against NumPy."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.rng = np.random.default_rng(42)
+        self.percentiles = [0, 1, 10, 25, 50, 75, 90, 97.5, 100]
+
+    def accumulate(self, values, blocks=7, **kwargs):
+        stats = RunningStats(**kwargs)
+        for block in np.array_split(values, blocks):
+            stats.update(block)
+        return stats
+
+    def test_moments(self):
+        """Count, sum, minimum, maximum, mean and std match NumPy over blocks."""
+        values = self.rng.normal(1e4, 3.0, 100000)
+        stats = self.accumulate(values)
+        self.assertEqual(stats.count, values.size)
+        self.assertAlmostEqual(stats.sum, values.sum(), delta=1e-6 * abs(values.sum()))
+        self.assertEqual(stats.minimum, values.min())
+        self.assertEqual(stats.maximum, values.max())
+        self.assertAlmostEqual(stats.mean, values.mean(), places=8)
+        self.assertAlmostEqual(stats.std, values.std(), places=8)
+
+    def test_exact_percentiles(self):
+        """Percentiles of discrete data are exactly those of np.percentile."""
+        values = self.rng.integers(0, 3000, 100000) * 0.1
+        stats = self.accumulate(values, bins=HISTOGRAM_BINS)
+        for q in self.percentiles:
+            self.assertEqual(stats.percentile(q), np.percentile(values, q))
+        self.assertEqual(stats.result(['median'])['median'], np.median(values))
+
+    def test_outlier(self):
+        """A far outlier does not move the median of discrete data."""
+        stats = RunningStats(bins=HISTOGRAM_BINS)
+        stats.update(np.full(10, 5.0))
+        stats.update(np.array([1e6]))
+        self.assertEqual(stats.percentile(50), 5.0)
+        self.assertEqual(stats.percentile(100), 1e6)
+
+    def test_histogram_percentiles(self):
+        """Past max_distinct values the percentiles are within a bin of NumPy."""
+        values = self.rng.uniform(-50, 250, 100000)
+        stats = self.accumulate(values, bins=HISTOGRAM_BINS, max_distinct=1000)
+        width = (values.max() - values.min()) / HISTOGRAM_BINS
+        for q in self.percentiles:
+            self.assertAlmostEqual(stats.percentile(q), np.percentile(values, q), delta=2 * width)
+        self.assertEqual(stats.result(['median'])['median'], stats.percentile(50))
+
+    def test_growing_range(self):
+        """Blocks outside the range of the first ones widen the histogram on either side."""
+        values = np.concatenate([self.rng.uniform(0, 1, 10000), self.rng.uniform(-100, 0, 10000),
+                                 self.rng.uniform(1, 500, 10000)])
+        stats = self.accumulate(values, blocks=3, bins=256, max_distinct=1000)
+        self.assertEqual(stats._counts.size, 256)
+        self.assertEqual(stats._counts.sum(), values.size)
+        width = 2 * (values.max() - values.min()) / 256
+        for q in self.percentiles:
+            self.assertAlmostEqual(stats.percentile(q), np.percentile(values, q), delta=2 * width)
+
+    def test_no_histogram(self):
+        """Without bins the percentiles are not computed."""
+        stats = self.accumulate(np.arange(100.0))
+        self.assertTrue(np.isnan(stats.percentile(50)))
+
+    def test_empty(self):
+        """Statistics of an empty band are nan with a count of 0."""
+        stats = RunningStats(bins=HISTOGRAM_BINS)
+        stats.update(np.array([]))
+        result = stats.result(['count', 'mean', 'std', 'minimum', 'median', 'p90'])
+        self.assertEqual(result['count'], 0)
+        for name in ['mean', 'std', 'minimum', 'median', 'p90']:
+            self.assertTrue(np.isnan(result[name]))
+
+    def test_valid_statistic(self):
+        """Statistic names are checked and percentiles need the histogram."""
+        for name in ['mean', 'median', 'p0', 'p10', 'p97.5', 'p100']:
+            self.assertTrue(valid_statistic(name))
+        for name in ['average', 'p101', 'p', 'p-1', '10']:
+            self.assertFalse(valid_statistic(name))
+        self.assertTrue(needs_histogram(['mean', 'p90']))
+        self.assertTrue(needs_histogram(['median']))
+        self.assertFalse(needs_histogram(['mean', 'std']))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,12 @@
 # coding=utf-8
 """Common functionality used by regression tests."""
 
+import re
 import sys
 import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 LOGGER = logging.getLogger('QGIS')
@@ -59,3 +63,89 @@ def get_qgis_app():
         IFACE = QgisInterface(CANVAS)
 
     return QGIS_APP, CANVAS, IFACE, PARENT
+
+
+def start_http_server(respond):
+    """ Start a local HTTP server for the tests of the network code.
+
+    :param respond: Function called with the request handler of each request,
+        which returns the status, a dictionary of headers and the body of the
+        response. A Content-Length of None leaves the header out. The body of
+        the request is available as handler.body.
+    :type respond: function
+
+    :returns: The running server, stopped with stop_http_server(), and its URL.
+    :rtype: (ThreadingHTTPServer, str)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def answer(self):
+            if self.server.stopped:
+                # drop the keep-alive connections like an unreachable server
+                self.close_connection = True
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            self.body = self.rfile.read(length) if length else b''
+            status, headers, body = respond(self)
+            self.send_response(status)
+            for name, value in headers.items():
+                if value is not None:
+                    self.send_header(name, value)
+            if 'Content-Length' not in headers:
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        do_GET = do_HEAD = do_POST = answer
+
+        def log_message(self, *args):  # pylint: disable=W0221
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.stopped = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def stop_http_server(server):
+    """ Stop a server started with start_http_server, also closing the
+    keep-alive connections of its clients.
+
+    :param server: The running server.
+    :type server: ThreadingHTTPServer
+    """
+    server.stopped = True
+    server.shutdown()
+    server.server_close()
+
+
+def range_response(handler, content, etag=None):
+    """ Answer a request for content honouring its Range header, like the
+    storage of the WaPOR rasters does.
+
+    :param handler: Request handler of the request.
+    :param content: Bytes of the whole file.
+    :type content: bytes
+    :param etag: ETag of the file, None to leave it out.
+    :type etag: str
+
+    :returns: The status, headers and body of the response.
+    :rtype: (int, dict, bytes)
+    """
+    headers = {'Accept-Ranges': 'bytes'}
+    if etag is not None:
+        headers['ETag'] = etag
+    match = re.match(r'bytes=(\d+)-(\d*)$', handler.headers.get('Range') or '')
+    if match is None:
+        return 200, headers, content
+    start = int(match.group(1))
+    end = min(int(match.group(2) or len(content) - 1), len(content) - 1)
+    if start >= len(content):
+        headers['Content-Range'] = 'bytes */{}'.format(len(content))
+        return 416, headers, b''
+    headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(content))
+    return 206, headers, content[start:end + 1]
@@ -0,0 +1,519 @@
+"""
+    Persistent cache of the byte ranges read from the remote COGs.
+
+    GDAL reads the headers and tiles of the WaPOR COGs with HTTP range
+    requests. To keep those bytes between sessions, the /vsicurl/ paths are
+    pointed to a small HTTP server bound to 127.0.0.1 that answers the range
+    requests from a SQLite database of fixed size blocks, keyed by URL, ETag
+    and block offset, and only asks the remote server for the missing
+    blocks. The database is bounded in size, the least recently used blocks
+    are evicted first. Only the WaPOR hosts are served, and the requests
+    must carry the random token of the session in their path, so the
+    server can not be used as a proxy by other local processes.
+"""
+import os
+import re
+import time
+import secrets
+import sqlite3
+import threading
+import requests
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+from .cache import DEFAULT_CACHE_DIR
+from .transport import get_transport
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+""" Hosts of the rasters read through the cache """
+ALLOWED_HOSTS = ('storage.googleapis.com', 'data.apps.fao.org')
+
+""" Bytes written at a time when a response is passed through """
+STREAM_CHUNK = 256 * 1024
+
+""" Recently used blocks kept in memory before their time is written """
+USED_FLUSH = 4096
+
+class RemoteFileChanged(requests.RequestException):
+    """
+        Raised when the ETag of a remote file changes while it is read.
+    """
+
+class BlockCache:
+    """
+        Class used to cache on disk the byte ranges of the remote rasters
+        read by GDAL, serving them through a local HTTP server.
+
+        ...
+
+        Attributes
+        ----------
+        cache_dir : String
+            Folder where the SQLite database of the blocks is stored.
+        max_bytes : int
+            Maximum size in bytes of the cached blocks.
+        block_size : int
+            Size in bytes of the blocks the files are split into.
+        validate_ttl : int
+            Seconds after which the ETag of a file is checked again.
+        enabled : bool
+            If False, the remote URLs are read directly.
+        allowed_hosts : Tuple
+            Hosts served through the cache, the URLs of other hosts are
+            read directly.
+        transport : HttpTransport
+            Pooled HTTP transport used to query the remote servers.
+
+        Methods
+        -------
+        local_url(url):
+            Returns the URL of the local server that serves url through the
+            cache, starting the server on the first call.
+        read(url, start, end):
+            Returns the bytes start to end (included) of url and the size of
+            the file, reading the missing blocks from the remote server.
+        stats():
+            Returns the counters of hits, misses, bytes saved and bytes
+            downloaded, and the size of the cache.
+        downloaded(urls):
+            Returns the bytes downloaded from the remote server for urls.
+        clear():
+            Drops all the cached blocks.
+        close():
+            Stops the local server.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=2 * 1024 ** 3, block_size=128 * 1024,
+                 validate_ttl=24 * 3600, enabled=True, transport=None, allowed_hosts=ALLOWED_HOSTS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.validate_ttl = validate_ttl
+        self.enabled = enabled
+        self.allowed_hosts = tuple(allowed_hosts)
+        self.transport = transport if transport is not None else get_transport()
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._size = 0
+        self._server = None
+        self._token = secrets.token_hex(16)
+        self._used = dict()
+        self._url_bytes = dict()
+        self._counters = {'hits': 0, 'misses': 0, 'bytes_saved': 0,
+                          'bytes_downloaded': 0, 'evicted': 0}
+
+    def _connection(self):
+        if self._conn is None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._conn = sqlite3.connect(os.path.join(self.cache_dir, 'blocks.sqlite'),
+                                             check_same_thread=False)
+            except (OSError, sqlite3.Error) as exception:
+                print('Block cache not available on disk, using memory: {}'.format(exception))
+                self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS files (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    size INTEGER,
+                    checked REAL);
+                CREATE TABLE IF NOT EXISTS blocks (
+                    url TEXT,
+                    etag TEXT,
+                    offset INTEGER,
+                    data BLOB,
+                    used REAL,
+                    PRIMARY KEY (url, etag, offset));
+                CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used);''')
+            self._conn.commit()
+            self._size = self._conn.execute('SELECT coalesce(sum(length(data)), 0) FROM blocks').fetchone()[0]
+        return self._conn
+
+    def local_url(self, url):
+        """
+            Returns the URL of the local server that serves url through the
+            cache, or url itself if the cache is disabled, the host of url is
+            not in allowed_hosts or the server can not be started.
+
+            ...
+            Parameters
+            ----------
+            url : String
+                URL of the remote file.
+        """
+        if not self.enabled or not self.allows(url):
+            return url
+        with self._lock:
+            if self._server is None:
+                try:
+                    self._server = ThreadingHTTPServer(('127.0.0.1', 0), _BlockHandler)
+                except OSError as exception:
+                    print('Block cache server not started, reading COGs directly: {}'.format(exception))
+                    self.enabled = False
+                    return url
+                self._server.daemon_threads = True
+                self._server.block_cache = self
+                threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            host, port = self._server.server_address
+        parsed = urlparse(url)
+        local = 'http://{}:{}/{}/{}/{}{}'.format(host, port, self._token, parsed.scheme, parsed.netloc, parsed.path)
+        return local + ('?' + parsed.query if parsed.query else '')
+
+    def allows(self, url):
+        """
+            Returns if url is an http(s) URL of one of the allowed_hosts.
+
+            ...
+            Parameters
+            ----------
+            url : String
+                URL of the remote file.
+        """
+        parsed = urlparse(url)
+        return parsed.scheme in ('http', 'https') and parsed.hostname in self.allowed_hosts
+
+    def _file(self, url):
+        """
+            Returns the ETag and size of url, checking them with the remote
+            server when they are unknown or older than validate_ttl. The
+            blocks of an older ETag are dropped.
+        """
+        with self._lock:
+            row = self._connection().execute('SELECT etag, size, checked FROM files WHERE url = ?',
+                                              (url,)).fetchone()
+        if row is not None and time.time() - row[2] < self.validate_ttl:
+            return row[0], row[1]
+        try:
+            etag, size = self._probe(url)
+        except (requests.ConnectionError, requests.Timeout):
+            if row is None:
+                raise
+            return row[0], row[1]
+        if size is None:
+            return None, None
+        self._set_file(url, etag, size)
+        return etag, size
+
+    def _probe(self, url):
+        """
+            Returns the ETag and size of url from a HEAD request, or from a
+            request of its first byte when the HEAD response has no
+            Content-Length, or None, None if the file does not exist.
+        """
+        with self.transport.head(url) as resp:
+            if not resp.ok:
+                return None, None
+            if resp.headers.get('Content-Length') is not None:
+                return resp.headers.get('ETag', ''), int(resp.headers['Content-Length'])
+        with self.transport.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as resp:
+            content_range = CONTENT_RANGE_PATTERN.match(resp.headers.get('Content-Range', ''))
+            if resp.status_code == 206 and content_range:
+                return resp.headers.get('ETag', ''), int(content_range.group(3))
+            if resp.status_code == 200 and resp.headers.get('Content-Length') is not None:
+                return resp.headers.get('ETag', ''), int(resp.headers['Content-Length'])
+        return None, None
+
+    def _set_file(self, url, etag, size):
+        with self._lock:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (url, etag, size, time.time()))
+            removed = conn.execute('SELECT coalesce(sum(length(data)), 0) FROM blocks WHERE url = ? AND etag != ?',
+                                   (url, etag)).fetchone()[0]
+            if removed:
+                conn.execute('DELETE FROM blocks WHERE url = ? AND etag != ?', (url, etag))
+                self._size -= removed
+            conn.commit()
+
+    def read(self, url, start, end):
+        """
+            Returns the bytes start to end (included) of url and the size of
+            the file, reading the missing blocks from the remote server. None
+            is returned if the remote file does not exist. When the file
+            changes during the read, it is read again from the new version,
+            and RemoteFileChanged is raised if it changes once more.
+
+            ...
+            Parameters
+            ----------
+            url : String
+                URL of the remote file.
+            start : int
+                First byte to read.
+            end : int
+                Last byte to read, None reads until the end of the file.
+        """
+        try:
+            return self._read(url, start, end)
+        except RemoteFileChanged:
+            ## The blocks already read belong to the old version.
+            return self._read(url, start, end)
+
+    def _read(self, url, start, end):
+        etag, size = self._file(url)
+        if size is None:
+            return None, None
+        end = size - 1 if end is None else min(end, size - 1)
+        if start > end:
+            return b'', size
+
+        offsets = list(range(start - start % self.block_size, end + 1, self.block_size))
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute('''SELECT offset, data FROM blocks WHERE url = ? AND etag = ?
+                                   AND offset >= ? AND offset <= ?''',
+                                (url, etag, offsets[0], offsets[-1])).fetchall()
+            ## The use times are written with the next stored blocks, not on every read.
+            now = time.time()
+            for offset, _ in rows:
+                self._used[(url, etag, offset)] = now
+            blocks = dict(rows)
+            missing = [offset for offset in offsets if offset not in blocks]
+            self._counters['hits'] += len(offsets) - len(missing)
+            self._counters['bytes_saved'] += sum(len(data) for data in blocks.values())
+            self._counters['misses'] += len(missing)
+
+        ## Fetch the missing blocks in runs of consecutive offsets, one request per run.
+        runs = list()
+        for offset in missing:
+            if runs and runs[-1][-1] + self.block_size == offset:
+                runs[-1].append(offset)
+            else:
+                runs.append([offset])
+        for run in runs:
+            fetched = self._fetch(url, etag, run[0], min(run[-1] + self.block_size, size) - 1)
+            if fetched is None:
+                return None, None
+            blocks.update(fetched)
+        if any(offset not in blocks for offset in offsets):
+            raise requests.RequestException('Incomplete range response for [{}]'.format(url))
+
+        data = b''.join(blocks[offset] for offset in offsets)
+        skip = start - offsets[0]
+        return data[skip:skip + end - start + 1], size
+
+    def _fetch(self, url, etag, start, end):
+        resp = self.transport.get(url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+        if resp.status_code == 206:
+            content_range = CONTENT_RANGE_PATTERN.match(resp.headers.get('Content-Range', ''))
+            first = int(content_range.group(1)) if content_range else start
+        elif resp.status_code == 200:
+            content_range = None
+            first = 0
+        else:
+            return None
+        new_etag = resp.headers.get('ETag', '')
+        changed = new_etag and new_etag != etag
+        if changed:
+            ## The remote file changed since it was validated.
+            size = int(content_range.group(3)) if content_range else len(resp.content)
+            self._set_file(url, new_etag, size)
+            etag = new_etag
+        content = resp.content
+        self._count(url, len(content))
+
+        fetched = dict()
+        for i in range(0, len(content), self.block_size):
+            offset = first + i
+            if offset % self.block_size == 0:
+                fetched[offset] = content[i:i + self.block_size]
+        self._store(url, etag, fetched)
+        if changed:
+            raise RemoteFileChanged('[{}] changed while it was read'.format(url))
+        return {offset: data for offset, data in fetched.items() if start <= offset <= end}
+
+    def _store(self, url, etag, blocks):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.executemany('INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?)',
+                             [(url, etag, offset, data, now) for offset, data in blocks.items()])
+            self._size += sum(len(data) for data in blocks.values())
+            if self._size > self.max_bytes or len(self._used) > USED_FLUSH:
+                self._flush_used(conn)
+            if self._size > self.max_bytes:
+                self._evict(conn)
+            conn.commit()
+
+    def _flush_used(self, conn):
+        """
+            Writes the use times of the blocks read since the last flush, the
+            lock must be held.
+        """
+        if len(self._used) == 0:
+            return
+        conn.executemany('UPDATE blocks SET used = ? WHERE url = ? AND etag = ? AND offset = ?',
+                         [(used, url, etag, offset) for (url, etag, offset), used in self._used.items()])
+        self._used.clear()
+
+    def _evict(self, conn):
+        """
+            Drops the least recently used blocks until the cache is at 90%
+            of max_bytes.
+        """
+        target = self.max_bytes * 0.9
+        rows = conn.execute('SELECT rowid, length(data) FROM blocks ORDER BY used').fetchall()
+        dropped = list()
+        for rowid, length in rows:
+            if self._size <= target:
+                break
+            dropped.append((rowid,))
+            self._size -= length
+        conn.executemany('DELETE FROM blocks WHERE rowid = ?', dropped)
+        self._counters['evicted'] += len(dropped)
+
+    def _count(self, url, nbytes):
+        with self._lock:
+            self._counters['bytes_downloaded'] += nbytes
+            self._url_bytes[url] = self._url_bytes.get(url, 0) + nbytes
+
+    def downloaded(self, urls):
+        """
+            Returns the bytes downloaded from the remote server for urls in
+            this session, so the rate of a download does not include the
+            other downloads running at the same time.
+
+            ...
+            Parameters
+            ----------
+            urls : List
+                URLs of the remote files.
+        """
+        with self._lock:
+            return sum(self._url_bytes.get(url, 0) for url in set(urls))
+
+    def stats(self):
+        """
+            Returns the counters of blocks served from disk (hits) and from
+            the remote server (misses), the bytes that were not downloaded
+            again, the bytes downloaded, the blocks evicted and the current
+            size of the cache in bytes.
+        """
+        with self._lock:
+            self._connection()
+            return dict(self._counters, size=self._size)
+
+    def clear(self):
+        """
+            Drops all the cached blocks and files.
+        """
+        with self._lock:
+            conn = self._connection()
+            self._used.clear()
+            conn.execute('DELETE FROM blocks')
+            conn.execute('DELETE FROM files')
+            conn.commit()
+            self._size = 0
+
+    def close(self):
+        """
+            Stops the local server, the next local_url call starts it again.
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._flush_used(self._conn)
+                self._conn.commit()
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+
+class _BlockHandler(BaseHTTPRequestHandler):
+    """
+        Handler of the local server, the path of the requests is
+        /<token>/<scheme>/<host>/<path> of the remote file.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _remote_url(self):
+        """
+            Returns the remote URL of the request, or None if the token is
+            wrong or the host is not allowed.
+        """
+        token, _, rest = self.path.lstrip('/').partition('/')
+        scheme, _, rest = rest.partition('/')
+        url = '{}://{}'.format(scheme, rest)
+        cache = self.server.block_cache
+        if not secrets.compare_digest(token, cache._token) or not cache.allows(url):
+            return None
+        return url
+
+    def do_HEAD(self):
+        if self._remote_url() is None:
+            self._reply(403)
+            return
+        try:
+            etag, size = self.server.block_cache._file(self._remote_url())
+        except requests.RequestException:
+            self._reply(502)
+            return
+        if size is None:
+            self._reply(404)
+            return
+        self._reply(200, length=size, etag=etag)
+
+    def do_GET(self):
+        cache = self.server.block_cache
+        url = self._remote_url()
+        if url is None:
+            self._reply(403)
+            return
+        match = RANGE_PATTERN.match(self.headers.get('Range', '').strip())
+        try:
+            if match is None or match.group(1) == '':
+                ## Whole file or suffix ranges are passed through without caching.
+                self._passthrough(url)
+                return
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else None
+            data, size = cache.read(url, start, end)
+        except requests.RequestException:
+            self._reply(502)
+            return
+        if data is None:
+            self._reply(404)
+            return
+        if start >= size:
+            self._reply(416, content_range='bytes */{}'.format(size))
+            return
+        self._reply(206, body=data, content_range='bytes {}-{}/{}'.format(start, start + len(data) - 1, size),
+                    etag=cache._file(url)[0])
+
+    def _passthrough(self, url):
+        """
+            Streams the remote response to GDAL without keeping it in
+            memory.
+        """
+        headers = {'Range': self.headers['Range']} if self.headers.get('Range') else {}
+        cache = self.server.block_cache
+        with cache.transport.get(url, headers=headers, stream=True) as resp:
+            self.send_response(resp.status_code)
+            for header in ('Content-Length', 'Content-Range', 'Content-Encoding', 'ETag'):
+                if resp.headers.get(header):
+                    self.send_header(header, resp.headers[header])
+            if resp.headers.get('Content-Length') is None:
+                ## Without a length the end of the body is the end of the connection.
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            self.end_headers()
+            for chunk in resp.raw.stream(STREAM_CHUNK, decode_content=False):
+                self.wfile.write(chunk)
+                cache._count(url, len(chunk))
+
+    def _reply(self, status, body=b'', length=None, content_range=None, etag=None):
+        self.send_response(status)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(length if length is not None else len(body)))
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
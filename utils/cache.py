@@ -0,0 +1,319 @@
+"""
+    Persistent on-disk cache for the GISMGR catalog.
+
+    The WaPOR catalog (workspaces, cubes, mapsets, dimensions, members and
+    measures) hardly ever changes, so every JSON response of the catalog API
+    is stored in a SQLite database under the plugin directory. Entries are
+    served from disk while they are younger than the TTL of their endpoint,
+    afterwards they are revalidated with the ETag/Last-Modified headers
+    returned by the server.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+import requests
+
+from urllib.parse import urlparse, urlencode
+
+from .transport import get_transport
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache')
+
+""" Time to live (seconds) of the cached responses, by catalog endpoint """
+CATALOG_TTLS = {
+                'workspaces' : 7 * 24 * 3600,
+                'cubes' : 24 * 3600,
+                'mapsets' : 24 * 3600,
+                'mosaicsets' : 24 * 3600,
+                'dimensions' : 7 * 24 * 3600,
+                'members' : 24 * 3600,
+                'measures' : 7 * 24 * 3600,
+                'rasters' : 6 * 3600,
+               }
+
+class CatalogCache:
+    """
+        Class used to cache the responses of the catalog API on disk.
+
+        ...
+
+        Attributes
+        ----------
+        cache_dir : String
+            Folder where the SQLite database of the cache is stored.
+        ttls : Dict
+            Time to live in seconds of the cached responses by endpoint.
+        default_ttl : int
+            Time to live in seconds for endpoints not listed in ttls.
+        stats : Dict
+            Counters of hits, revalidations and misses of the cache.
+        transport : HttpTransport
+            Pooled HTTP transport used to query the server.
+
+        Methods
+        -------
+        get_json(url, params, timeout, retries):
+            Returns the JSON response of an URL, from disk when the cached
+            entry is still valid or after revalidating it with the server.
+        ttl_for(url):
+            Returns the time to live of the endpoint of an URL.
+        refresh(prefix):
+            Drops the cached entries whose URL starts with prefix, or all of
+            them, forcing the next queries to hit the server.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttls=None, default_ttl=24 * 3600, transport=None):
+        self.cache_dir = cache_dir
+        self.transport = transport if transport is not None else get_transport()
+        self.ttls = dict(CATALOG_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.cache_dir, 'catalog.sqlite'),
+                                         check_same_thread=False)
+        except (OSError, sqlite3.Error) as exception:
+            print('Catalog cache not available on disk, using memory: {}'.format(exception))
+            self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        with self._lock:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                    key TEXT PRIMARY KEY,
+                                    url TEXT,
+                                    body TEXT,
+                                    etag TEXT,
+                                    last_modified TEXT,
+                                    fetched REAL)''')
+            self._conn.commit()
+
+    def ttl_for(self, url):
+        """
+            Returns the time to live of the endpoint of an URL, which is the
+            last collection named in its path, e.g. .../mapsets/L1-AETI-D
+            and .../mapsets both resolve to the mapsets TTL.
+
+            ...
+            Parameters
+            ----------
+            url : String
+                URL of the catalog query.
+        """
+        for segment in reversed(urlparse(url).path.rstrip('/').split('/')):
+            if segment in self.ttls:
+                return self.ttls[segment]
+        return self.default_ttl
+
+    def get_json(self, url, params=None, timeout=5, retries=None):
+        """
+            Returns the JSON response of an URL, from disk when the cached
+            entry is still valid or after revalidating it with the server.
+            If the server can not be reached, answers with an error or with
+            a body that is not JSON, a stale entry is returned. Without one,
+            the JSON of an error answer is returned as is and an error answer
+            that is not JSON raises requests.HTTPError.
+
+            ...
+            Parameters
+            ----------
+            url : String
+                URL of the catalog query.
+            params : Dict
+                Query parameters sent with the request.
+            timeout : int
+                Seconds of waiting before claiming a time out.
+            retries : int
+                Number of retries of the request, None for the retries of the
+                transport.
+        """
+        key = url if not params else '{}?{}'.format(url, urlencode(sorted(params.items())))
+        entry = self._load(key)
+
+        if entry is not None and time.time() - entry['fetched'] < self.ttl_for(url):
+            self._count('hits')
+            return json.loads(entry['body'])
+
+        headers = dict()
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            resp = self.transport.get(url, params, headers=headers, timeout=timeout, retries=retries)
+        except (requests.ConnectionError, requests.Timeout):
+            if entry is None:
+                raise
+            print('Server not reachable, using cached catalog for [{}]'.format(url))
+            return json.loads(entry['body'])
+
+        if resp.status_code == 304 and entry is not None:
+            self._count('revalidated')
+            self._touch(key)
+            return json.loads(entry['body'])
+
+        self._count('misses')
+        if not resp.ok:
+            if entry is not None:
+                print('Server answered {} {}, using cached catalog for [{}]'.format(
+                    resp.status_code, resp.reason, url))
+                return json.loads(entry['body'])
+            try:
+                return resp.json()
+            except ValueError:
+                resp.raise_for_status()
+
+        try:
+            resp_json = resp.json()
+        except ValueError:
+            if entry is None:
+                raise
+            print('Invalid response from the server, using cached catalog for [{}]'.format(url))
+            return json.loads(entry['body'])
+        self._store(key, url, resp.text, resp.headers.get('ETag'),
+                    resp.headers.get('Last-Modified'))
+        return resp_json
+
+    def refresh(self, prefix=None):
+        """
+            Drops the cached entries whose URL starts with prefix, or all of
+            them, forcing the next queries to hit the server.
+
+            ...
+            Parameters
+            ----------
+            prefix : String
+                URL prefix of the entries to drop, None drops everything.
+        """
+        with self._lock:
+            if prefix is None:
+                self._conn.execute('DELETE FROM responses')
+            else:
+                self._conn.execute('DELETE FROM responses WHERE substr(url, 1, ?) = ?',
+                                   (len(prefix), prefix))
+            self._conn.commit()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _load(self, key):
+        with self._lock:
+            row = self._conn.execute('''SELECT body, etag, last_modified, fetched
+                                        FROM responses WHERE key = ?''', (key,)).fetchone()
+        if row is None:
+            return None
+        return {'body': row[0], 'etag': row[1], 'last_modified': row[2], 'fetched': row[3]}
+
+    def _store(self, key, url, body, etag, last_modified):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, url, body, etag, last_modified, time.time()))
+            self._conn.commit()
+
+    def _touch(self, key):
+        with self._lock:
+            self._conn.execute('UPDATE responses SET fetched = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+
+class MetadataIndex:
+    """
+        Class used to keep a process-wide index of the metadata of the
+        variables of the catalog, keyed by variable code. Each collection
+        (e.g. the mapsets or the mosaicsets of a workspace) is loaded once
+        per session, from disk while it is younger than the TTL or from the
+        server otherwise, and is shared by all the threads.
+
+        ...
+
+        Attributes
+        ----------
+        loader : function
+            Function that receives the URL of a collection and returns a
+            dictionary with the metadata of its variables by code.
+        cache_dir : String
+            Folder where the index is persisted.
+        ttl : int
+            Time to live in seconds of the persisted index.
+
+        Methods
+        -------
+        get(collection, code):
+            Returns the metadata of the variable code of a collection.
+        refresh():
+            Drops the index from memory and disk.
+    """
+    def __init__(self, loader, cache_dir=DEFAULT_CACHE_DIR, ttl=7 * 24 * 3600):
+        self.loader = loader
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._path = os.path.join(self.cache_dir, 'metadata_index.json')
+        self._lock = threading.Lock()
+        self._entries = dict()
+        self._loaded = set()
+
+    def get(self, collection, code):
+        """
+            Returns a copy of the metadata of the variable code of a
+            collection, raising a KeyError if the collection does not have
+            that variable.
+
+            ...
+            Parameters
+            ----------
+            collection : String
+                URL of the collection listing the variables.
+            code : String
+                Code of the variable.
+        """
+        with self._lock:
+            if collection not in self._entries:
+                entries = self._read(collection)
+                if entries is not None:
+                    self._entries[collection] = entries
+            if code not in self._entries.get(collection, {}) and collection not in self._loaded:
+                self._entries[collection] = self.loader(collection)
+                self._loaded.add(collection)
+                self._write(collection)
+            return dict(self._entries[collection][code])
+
+    def refresh(self):
+        """
+            Drops the index from memory and disk, the next lookups load it
+            again from the server.
+        """
+        with self._lock:
+            self._entries = dict()
+            self._loaded = set()
+            if os.path.isfile(self._path):
+                try:
+                    os.remove(self._path)
+                except OSError:
+                    ...
+
+    def _read(self, collection):
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                stored = json.load(f).get(collection)
+        except (OSError, ValueError):
+            return None
+        if stored is None or time.time() - stored['fetched'] > self.ttl:
+            return None
+        return stored['entries']
+
+    def _write(self, collection):
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = dict()
+        stored[collection] = {'fetched': time.time(), 'entries': self._entries[collection]}
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(stored, f)
+            os.replace(tmp_path, self._path)
+        except OSError as exception:
+            print('Metadata index not saved on disk: {}'.format(exception))
@@ -0,0 +1,95 @@
+"""
+    Canonical hashes of the download regions and requests.
+
+    The hashes identify a region or a request whatever the way it is
+    written: equal geometries give the same hash when their vertices or
+    parts are in a different order or the GeoJSON has other properties.
+    The request hash also covers every setting that changes the output
+    files, so two requests are only merged when they write the same data.
+"""
+import os
+import json
+import hashlib
+import shapely
+
+def region_wkb(region):
+    """
+        Returns the normalized 2D WKB of a shapely geometry or WKB, the same
+        for equal geometries.
+
+        ...
+        Parameters
+        ----------
+        region : shapely.Geometry, bytes
+            Geometry or its WKB.
+    """
+    geometry = shapely.from_wkb(region) if isinstance(region, bytes) else region
+    return shapely.to_wkb(shapely.normalize(shapely.force_2d(geometry)))
+
+def region_hash(region):
+    """
+        Returns a short hash of a region, from the normalized WKB of a
+        geometry, the content of a file or the JSON of a bounding-box or
+        region code.
+
+        ...
+        Parameters
+        ----------
+        region : shapely.Geometry, bytes, String, List
+            Geometry, WKB, path to a GeoJSON file, bounding-box or code of
+            the region.
+    """
+    if isinstance(region, (shapely.Geometry, bytes)):
+        content = region_wkb(region)
+    elif isinstance(region, str) and os.path.isfile(region):
+        with open(region, 'rb') as f:
+            content = f.read()
+    else:
+        content = json.dumps(region).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()[:16]
+
+def request_hash(region, variable, period, overview='NONE', unit_conversion='none', extension='.tif',
+                 seperate_unscale=False, dtype_policy='exact', profile=None, time_cube=False, grid=None):
+    """
+        Returns the canonical hash of a download request. It is the same for
+        equal geometries written in a different order or with different
+        properties, and changes with every setting of the output files.
+
+        ...
+        Parameters
+        ----------
+        region : shapely.Geometry, bytes, String, List
+            Geometry, WKB, path to a GeoJSON file, bounding-box or code of
+            the region.
+        variable : String
+            Code of the mapset, e.g. L2-AETI-D.
+        period : List
+            Start and end dates of the request.
+        overview, unit_conversion, extension, seperate_unscale,
+        dtype_policy, profile, time_cube, grid :
+            Output settings of the request, see wapor_map.
+    """
+    if isinstance(region, (shapely.Geometry, bytes)):
+        region_key = region_wkb(region).hex()
+    elif isinstance(region, str) and os.path.isfile(region):
+        try:
+            with open(region, 'r', encoding='utf-8') as f:
+                region_key = shapely.to_wkb(shapely.normalize(shapely.from_geojson(f.read())), hex=True)
+        except shapely.GEOSException:
+            region_key = region_hash(region)
+    elif isinstance(region, list):
+        region_key = [round(float(x), 9) for x in region]
+    else:
+        region_key = region
+    request = {'region': region_key,
+               'variable': variable,
+               'period': list(period) if period is not None else None,
+               'overview': str(overview),
+               'unit_conversion': unit_conversion,
+               'extension': extension,
+               'seperate_unscale': bool(seperate_unscale),
+               'dtype_policy': dtype_policy,
+               'profile': profile,
+               'time_cube': bool(time_cube),
+               'grid': grid}
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
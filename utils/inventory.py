@@ -0,0 +1,301 @@
+"""
+    Local inventory of the rasters published in the GISMGR catalog.
+
+    The raster codes, time ranges and download URLs of every mapset (and L3
+    region) that has been queried are stored in a SQLite database indexed on
+    time, so the URLs of a period are answered locally and only the rasters
+    newer than the last synchronisation are requested to the server. Every
+    few days the whole listing is fetched again, so rasters republished or
+    backfilled before the newest one are picked up as well. The files whose
+    existence has been checked (e.g. the agERA5 files, which are not listed
+    in the catalog) are remembered as well.
+"""
+import os
+import time
+import sqlite3
+import datetime
+import threading
+
+from .cache import DEFAULT_CACHE_DIR
+
+def _day(value):
+    """
+        Parses a date (YYYY-MM-DD, with or without time, or a date object)
+        into its ISO format, so the stored dates compare as dates.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    text = str(value).strip().split('T')[0].split(' ')[0]
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date().isoformat()
+
+class RasterInventory:
+    """
+        Class used to keep a local inventory of the rasters of the catalog.
+
+        ...
+
+        Attributes
+        ----------
+        cache_dir : String
+            Folder where the SQLite database of the inventory is stored.
+        sync_ttl : int
+            Seconds after which a synchronised mapset is checked again for
+            new rasters.
+        full_sync_ttl : int
+            Seconds after which the whole listing of a mapset is fetched
+            again instead of only the newest rasters.
+
+        Methods
+        -------
+        has(mapset, region):
+            Returns if a mapset (and region) has been synchronised.
+        latest(mapset, region):
+            Returns the start date of the newest raster of a mapset.
+        needs_sync(mapset, region):
+            Returns if a mapset has never been synchronised or its last
+            synchronisation is older than sync_ttl.
+        needs_full_sync(mapset, region):
+            Returns if the whole listing of a mapset has not been fetched in
+            the last full_sync_ttl.
+        update(mapset, region, rasters, full):
+            Adds the rasters fetched from the server and marks the mapset as
+            synchronised.
+        urls(mapset, region, period):
+            Returns the download URLs of the rasters that overlap a period.
+        refresh(mapset):
+            Drops the inventory of a mapset, or all of it.
+        valid_urls(urls):
+            Returns the URLs that are known to exist.
+        add_valid_urls(urls):
+            Remembers URLs that have been checked to exist.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, sync_ttl=6 * 3600, full_sync_ttl=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.sync_ttl = sync_ttl
+        self.full_sync_ttl = full_sync_ttl
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._conn = sqlite3.connect(os.path.join(self.cache_dir, 'inventory.sqlite'),
+                                             check_same_thread=False)
+            except (OSError, sqlite3.Error) as exception:
+                print('Raster inventory not available on disk, using memory: {}'.format(exception))
+                self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS rasters (
+                    mapset TEXT,
+                    region TEXT,
+                    code TEXT,
+                    start_date TEXT,
+                    end_date TEXT,
+                    url TEXT,
+                    PRIMARY KEY (mapset, region, code));
+                CREATE INDEX IF NOT EXISTS rasters_time
+                    ON rasters (mapset, region, start_date, end_date);
+                CREATE TABLE IF NOT EXISTS syncs (
+                    mapset TEXT,
+                    region TEXT,
+                    synced REAL,
+                    full_synced REAL,
+                    PRIMARY KEY (mapset, region));
+                CREATE TABLE IF NOT EXISTS valid_urls (
+                    url TEXT PRIMARY KEY,
+                    checked REAL);''')
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(syncs)')]
+            if 'full_synced' not in columns:
+                self._conn.execute('ALTER TABLE syncs ADD COLUMN full_synced REAL')
+            self._conn.commit()
+        return self._conn
+
+    def has(self, mapset, region=None):
+        """
+            Returns if a mapset (and region) has been synchronised.
+
+            ...
+            Parameters
+            ----------
+            mapset : String
+                Code of the mapset, e.g. L2-AETI-D.
+            region : String
+                Code of the L3 region, None for all the rasters of the mapset.
+        """
+        with self._lock:
+            row = self._connection().execute('SELECT synced FROM syncs WHERE mapset = ? AND region = ?',
+                                             (mapset, region or '')).fetchone()
+        return row is not None
+
+    def needs_sync(self, mapset, region=None):
+        """
+            Returns if a mapset has never been synchronised or its last
+            synchronisation is older than sync_ttl.
+
+            ...
+            Parameters
+            ----------
+            mapset : String
+                Code of the mapset, e.g. L2-AETI-D.
+            region : String
+                Code of the L3 region, None for all the rasters of the mapset.
+        """
+        with self._lock:
+            row = self._connection().execute('SELECT synced FROM syncs WHERE mapset = ? AND region = ?',
+                                             (mapset, region or '')).fetchone()
+        return row is None or time.time() - row[0] > self.sync_ttl
+
+    def needs_full_sync(self, mapset, region=None):
+        """
+            Returns if the whole listing of a mapset has not been fetched in
+            the last full_sync_ttl.
+
+            ...
+            Parameters
+            ----------
+            mapset : String
+                Code of the mapset, e.g. L2-AETI-D.
+            region : String
+                Code of the L3 region, None for all the rasters of the mapset.
+        """
+        with self._lock:
+            row = self._connection().execute('SELECT full_synced FROM syncs WHERE mapset = ? AND region = ?',
+                                             (mapset, region or '')).fetchone()
+        return row is None or row[0] is None or time.time() - row[0] > self.full_sync_ttl
+
+    def latest(self, mapset, region=None):
+        """
+            Returns the start date of the newest raster of a mapset, or None
+            if no raster is known.
+
+            ...
+            Parameters
+            ----------
+            mapset : String
+                Code of the mapset, e.g. L2-AETI-D.
+            region : String
+                Code of the L3 region, None for all the rasters of the mapset.
+        """
+        with self._lock:
+            row = self._connection().execute('''SELECT max(start_date) FROM rasters
+                                                WHERE mapset = ? AND region = ?''',
+                                             (mapset, region or '')).fetchone()
+        return row[0]
+
+    def update(self, mapset, region, rasters, full=False):
+        """
+            Adds the rasters fetched from the server, replacing the known
+            ones with the same code, and marks the mapset as synchronised.
+            After a full listing the known rasters that are not in it are
+            dropped.
+
+            ...
+            Parameters
+            ----------
+            mapset : String
+                Code of the mapset, e.g. L2-AETI-D.
+            region : String
+                Code of the L3 region, None for all the rasters of the mapset.
+            rasters : List
+                Tuples of (code, start_date, end_date, url) of the rasters.
+            full : bool
+                If rasters is the whole listing of the mapset.
+        """
+        rows = [(mapset, region or '', code, _day(start), _day(end), url)
+                for code, start, end, url in rasters]
+        with self._lock:
+            conn = self._connection()
+            if full:
+                conn.execute('DELETE FROM rasters WHERE mapset = ? AND region = ?', (mapset, region or ''))
+            conn.executemany('INSERT OR REPLACE INTO rasters VALUES (?, ?, ?, ?, ?, ?)', rows)
+            row = conn.execute('SELECT full_synced FROM syncs WHERE mapset = ? AND region = ?',
+                               (mapset, region or '')).fetchone()
+            full_synced = time.time() if full else (row[0] if row is not None else None)
+            conn.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?)',
+                         (mapset, region or '', time.time(), full_synced))
+            conn.commit()
+
+    def urls(self, mapset, region=None, period=None):
+        """
+            Returns the download URLs of the rasters of a mapset whose time
+            range overlaps a period.
+
+            ...
+            Parameters
+            ----------
+            mapset : String
+                Code of the mapset, e.g. L2-AETI-D.
+            region : String
+                Code of the L3 region, None for all the rasters of the mapset.
+            period : List
+                Start and end dates (YYYY-MM-DD) of the period, None for all
+                the rasters.
+        """
+        query = 'SELECT url FROM rasters WHERE mapset = ? AND region = ?'
+        args = [mapset, region or '']
+        if period is not None:
+            query += ' AND start_date <= ? AND end_date >= ?'
+            args += [_day(period[1]), _day(period[0])]
+        with self._lock:
+            rows = self._connection().execute(query + ' ORDER BY start_date', args).fetchall()
+        return [row[0] for row in rows]
+
+    def refresh(self, mapset=None):
+        """
+            Drops the inventory of a mapset, or all of it.
+
+            ...
+            Parameters
+            ----------
+            mapset : String
+                Code of the mapset to drop, None drops everything.
+        """
+        with self._lock:
+            conn = self._connection()
+            if mapset is None:
+                conn.execute('DELETE FROM rasters')
+                conn.execute('DELETE FROM syncs')
+            else:
+                conn.execute('DELETE FROM rasters WHERE mapset = ?', (mapset,))
+                conn.execute('DELETE FROM syncs WHERE mapset = ?', (mapset,))
+            conn.commit()
+
+    def valid_urls(self, urls):
+        """
+            Returns the set of URLs that are known to exist.
+
+            ...
+            Parameters
+            ----------
+            urls : List
+                URLs to look up.
+        """
+        with self._lock:
+            conn = self._connection()
+            known = set()
+            urls = list(urls)
+            for i in range(0, len(urls), 500):
+                chunk = urls[i:i + 500]
+                rows = conn.execute('SELECT url FROM valid_urls WHERE url IN ({})'.format(
+                                    ', '.join('?' * len(chunk))), chunk).fetchall()
+                known.update(row[0] for row in rows)
+        return known
+
+    def add_valid_urls(self, urls):
+        """
+            Remembers URLs that have been checked to exist.
+
+            ...
+            Parameters
+            ----------
+            urls : List
+                URLs that exist.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.executemany('INSERT OR REPLACE INTO valid_urls VALUES (?, ?)',
+                             [(url, time.time()) for url in urls])
+            conn.commit()
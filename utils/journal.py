@@ -0,0 +1,256 @@
+"""
+    Crash-safe journal of the download jobs.
+
+    Every batch download (a v2 crop job over several time members, a v3
+    download over several years...) is recorded with the units of work it
+    was split into before any of them starts. Each unit is marked as done
+    or failed as soon as it finishes, in a SQLite database committed after
+    every change, so after a crash or a network failure the same job is
+    found again and only the units that are not done are run.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from .cache import DEFAULT_CACHE_DIR
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+""" Values of jobs.finished """
+UNFINISHED = 0
+FINISHED = 1
+ABANDONED = 2
+
+class JobJournal:
+    """
+        Class used to record the planned units of work of the download jobs
+        and their completion state.
+
+        ...
+
+        Attributes
+        ----------
+        cache_dir : String
+            Folder where the SQLite database of the journal is stored.
+
+        Methods
+        -------
+        open_job(kind, params):
+            Returns the id of the unfinished job with the same kind and
+            parameters, or of a new job.
+        plan(job_id, units):
+            Records the units of work of a job.
+        pending(job_id):
+            Returns the units of a job that are not done.
+        mark(job_id, unit, state, detail):
+            Records the state of a unit of work.
+        close_job(job_id):
+            Marks a job as finished if all its units are done.
+        unfinished(kind):
+            Returns the jobs that were not finished.
+        completed(kind, params):
+            Returns the results of the units of the latest finished job with
+            the same kind and parameters.
+        abandon(job_id):
+            Marks a job as finished without running its pending units.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.cache_dir, 'journal.sqlite'),
+                                         check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        except (OSError, sqlite3.Error) as exception:
+            print('Job journal not available on disk, using memory: {}'.format(exception))
+            self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        with self._lock:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT,
+                    key TEXT,
+                    params TEXT,
+                    finished INTEGER DEFAULT 0,
+                    created REAL,
+                    updated REAL);
+                CREATE INDEX IF NOT EXISTS jobs_key ON jobs (kind, key, finished);
+                CREATE TABLE IF NOT EXISTS units (
+                    job_id INTEGER,
+                    seq INTEGER,
+                    unit TEXT,
+                    state TEXT,
+                    detail TEXT,
+                    updated REAL,
+                    PRIMARY KEY (job_id, unit));''')
+            self._conn.commit()
+
+    def open_job(self, kind, params):
+        """
+            Returns the id of the unfinished job with the same kind and
+            parameters, so an interrupted job is resumed, or of a new job.
+
+            ...
+            Parameters
+            ----------
+            kind : String
+                Type of job, e.g. wapor2-crop or wapor3-download.
+            params : Dict
+                JSON serializable parameters that identify the job.
+        """
+        params_json, key = self._key(params)
+        with self._lock:
+            row = self._conn.execute('''SELECT job_id FROM jobs WHERE kind = ? AND key = ?
+                                        AND finished = ? ORDER BY job_id DESC''',
+                                     (kind, key, UNFINISHED)).fetchone()
+            if row is not None:
+                return row[0]
+            cursor = self._conn.execute('''INSERT INTO jobs (kind, key, params, created, updated)
+                                           VALUES (?, ?, ?, ?, ?)''',
+                                        (kind, key, params_json, time.time(), time.time()))
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def plan(self, job_id, units):
+        """
+            Records the units of work of a job, the units already recorded
+            keep their state.
+
+            ...
+            Parameters
+            ----------
+            job_id : int
+                Id of the job.
+            units : List
+                Keys of the units of work, in the order they should run.
+        """
+        with self._lock:
+            self._conn.executemany('INSERT OR IGNORE INTO units VALUES (?, ?, ?, ?, ?, ?)',
+                                   [(job_id, seq, unit, PENDING, None, time.time())
+                                    for seq, unit in enumerate(units)])
+            self._conn.commit()
+
+    def pending(self, job_id):
+        """
+            Returns, in order, the units of a job that are not done.
+
+            ...
+            Parameters
+            ----------
+            job_id : int
+                Id of the job.
+        """
+        with self._lock:
+            rows = self._conn.execute('''SELECT unit FROM units WHERE job_id = ? AND state != ?
+                                         ORDER BY seq''', (job_id, DONE)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark(self, job_id, unit, state, detail=None):
+        """
+            Records the state of a unit of work.
+
+            ...
+            Parameters
+            ----------
+            job_id : int
+                Id of the job.
+            unit : String
+                Key of the unit of work.
+            state : String
+                One of PENDING, DONE or FAILED.
+            detail : String
+                Result or error message of the unit.
+        """
+        with self._lock:
+            self._conn.execute('UPDATE units SET state = ?, detail = ?, updated = ? WHERE job_id = ? AND unit = ?',
+                               (state, detail, time.time(), job_id, unit))
+            self._conn.execute('UPDATE jobs SET updated = ? WHERE job_id = ?', (time.time(), job_id))
+            self._conn.commit()
+
+    def close_job(self, job_id):
+        """
+            Marks a job as finished if all its units are done, and returns
+            if it was.
+
+            ...
+            Parameters
+            ----------
+            job_id : int
+                Id of the job.
+        """
+        if len(self.pending(job_id)) > 0:
+            return False
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET finished = ?, updated = ? WHERE job_id = ?',
+                               (FINISHED, time.time(), job_id))
+            self._conn.commit()
+        return True
+
+    def unfinished(self, kind=None):
+        """
+            Returns the id and parameters of the jobs that were not finished.
+
+            ...
+            Parameters
+            ----------
+            kind : String
+                Type of job to look for, None for all of them.
+        """
+        query = 'SELECT job_id, params FROM jobs WHERE finished = ?'
+        args = [UNFINISHED]
+        if kind is not None:
+            query += ' AND kind = ?'
+            args.append(kind)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY job_id', args).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def abandon(self, job_id):
+        """
+            Marks a job as finished without running its pending units.
+
+            ...
+            Parameters
+            ----------
+            job_id : int
+                Id of the job.
+        """
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET finished = ?, updated = ? WHERE job_id = ?',
+                               (ABANDONED, time.time(), job_id))
+            self._conn.commit()
+
+    def completed(self, kind, params):
+        """
+            Returns the details recorded for the units of the latest finished
+            job with the same kind and parameters, in order, or None if there
+            is no such job.
+
+            ...
+            Parameters
+            ----------
+            kind : String
+                Type of job, e.g. wapor2-crop or wapor3-download.
+            params : Dict
+                JSON serializable parameters that identify the job.
+        """
+        _, key = self._key(params)
+        with self._lock:
+            row = self._conn.execute('''SELECT job_id FROM jobs WHERE kind = ? AND key = ?
+                                        AND finished = ? ORDER BY job_id DESC''',
+                                     (kind, key, FINISHED)).fetchone()
+            if row is None:
+                return None
+            rows = self._conn.execute('SELECT detail FROM units WHERE job_id = ? ORDER BY seq',
+                                      (row[0],)).fetchall()
+        return [detail for detail, in rows]
+
+    def _key(self, params):
+        params_json = json.dumps(params, sort_keys=True)
+        return params_json, hashlib.sha1(params_json.encode('utf-8')).hexdigest()
@@ -4,6 +4,8 @@ import os
 import processing
 
 from .api_queries import crop_raster_query
+from .cache import CatalogCache
+from .transport import get_transport, collect_pages
 
 from qgis.PyQt.QtWidgets import QApplication, QMessageBox
 
@@ -29,6 +31,13 @@ class Wapor3APIManager:
             Dictionary with the payload of the query.
         time_out : int
             Seconds of waiting before claiming a time out.
+        retries : int
+            Retries of the catalog queries, kept low because they run in
+            the GUI thread.
+        cache : CatalogCache
+            Persistent cache of the catalog responses.
+        transport : HttpTransport
+            Pooled HTTP transport shared by all the queries.
 
         Methods
         -------
@@ -55,10 +64,12 @@ class Wapor3APIManager:
             given workspace code.
         pull_mapsets(workspace):
             Pulls all the pull_mapsets available in the catalog for a given workspace.
+        refresh_catalog():
+            Drops the cached catalog responses so they are pulled again.
             
     """
 
-    def __init__(self, APIToken=None):
+    def __init__(self, APIToken=None, cache=None):
 
         self.APIToken = APIToken
         self.connected =  False
@@ -68,6 +79,9 @@ class Wapor3APIManager:
 
         self.payload = {'overview':False,'paged':False}
         self.time_out = 5
+        self.retries = 1
+        self.transport = get_transport()
+        self.cache = cache if cache is not None else CatalogCache(transport=self.transport)
     
     def showInternetMsg(self):
             print("The internet connection is down")
@@ -112,7 +126,7 @@ class Wapor3APIManager:
         request_headers = {'X-GISMGR-API-KEY': APIToken}
 
         try:
-            resp = requests.post(self.sign_in_url, headers=request_headers)
+            resp = self.transport.post(self.sign_in_url, headers=request_headers)
             print('Connecting to WaPORv3 Database . . .')
 
             resp_json = resp.json()
@@ -186,26 +200,28 @@ class Wapor3APIManager:
         """
         try:
             listing = dict()
-            while url is not None:
-                try:
-                    resp = requests.get(url,timeout=self.time_out).json()
-                except:
-                    req_output = requests.get(url,timeout=self.time_out)
-                    print('Connection failed due to {}: {}'.format(req_output.reason, req_output.status_code))
-                    return -1
-                for elem in resp['response']['items']:
+            for page in collect_pages(url, self._fetch_page):
+                for elem in page['items']:
                     listing[elem['caption']] = elem['code']
-                url = resp['response']['links'][-1]['href'] if resp['response']['links'][-1]['rel'] == 'next' else None
             return listing
         except (requests.ConnectionError, requests.Timeout) as exception:
             print('requests.ConnectionError, requests.Timeout')
             print(exception)
             return None
+        except requests.HTTPError as exception:
+            print('Connection failed due to {}: {}'.format(exception.response.reason, exception.response.status_code))
+            return -1
+        except ValueError as exception:
+            print('Connection failed due to an invalid response: {}'.format(exception))
+            return -1
         except (KeyError) as exception:
             print('KeyError')
             print(exception)
             return {'---':None}
 
+    def _fetch_page(self, url):
+        return self.cache.get_json(url, timeout=self.time_out, retries=self.retries)['response']
+
     def query_info(self, url):
         """
             Performs de info query for an URL which will return the information
@@ -219,7 +235,7 @@ class Wapor3APIManager:
                 URL to get the info from the query.
         """
         try:
-            resp = requests.get(url,timeout=self.time_out).json()
+            resp = self.cache.get_json(url, timeout=self.time_out, retries=self.retries)
             return resp['response']
         except (requests.ConnectionError, requests.Timeout) as exception:
             return None
@@ -281,11 +297,9 @@ class Wapor3APIManager:
         """
         try:
             listing = dict()
-            while url is not None:
-                resp = requests.get(url,timeout=self.time_out).json()
-                for elem in resp['response']['items']:
+            for page in collect_pages(url, self._fetch_page):
+                for elem in page['items']:
                     listing[elem['code']] = elem['downloadUrl']
-                url = resp['response']['links'][-1]['href'] if resp['response']['links'][-1]['rel'] == 'next' else None
             return listing
         except (requests.ConnectionError, requests.Timeout) as exception:
             print('requests.ConnectionError, requests.Timeout')
@@ -306,6 +320,13 @@ class Wapor3APIManager:
         else:
             return rasters_dict
 
+    def refresh_catalog(self):
+        """
+            Drops the cached catalog responses so they are pulled again from
+            the server on the next queries.
+        """
+        self.cache.refresh(self.catalog_url)
+
 class Wapor2APIManager:
     """
         Class used to manage the API of WaPOR V2 and all its functions associated.
@@ -328,6 +349,13 @@ class Wapor2APIManager:
             Dictionary with the payload of the query.
         time_out : int
             Seconds of waiting before claiming a time out.
+        retries : int
+            Retries of the catalog queries, kept low because they run in
+            the GUI thread.
+        cache : CatalogCache
+            Persistent cache of the catalog responses.
+        transport : HttpTransport
+            Pooled HTTP transport shared by all the queries.
 
         Methods
         -------
@@ -376,9 +404,11 @@ class Wapor2APIManager:
         get_info_cube_mea(workspace, cube, measure):
             Gets the information contained in the catalog with respect to a 
             given set of workspace and cube codes.
+        refresh_catalog():
+            Drops the cached catalog responses so they are pulled again.
     """
 
-    def __init__(self, APIToken=None):
+    def __init__(self, APIToken=None, cache=None):
 
         self.APIToken = APIToken
         self.connected =  False
@@ -388,6 +418,9 @@ class Wapor2APIManager:
 
         self.payload = {'overview':False,'paged':False}
         self.time_out = 5
+        self.retries = 1
+        self.transport = get_transport()
+        self.cache = cache if cache is not None else CatalogCache(transport=self.transport)
     
     def showInternetMsg(self):
             print("The internet connection is down")
@@ -425,7 +458,7 @@ class Wapor2APIManager:
         request_headers = {'X-GISMGR-API-KEY': APIToken}
 
         try:
-            resp = requests.post(self.sign_in_url, headers=request_headers)
+            resp = self.transport.post(self.sign_in_url, headers=request_headers)
             print('Connecting to WaPOR v2 Database . . .')
 
             resp_json = resp.json()
@@ -505,16 +538,16 @@ class Wapor2APIManager:
             request_headers = {'Authorization': "Bearer " + self.AccessToken}
 
             try:
-                resp_json = requests.post(  self.query_url,
-                                            json=request_json,
-                                            headers=request_headers).json()
+                resp_json = self.transport.post(self.query_url,
+                                                json=request_json,
+                                                headers=request_headers).json()
                 if resp_json['message']=='OK':
                     job_url = resp_json['response']['links'][0]['href']
                     downloadButton.setEnabled(False)
 
                     while True:
                         QApplication.processEvents()
-                        response = requests.get(job_url)
+                        response = self.transport.get(job_url)
                         resp_json=response.json()
                         # NOTE: Uncomment if needed to check status
                         # print(resp_json['response']['status'])
@@ -549,7 +582,7 @@ class Wapor2APIManager:
                 URL to get listed from the query.
         """
         try:
-            resp = requests.get(url,self.payload,timeout=self.time_out).json()
+            resp = self.cache.get_json(url, self.payload, timeout=self.time_out, retries=self.retries)
 
             listing = dict()
             for elem in resp['response']:
@@ -575,7 +608,7 @@ class Wapor2APIManager:
                 URL to get the info from the query.
         """
         try:
-            resp = requests.get(url,timeout=self.time_out).json()
+            resp = self.cache.get_json(url, timeout=self.time_out, retries=self.retries)
             return resp['response']
         except (requests.ConnectionError, requests.Timeout) as exception:
             return None
@@ -737,7 +770,7 @@ class Wapor2APIManager:
         info_list = list()
         cubes_url = self.catalog_url+'workspaces/{}/cubes/{}'.format(workspace,cube)
         try:
-            resp_ele = requests.get(cubes_url, self.payload, timeout=self.time_out).json()
+            resp_ele = self.cache.get_json(cubes_url, self.payload, timeout=self.time_out, retries=self.retries)
         except (requests.ConnectionError, requests.Timeout) as exception:
             print(exception)
 
@@ -892,6 +925,13 @@ class Wapor2APIManager:
         else:
             return cube_meas_resp['caption'], cube_meas_resp['description']
 
+    def refresh_catalog(self):
+        """
+            Drops the cached catalog responses so they are pulled again from
+            the server on the next queries.
+        """
+        self.cache.refresh(self.catalog_url)
+
 
 class FileManager:
     """
@@ -0,0 +1,210 @@
+"""
+    Progress reporting and cancellation of the downloads.
+
+    GDAL calls a progress function while it warps, translates or calculates
+    a raster, and stops when the function returns 0. Progress builds those
+    functions for every stage of a download, maps their completion to an
+    overall percent with the downloaded bytes and speed, and stops GDAL as
+    soon as the shared CancelToken is set.
+"""
+import time
+import threading
+
+class DownloadCancelled(Exception):
+    """
+        Raised when a download is stopped through its CancelToken.
+    """
+
+class CancelToken:
+    """
+        Class used to share the cancellation of the running downloads
+        between the plugin and its threads. A token is also cancelled when
+        its parent is, so a single download and all of them can be stopped.
+
+        ...
+
+        Attributes
+        ----------
+        parent : CancelToken
+            Token whose cancellation also cancels this one.
+
+        Methods
+        -------
+        cancel():
+            Asks all the downloads holding the token to stop.
+        check():
+            Raises DownloadCancelled if the token has been cancelled.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def cancel(self):
+        """
+            Asks all the downloads holding the token to stop.
+        """
+        self._event.set()
+
+    def check(self):
+        """
+            Raises DownloadCancelled if the token has been cancelled.
+        """
+        if self.cancelled:
+            raise DownloadCancelled('Download cancelled')
+
+class Progress:
+    """
+        Class used to build the GDAL progress functions of the stages of a
+        download and to report the overall progress.
+
+        ...
+
+        Attributes
+        ----------
+        report : function
+            Function that receives a dictionary with the stage, percent,
+            downloaded bytes and speed in MB/s of the download.
+        token : CancelToken
+            Token that stops the download when it is cancelled.
+        bytes_counter : function
+            Function that returns the total bytes downloaded so far.
+        interval : float
+            Minimum seconds between two reports.
+
+        Methods
+        -------
+        callback(start, end, stage):
+            Returns a GDAL progress function for a stage that covers start
+            to end percent of the download.
+        part_callbacks(start, end, parts, stage):
+            Returns a GDAL progress function for each of the parts of a stage
+            that run at the same time.
+        children(parts):
+            Returns a Progress for each of the downloads that run at the same
+            time as parts of this one.
+        count_bytes(bytes_counter):
+            Counts the downloaded bytes and speed with bytes_counter from
+            now on.
+        check():
+            Raises DownloadCancelled if the token has been cancelled.
+    """
+    def __init__(self, report=None, token=None, bytes_counter=None, interval=0.25):
+        self.report = report
+        self.token = token if token is not None else CancelToken()
+        self.bytes_counter = bytes_counter
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._bytes0 = bytes_counter() if bytes_counter is not None else 0
+        self._last = 0
+
+    def check(self):
+        """
+            Raises DownloadCancelled if the token has been cancelled.
+        """
+        self.token.check()
+
+    def callback(self, start=0, end=100, stage=''):
+        """
+            Returns a GDAL progress function for a stage that covers start
+            to end percent of the download.
+
+            ...
+            Parameters
+            ----------
+            start : float
+                Percent of the download when the stage starts.
+            end : float
+                Percent of the download when the stage ends.
+            stage : String
+                Name of the stage, e.g. warp.
+        """
+        return self.part_callbacks(start, end, 1, stage)[0]
+
+    def part_callbacks(self, start, end, parts, stage=''):
+        """
+            Returns a GDAL progress function for each of the parts of a stage
+            that run at the same time, the stage progress is the mean of the
+            parts.
+
+            ...
+            Parameters
+            ----------
+            start : float
+                Percent of the download when the stage starts.
+            end : float
+                Percent of the download when the stage ends.
+            parts : int
+                Number of parts of the stage.
+            stage : String
+                Name of the stage, e.g. warp.
+        """
+        fractions = [0.0] * parts
+
+        def _make(i):
+            def _callback(complete, message=None, data=None):
+                fractions[i] = complete
+                self._emit(start + (end - start) * sum(fractions) / parts, stage)
+                return 0 if self.token.cancelled else 1
+            return _callback
+        return [_make(i) for i in range(parts)]
+
+    def children(self, parts):
+        """
+            Returns a Progress for each of the downloads that run at the same
+            time as parts of this one, the reported percent is the mean of
+            the parts. Each child has its own token, cancelled with this one,
+            so a failed part can stop the others without cancelling this
+            download's token.
+
+            ...
+            Parameters
+            ----------
+            parts : int
+                Number of downloads.
+        """
+        percents = [0.0] * parts
+
+        def _make(i):
+            def _report(state):
+                percents[i] = state['percent']
+                if self.report is not None:
+                    self.report({**state, 'percent': sum(percents) / parts})
+            return Progress(report=_report, token=CancelToken(parent=self.token),
+                            bytes_counter=self.bytes_counter, interval=self.interval)
+        return [_make(i) for i in range(parts)]
+
+    def count_bytes(self, bytes_counter):
+        """
+            Counts the downloaded bytes and speed with bytes_counter from
+            now on, e.g. once the files read by the download are known.
+
+            ...
+            Parameters
+            ----------
+            bytes_counter : function
+                Function that returns the total bytes downloaded so far.
+        """
+        with self._lock:
+            self.bytes_counter = bytes_counter
+            self._bytes0 = bytes_counter()
+            self._started = time.time()
+
+    def _emit(self, percent, stage):
+        if self.report is None:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._last < self.interval and percent < 100:
+                return
+            self._last = now
+        downloaded = self.bytes_counter() - self._bytes0 if self.bytes_counter is not None else 0
+        self.report({'stage': stage,
+                     'percent': min(percent, 100),
+                     'bytes': downloaded,
+                     'mb_per_s': downloaded / 1e6 / max(now - self._started, 1e-3)})
@@ -0,0 +1,245 @@
+"""
+    Priority scheduler of the download jobs.
+
+    The downloads are queued instead of being started all at once. A
+    bounded number of them run at the same time, with a cap per source
+    host so they do not fight for the same bandwidth. Interactive requests
+    go before batch ones and always have a worker reserved for them. Among
+    jobs of the same priority, the owner with fewer running jobs is served
+    first, so one large batch does not hold all the workers.
+"""
+import queue
+import itertools
+import threading
+
+INTERACTIVE = 0
+BATCH = 10
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+class ScheduledJob:
+    """
+        Class used to hold a job of the scheduler and its state.
+
+        ...
+
+        Attributes
+        ----------
+        job_id : int
+            Id of the job in the scheduler.
+        runnable : object
+            Object whose run() method does the job, and optionally a
+            cancel() method that stops it.
+        name : String
+            Name of the job shown in the queue view.
+        priority : int
+            INTERACTIVE or BATCH, lower values run first.
+        host : String
+            Host the job downloads from.
+        owner : String
+            Group of jobs the job belongs to, used to share the workers.
+        state : String
+            One of QUEUED, RUNNING, DONE or CANCELLED.
+    """
+    def __init__(self, job_id, runnable, name, priority, host, owner):
+        self.job_id = job_id
+        self.runnable = runnable
+        self.name = name
+        self.priority = priority
+        self.host = host
+        self.owner = owner
+        self.state = QUEUED
+        self.cancelled = False
+
+class DownloadScheduler:
+    """
+        Class used to run the download jobs by priority with a bounded
+        queue, a cap of concurrent jobs per host and fair sharing of the
+        workers.
+
+        ...
+
+        Attributes
+        ----------
+        max_workers : int
+            Maximum number of jobs running at the same time.
+        max_queued : int
+            Maximum number of jobs waiting to run.
+        host_limits : Dict
+            Maximum number of jobs running at the same time by host.
+        default_host_limit : int
+            Maximum number of running jobs for hosts not in host_limits.
+        reserved : int
+            Workers that batch jobs can not use, kept for interactive ones.
+        on_change : function
+            Function called without arguments when the queue changes.
+        history : int
+            Number of finished jobs kept in the queue view.
+
+        Methods
+        -------
+        submit(runnable, name, priority, host, owner):
+            Queues a job and returns its id.
+        cancel(job_id):
+            Removes a queued job or stops a running one.
+        cancel_all():
+            Cancels all the queued and running jobs.
+        snapshot():
+            Returns the jobs of the queue view.
+        active():
+            Returns the number of queued and running jobs.
+    """
+    def __init__(self, max_workers=3, max_queued=50, host_limits=None, default_host_limit=2,
+                 reserved=1, on_change=None, history=20):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.host_limits = dict(host_limits or {})
+        self.default_host_limit = default_host_limit
+        self.reserved = reserved
+        self.on_change = on_change
+        self.history = history
+
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._jobs = list()
+
+    def submit(self, runnable, name, priority=BATCH, host=None, owner=None):
+        """
+            Queues a job and returns its id, raising queue.Full if there are
+            already max_queued jobs waiting.
+
+            ...
+            Parameters
+            ----------
+            runnable : object
+                Object whose run() method does the job, and optionally a
+                cancel() method that stops it.
+            name : String
+                Name of the job shown in the queue view.
+            priority : int
+                INTERACTIVE or BATCH, lower values run first.
+            host : String
+                Host the job downloads from.
+            owner : String
+                Group of jobs the job belongs to, each job is its own group
+                if None.
+        """
+        with self._lock:
+            if sum(job.state == QUEUED for job in self._jobs) >= self.max_queued:
+                raise queue.Full('Download queue is full ({} jobs)'.format(self.max_queued))
+            job_id = next(self._ids)
+            self._jobs.append(ScheduledJob(job_id, runnable, name, priority, host,
+                                           owner if owner is not None else job_id))
+            self._dispatch()
+        self._changed()
+        return job_id
+
+    def cancel(self, job_id):
+        """
+            Removes a queued job or stops a running one.
+
+            ...
+            Parameters
+            ----------
+            job_id : int
+                Id of the job.
+        """
+        with self._lock:
+            for job in self._jobs:
+                if job.job_id == job_id:
+                    self._cancel(job)
+        self._changed()
+
+    def cancel_all(self):
+        """
+            Cancels all the queued and running jobs.
+        """
+        with self._lock:
+            for job in self._jobs:
+                self._cancel(job)
+        self._changed()
+
+    def snapshot(self):
+        """
+            Returns a list of dictionaries with the id, name, priority and
+            state of the jobs, running first, then queued in run order, then
+            the latest finished.
+        """
+        with self._lock:
+            queued = sorted([job for job in self._jobs if job.state == QUEUED],
+                            key=lambda job: (job.priority, job.job_id))
+            running = [job for job in self._jobs if job.state == RUNNING]
+            finished = [job for job in self._jobs if job.state in (DONE, CANCELLED)]
+            return [{'job_id': job.job_id, 'name': job.name, 'priority': job.priority,
+                     'state': job.state} for job in running + queued + finished[::-1]]
+
+    def active(self):
+        """
+            Returns the number of queued and running jobs.
+        """
+        with self._lock:
+            return sum(job.state in (QUEUED, RUNNING) for job in self._jobs)
+
+    def _cancel(self, job):
+        if job.state == QUEUED:
+            job.state = CANCELLED
+            if hasattr(job.runnable, 'cancel'):
+                job.runnable.cancel()
+        elif job.state == RUNNING and hasattr(job.runnable, 'cancel'):
+            job.cancelled = True
+            job.runnable.cancel()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def _pick(self):
+        """
+            Returns the next queued job that can run, or None.
+        """
+        running = [job for job in self._jobs if job.state == RUNNING]
+        batch_running = sum(job.priority > INTERACTIVE for job in running)
+        candidates = list()
+        for job in self._jobs:
+            if job.state != QUEUED:
+                continue
+            ## Interactive jobs can also use the reserved workers over the host cap.
+            host_limit = self.host_limits.get(job.host, self.default_host_limit)
+            if job.priority == INTERACTIVE:
+                host_limit += self.reserved
+            if sum(other.host == job.host for other in running) >= host_limit:
+                continue
+            if job.priority > INTERACTIVE and batch_running >= max(self.max_workers - self.reserved, 1):
+                continue
+            owner_running = sum(other.owner == job.owner for other in running)
+            candidates.append(((job.priority, owner_running, job.job_id), job))
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda candidate: candidate[0])[1]
+
+    def _dispatch(self):
+        """
+            Starts queued jobs while there are free workers, the lock must be
+            held.
+        """
+        while sum(job.state == RUNNING for job in self._jobs) < self.max_workers:
+            job = self._pick()
+            if job is None:
+                break
+            job.state = RUNNING
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        try:
+            job.runnable.run()
+        finally:
+            with self._lock:
+                job.state = CANCELLED if job.cancelled else DONE
+                finished = [other for other in self._jobs if other.state in (DONE, CANCELLED)]
+                for other in finished[:max(len(finished) - self.history, 0)]:
+                    self._jobs.remove(other)
+                self._dispatch()
+            self._changed()
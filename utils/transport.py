@@ -0,0 +1,291 @@
+"""
+    Shared HTTP transport for all the catalog and download calls.
+
+    A single requests.Session keeps the connections to the GISMGR servers
+    alive, so paginated listings and repeated queries skip the TCP and TLS
+    handshakes. Requests are limited per host, and the idempotent ones are
+    retried with exponential backoff and jitter when the server answers 429
+    or 5xx. POSTs are sent once, so a sign in or a job submission that timed
+    out is never sent twice.
+"""
+import time
+import random
+import threading
+import requests
+
+from urllib.parse import urlparse, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+""" Workers used to prefetch the pages of a paginated listing """
+PAGE_WORKERS = 8
+
+class HttpTransport:
+    """
+        Class used to send the HTTP requests of the plugin through a pool of
+        keep-alive connections.
+
+        ...
+
+        Attributes
+        ----------
+        session : requests.Session
+            Session holding the pool of connections.
+        max_per_host : int
+            Maximum number of concurrent requests to the same host.
+        retries : int
+            Number of retries of the idempotent requests on connection
+            errors and retryable statuses.
+        backoff : float
+            Base delay in seconds of the exponential backoff.
+        max_backoff : float
+            Maximum delay in seconds between two retries.
+        timeout : float
+            Seconds of waiting before claiming a time out, if the caller
+            does not give one.
+
+        Methods
+        -------
+        request(method, url, retries, **kwargs):
+            Sends a request, waiting for a free slot of its host and retrying
+            it when it is idempotent and fails with a retryable error.
+        get(url, params, **kwargs):
+            Sends a GET request.
+        post(url, **kwargs):
+            Sends a POST request.
+        head(url, **kwargs):
+            Sends a HEAD request.
+        set_host_limit(host, limit):
+            Sets the maximum number of concurrent requests to a host.
+        stats():
+            Returns the counters of requests, reused connections and retries.
+    """
+    def __init__(self, pool_size=16, max_per_host=6, retries=4, backoff=0.5,
+                 max_backoff=30, timeout=60):
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+        self._lock = threading.Lock()
+        self._host_limits = dict()
+        self._host_slots = dict()
+        self._counters = {'requests': 0, 'retries': 0}
+
+    def set_host_limit(self, host, limit):
+        """
+            Sets the maximum number of concurrent requests to a host, it only
+            applies to the requests started after the call.
+
+            ...
+            Parameters
+            ----------
+            host : String
+                Network location of the host, e.g. data.apps.fao.org.
+            limit : int
+                Maximum number of concurrent requests.
+        """
+        with self._lock:
+            self._host_limits[host] = limit
+            self._host_slots.pop(host, None)
+
+    def _slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                limit = self._host_limits.get(host, self.max_per_host)
+                self._host_slots[host] = threading.BoundedSemaphore(limit)
+            return self._host_slots[host]
+
+    def _delay(self, attempt, resp=None):
+        retry_after = resp.headers.get('Retry-After') if resp is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, retries=None, **kwargs):
+        """
+            Sends a request, waiting for a free slot of its host and retrying
+            it when it fails with a connection error or a retryable status.
+            The last response (or exception) is returned (or raised) once the
+            retries are exhausted. Only GET, HEAD and OPTIONS are retried
+            unless retries is given.
+
+            ...
+            Parameters
+            ----------
+            method : String
+                HTTP method of the request.
+            url : String
+                URL of the request.
+            retries : int
+                Number of retries of this request, by default the retries of
+                the transport for idempotent methods and 0 for the others.
+            kwargs : Dict
+                Keyword arguments passed to requests.Session.request.
+        """
+        if retries is None:
+            retries = self.retries if method.upper() in IDEMPOTENT_METHODS else 0
+        kwargs.setdefault('timeout', self.timeout)
+        slot = self._slot(url)
+        attempt = 0
+        while True:
+            with self._lock:
+                self._counters['requests'] += 1
+            try:
+                with slot:
+                    resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= retries:
+                    raise
+                delay = self._delay(attempt)
+            else:
+                if resp.status_code not in RETRY_STATUSES or attempt >= retries:
+                    return resp
+                delay = self._delay(attempt, resp)
+                resp.close()
+            with self._lock:
+                self._counters['retries'] += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, url, params=None, **kwargs):
+        """
+            Sends a GET request, see request().
+        """
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, **kwargs):
+        """
+            Sends a POST request, see request().
+        """
+        return self.request('POST', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """
+            Sends a HEAD request, see request().
+        """
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('HEAD', url, **kwargs)
+
+    def stats(self):
+        """
+            Returns the counters of requests sent, connections opened,
+            requests served by an already open connection and retries.
+        """
+        opened = 0
+        served = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                served += pool.num_requests
+        with self._lock:
+            return {'requests': self._counters['requests'],
+                    'connections': opened,
+                    'reused_connections': max(served - opened, 0),
+                    'retries': self._counters['retries']}
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    """
+        Returns the transport shared by the whole plugin, creating it on the
+        first call.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HttpTransport()
+        return _transport
+
+def _next_href(page):
+    for link in page.get('links', []):
+        if link.get('rel') == 'next':
+            return link.get('href')
+    return None
+
+""" Keys of the GISMGR listings with the total number of items of all the pages """
+TOTAL_KEYS = ('totalItems', 'totalCount')
+
+def _total_items(page):
+    for key in TOTAL_KEYS:
+        if isinstance(page.get(key), int):
+            return page[key]
+    return None
+
+def _offset_limit(url):
+    query = {k.lower(): v for k, v in parse_qsl(urlparse(url).query)}
+    try:
+        return int(query['offset']), int(query['limit'])
+    except (KeyError, ValueError):
+        return None
+
+def _page_urls(next_url, stop):
+    """
+        Builds the URLs of the pages from next_url up to the stop offset by
+        moving the offset parameter of next_url.
+    """
+    parsed = urlparse(next_url)
+    query = parse_qsl(parsed.query, keep_blank_values=True)
+    offset, limit = _offset_limit(next_url)
+    urls = list()
+    for page_offset in range(offset, stop, limit):
+        page_query = [(k, str(page_offset) if k.lower() == 'offset' else v) for k, v in query]
+        urls.append(parsed._replace(query=urlencode(page_query)).geturl())
+    return urls
+
+def collect_pages(url, fetch, max_workers=PAGE_WORKERS):
+    """
+        Returns, in order, all the pages of a paginated listing that follows
+        links[rel=next]. When the first page gives the total number of items
+        and the next link has offset/limit parameters, the pages within the
+        total are fetched concurrently in windows of max_workers pages, which
+        stop at the first page without a next link. The next links are still
+        followed after the planned pages, so a wrong total never truncates
+        the listing. Otherwise the listing is followed one page at a time, so
+        no page past the end is requested.
+
+        ...
+        Parameters
+        ----------
+        url : String
+            URL of the first page.
+        fetch : function
+            Function that receives the URL of a page and returns its content,
+            a dictionary with the items and links of the page.
+        max_workers : int
+            Maximum number of pages fetched at the same time.
+    """
+    pages = [fetch(url)]
+    next_url = _next_href(pages[0])
+    offset_limit = _offset_limit(next_url) if next_url is not None else None
+    total = _total_items(pages[0])
+
+    if offset_limit is not None and offset_limit[1] > 0 and total is not None and max_workers > 1:
+        planned = _page_urls(next_url, total)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for start in range(0, len(planned), max_workers):
+                for page in pool.map(fetch, planned[start:start + max_workers]):
+                    pages.append(page)
+                    next_url = _next_href(page)
+                    if next_url is None:
+                        break
+                if next_url is None:
+                    break
+
+    while next_url is not None:
+        pages.append(fetch(next_url))
+        next_url = _next_href(pages[-1])
+    return pages
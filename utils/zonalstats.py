@@ -0,0 +1,198 @@
+"""
+    Streaming zonal statistics of the downloaded bands.
+
+    The statistics of a band are accumulated over the blocks it is read in,
+    so a time series over a large region and a long period is computed
+    without keeping the warped rasters in memory. Each band keeps its count,
+    sum, spread, minimum and maximum, and the counts of its values when
+    percentiles are requested.
+"""
+import re
+
+import numpy as np
+
+STATISTICS = ['minimum', 'maximum', 'mean', 'std', 'count', 'sum', 'median']
+HISTOGRAM_BINS = 2048
+
+""" Distinct values counted exactly before falling back to a histogram """
+MAX_DISTINCT = 65536
+
+_PERCENTILE = re.compile(r'^p(\d{1,2}(\.\d+)?|100)$')
+
+def valid_statistic(name):
+    """
+        Returns if name is one of STATISTICS or a percentile like p10 or
+        p97.5.
+    """
+    return name in STATISTICS or _PERCENTILE.match(str(name)) is not None
+
+def needs_histogram(names):
+    """
+        Returns if any of the statistics in names is a percentile.
+    """
+    return any(name == 'median' or _PERCENTILE.match(str(name)) is not None for name in names)
+
+class RunningStats:
+    """
+        Class used to accumulate the statistics of a band over the blocks
+        it is read in.
+
+        The spread is merged with the parallel formula of Chan et al., which
+        stays accurate where a plain sum of squares loses precision.
+
+        The percentiles are exact, computed like np.percentile, as long as
+        the band has at most max_distinct distinct values, which is the case
+        of the scaled integers of WaPOR. Past that (e.g. continuous agERA5
+        data) they are approximated with a histogram of bins bins, which
+        starts on the range of the values and doubles its bin width whenever
+        values fall outside of it. Its resolution is then the range of the
+        values over bins, so a few far outliers make it coarse; more bins
+        make it finer.
+
+        ...
+
+        Attributes
+        ----------
+        bins : int
+            Number of bins of the histogram, None to not compute percentiles.
+        max_distinct : int
+            Maximum number of distinct values counted exactly.
+
+        Methods
+        -------
+        update(values):
+            Adds the valid values of a block.
+        percentile(q):
+            Returns the q-th percentile of the values.
+        result(names):
+            Returns a dictionary with the requested statistics.
+    """
+    def __init__(self, bins=None, max_distinct=MAX_DISTINCT):
+        self.bins = bins
+        self.max_distinct = max_distinct
+        self.count = 0
+        self.sum = 0.0
+        self.minimum = np.nan
+        self.maximum = np.nan
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._distinct = None
+        self._counts = None
+        self._low = None
+        self._width = None
+
+    @property
+    def mean(self):
+        return self._mean if self.count > 0 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / self.count) if self.count > 0 else np.nan
+
+    def update(self, values):
+        """
+            Adds the valid values of a block.
+
+            ...
+            Parameters
+            ----------
+            values : np.ndarray
+                Values of the block, without nodata.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        n = values.size
+        if n == 0:
+            return
+        block_mean = values.mean()
+        block_m2 = np.square(values - block_mean).sum()
+        total = self.count + n
+        delta = block_mean - self._mean
+        self._m2 += block_m2 + delta ** 2 * self.count * n / total
+        self._mean += delta * n / total
+        self.count = total
+        self.sum += values.sum()
+        self.minimum = np.nanmin([self.minimum, values.min()])
+        self.maximum = np.nanmax([self.maximum, values.max()])
+        if self.bins is None:
+            return
+        if self._counts is not None:
+            self._histogram(values)
+            return
+        distinct, counts = np.unique(values, return_counts=True)
+        if self._distinct is not None:
+            distinct, inverse = np.unique(np.concatenate([self._distinct[0], distinct]), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate([self._distinct[1], counts])).astype(np.int64)
+        if distinct.size <= self.max_distinct:
+            self._distinct = (distinct, counts)
+        else:
+            self._distinct = None
+            self._histogram(distinct, counts)
+
+    def _histogram(self, values, weights=None):
+        low, high = values.min(), values.max()
+        if self._counts is None:
+            self._counts = np.zeros(self.bins, dtype=np.int64)
+            self._low = low
+            self._width = max((high - low) / self.bins, np.finfo(np.float64).eps * max(abs(low), 1.0))
+        ## Double the bin width towards the side the values are on until they fit.
+        while low < self._low or high >= self._low + self.bins * self._width:
+            if low < self._low:
+                counts = np.concatenate([np.zeros(self.bins, dtype=np.int64), self._counts])
+                self._low -= self.bins * self._width
+            else:
+                counts = np.concatenate([self._counts, np.zeros(self.bins, dtype=np.int64)])
+            self._counts = counts.reshape(self.bins, 2).sum(axis=1)
+            self._width *= 2
+        index = np.minimum(((values - self._low) / self._width).astype(np.int64), self.bins - 1)
+        self._counts += np.bincount(index, weights=weights, minlength=self.bins).astype(np.int64)
+
+    def percentile(self, q):
+        """
+            Returns the q-th percentile of the values, exact like
+            np.percentile while the distinct values are counted, otherwise
+            interpolated inside the histogram bin it falls in.
+
+            ...
+            Parameters
+            ----------
+            q : float
+                Percentile between 0 and 100.
+        """
+        if self.count == 0:
+            return np.nan
+        if self._distinct is not None:
+            values, counts = self._distinct
+            cumulative = np.cumsum(counts)
+            position = q / 100 * (self.count - 1)
+            lower = values[np.searchsorted(cumulative, np.floor(position), side='right')]
+            upper = values[np.searchsorted(cumulative, np.ceil(position), side='right')]
+            return float(lower + (upper - lower) * (position - np.floor(position)))
+        if self._counts is None:
+            return np.nan
+        target = q / 100 * self.count
+        cumulative = np.cumsum(self._counts)
+        i = min(int(np.searchsorted(cumulative, target)), self.bins - 1)
+        before = cumulative[i - 1] if i > 0 else 0
+        fraction = (target - before) / self._counts[i] if self._counts[i] > 0 else 0.0
+        value = self._low + (i + fraction) * self._width
+        return float(np.clip(value, self.minimum, self.maximum))
+
+    def result(self, names):
+        """
+            Returns a dictionary with the requested statistics.
+
+            ...
+            Parameters
+            ----------
+            names : List
+                Names of the statistics, see valid_statistic.
+        """
+        out = dict()
+        for name in names:
+            if name == 'median':
+                out[name] = self.percentile(50)
+            elif name in STATISTICS:
+                out[name] = getattr(self, name)
+            else:
+                out[name] = self.percentile(float(name[1:]))
+        return out
@@ -23,7 +23,7 @@
 """
 from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication, QDate, QTime, QDateTime, Qt
 from qgis.PyQt.QtGui import QIcon 
-from qgis.PyQt.QtWidgets import QAction, QApplication, QMessageBox, QTableWidgetItem
+from qgis.PyQt.QtWidgets import QAction, QApplication, QMessageBox, QTableWidgetItem, QListWidgetItem
 
 from qgis.analysis import QgsRasterCalculatorEntry, QgsRasterCalculator
 from qgis.core import QgsRasterLayer, QgsMapLayerProxyModel, QgsCoordinateReferenceSystem
@@ -38,17 +38,21 @@ import os.path
 import os  
 from itertools import compress
 
-import tempfile
+import queue
+import re
 import json
-from shapely.geometry import mapping
-from shapely.wkt import loads
+import shapely
 
-from PyQt5.QtCore import pyqtSignal, QRunnable, pyqtSlot, QThreadPool, QObject	
+from PyQt5.QtCore import pyqtSignal, QRunnable, pyqtSlot, QObject	
 
-from .utils.wapordl_ext import wapor_map 
+from .utils.wapordl_ext import wapor_map, sparse_vrt, NoFilesFound, OUTPUT_PROFILES, DEFAULT_PROFILE, source_host, request_hash, METADATA_INDEX, RASTER_INVENTORY, BLOCK_CACHE
+from .utils.progress import Progress, CancelToken
+from .utils.scheduler import DownloadScheduler, INTERACTIVE, BATCH
 
 try:
     from .utils.managers import Wapor2APIManager, Wapor3APIManager, FileManager, CanvasManager
+    from .utils.cache import CatalogCache
+    from .utils.journal import JobJournal, DONE, FAILED
     from .utils.indicators import IndicatorCalculator, INDICATORS_INFO
     from .utils.tools import CoordinatesSelectorTool
 
@@ -77,36 +81,114 @@ class WorkerSignals(QObject):
     - result
         Not implemented
     - progress
-        Not implemented
+        Dictionary with the stage, percent, downloaded bytes and MB/s
+        of the download
     '''
     finished = pyqtSignal(object)
     result = pyqtSignal(object)
-    progress = pyqtSignal(int)
+    progress = pyqtSignal(object)
     error = pyqtSignal(object)
 
+class SchedulerSignals(QObject):
+    '''
+    Defines the signals available from the download scheduler.
+
+    Supported signals are:
+    - changed
+        Refresh the download queue view
+    '''
+    changed = pyqtSignal()
+
 class DownloadThread(QRunnable):
 
-    def __init__(self, region, mapset, folder, file_name, period):
+    def __init__(self, region, mapset, folder, file_name, period, incremental=False,
+                 journal=None, job_id=None, token=None, dtype_policy='exact', profile=DEFAULT_PROFILE):
         super().__init__()
         self.region = region
         self.mapset = mapset
         self.folder = folder
         self.file_name = file_name
         self.period = period
+        self.incremental = incremental
+        self.dtype_policy = dtype_policy
+        self.profile = profile
+        self.journal = journal
+        self.job_id = job_id
         self.signals = WorkerSignals()
+        self.started = False
+        self.progress = Progress(report=self.reportProgress, token=CancelToken(parent=token))
+        self.units_done = 0
+        self.units_total = 1
+
+    def cancel(self):
+        """
+            Stops the download, a download that has not started yet is
+            abandoned in the job journal.
+        """
+        self.progress.token.cancel()
+        if not self.started:
+            if self.journal is not None:
+                self.journal.abandon(self.job_id)
+            self.signals.error.emit(f'Download of {self.mapset} cancelled')
+
+    def reportProgress(self, info):
+        """
+            Emits the progress of the running unit of work as progress of
+            the whole download.
+        """
+        percent = (self.units_done + info['percent'] / 100) / self.units_total * 100
+        self.signals.progress.emit(dict(info, percent=percent, mapset=self.mapset))
+
+    @staticmethod
+    def splitPeriod(period):
+        """
+            Splits a period in calendar years, the units of work recorded in
+            the job journal.
+        """
+        return ['{}/{}'.format(max(period[0], '{}-01-01'.format(year)),
+                               min(period[1], '{}-12-31'.format(year)))
+                for year in range(int(period[0][:4]), int(period[1][:4]) + 1)]
 
     def downloadFromWapordl(self, region, mapset, folder, file_name, period):
         return wapor_map(region=region, variable=mapset, folder=folder,
-                         file_name=file_name, period=period, seperate_unscale=True)
+                         file_name=file_name, period=period, seperate_unscale=True,
+                         incremental=self.incremental, dtype_policy=self.dtype_policy,
+                         profile=self.profile, progress=self.progress)
 
     @pyqtSlot()
     def run(self):
         try:
             print("Thread run")
-            result = self.downloadFromWapordl(self.region, self.mapset, self.folder,
-                                            self.file_name, self.period)
+            self.started = True
+            self.progress.check()
+            if self.journal is None:
+                result = self.downloadFromWapordl(self.region, self.mapset, self.folder,
+                                                self.file_name, self.period)
+            else:
+                units = self.journal.pending(self.job_id)
+                self.units_total = max(len(units), 1)
+                for units_done, unit in enumerate(units):
+                    self.units_done = units_done
+                    try:
+                        result = self.downloadFromWapordl(self.region, self.mapset, self.folder,
+                                                          self.file_name, unit.split('/'))
+                    except NoFilesFound:
+                        ## A year without rasters is an empty unit, not a failed one.
+                        result = []
+                    except Exception as e:
+                        if not self.progress.token.cancelled:
+                            self.journal.mark(self.job_id, unit, FAILED, str(e))
+                        raise
+                    self.journal.mark(self.job_id, unit, DONE, json.dumps(result))
+                self.journal.close_job(self.job_id)
             self.signals.finished.emit(self.file_name+' '+self.mapset)
         except Exception as e:
+            if self.progress.token.cancelled:
+                print(f"Download of {self.mapset} cancelled")
+                if self.journal is not None:
+                    self.journal.abandon(self.job_id)
+                self.signals.error.emit(f'Download of {self.mapset} cancelled')
+                return
             print(f"An exception occurred: {e}")
             self.signals.error.emit(str(e))
 
@@ -127,7 +209,8 @@ class WAPlugin:
         # initialize plugin directory
         self.plugin_dir = os.path.dirname(__file__)
 
-        self.threadpool = QThreadPool()
+        self.scheduler_signals = SchedulerSignals()
+        self.scheduler = DownloadScheduler(on_change=self.scheduler_signals.changed.emit)
 
         # initialize locale
         locale = QSettings().value('locale/userLocale')[0:2]
@@ -181,8 +264,12 @@ class WAPlugin:
 
         self.rasters_path = "layers"
 
-        self.api2_manag = Wapor2APIManager()
-        self.api3_manag = Wapor3APIManager()
+        self.catalog_cache = CatalogCache(os.path.join(self.plugin_dir, 'cache'))
+        self.api2_manag = Wapor2APIManager(cache=self.catalog_cache)
+        self.api3_manag = Wapor3APIManager(cache=self.catalog_cache)
+        self.journal = JobJournal(os.path.join(self.plugin_dir, 'cache'))
+        self.inflight = dict()
+        self.cancel_token = CancelToken()
 
         self.ws2Initialized = False
         self.ws3Initialized = False
@@ -304,6 +391,9 @@ class WAPlugin:
                 self.tr(u'&WAPlugin'),
                 action)
             self.iface.removeToolBarIcon(action)
+        self.scheduler.cancel_all()
+        self.cancel_token.cancel()
+        BLOCK_CACHE.close()
 
     def updateWaporParams(self):
         self.isWapor2 = self.dlg.wapor2radioButton.isChecked()
@@ -427,6 +517,21 @@ class WAPlugin:
             self.dlg.progressLabel.setText ('Loaded data categories!')
             self.dlg.downloadButton_2.setEnabled(True)
 
+    def refreshCatalog(self):
+        """
+            Drops the cached catalog of the active WaPOR version and pulls the
+            workspaces again from the server.
+        """
+        if self.dlg.tabManager.currentIndex() == 1:
+            self.api2_manag.refresh_catalog()
+            self.ws2Initialized = False
+        elif self.dlg.tabManager.currentIndex() == 2:
+            self.api3_manag.refresh_catalog()
+            METADATA_INDEX.refresh()
+            RASTER_INVENTORY.refresh()
+            self.ws3Initialized = False
+        self.listWorkspaces()
+
     def listRasterMemory(self):
         """
             Calls the list rasters function of the file manager and updates 
@@ -889,10 +994,19 @@ class WAPlugin:
 
         self.dlg.cancelButton.setEnabled(True)
 
+        job_id = self.journal.open_job('wapor2-crop', dict(params, dimensions=dimensions2crop))
+        self.journal.plan(job_id, [json.dumps(dimensions_payload) for dimensions_payload in dimensions2crop])
+        pending = set(self.journal.pending(job_id))
+
         for i, dimensions_payload in enumerate(dimensions2crop):
             member_frame = dimensions_payload[0]["values"][0] if len(dimensions_payload) == 1 \
                 else dimensions_payload[1]["values"][0] + dimensions_payload[0]["values"][0] 
             
+            unit = json.dumps(dimensions_payload)
+            if unit not in pending:
+                print('Already downloaded {}, skipping'.format(member_frame))
+                continue
+
             print(member_frame)
             progress_value = 20 + ((i+1)/len(dimensions2crop))*60
             self.dlg.progressBar.setValue(progress_value)
@@ -912,6 +1026,7 @@ class WAPlugin:
 
             if not rast_url == None:
                 self.file_manag.download_raster(rast_url, params['rast_directory'])
+                self.journal.mark(job_id, unit, DONE, params['outputFileName'])
                 
                 self.dlg.progressBar.setValue(100)
                 self.dlg.progressLabel.setText('Download {}/{} Complete'.format(i+1, len(dimensions2crop)))
@@ -919,6 +1034,7 @@ class WAPlugin:
                 self.listRasterMemory()
                 self.indicatorChange()
             else:
+                self.journal.mark(job_id, unit, FAILED)
                 self.dlg.progressBar.setValue(0)
                 self.dlg.progressLabel.setText('Download {}/{} Complete'.format(i+1, len(dimensions2crop)))
 
@@ -927,6 +1043,10 @@ class WAPlugin:
                 self.dlg.progressLabel.setText('Download {}/{} Complete. Cancelled by user'.format(i+1, len(dimensions2crop)))
                 break
         
+        if self.cancelDownload:
+            self.journal.abandon(job_id)
+        else:
+            self.journal.close_job(job_id)
         self.cancelDownload = False
         self.dlg.downloadButton.setEnabled(True)
         self.dlg.cancelButton.setEnabled(False)
@@ -961,77 +1081,267 @@ class WAPlugin:
             self.dlg.progressLabel.setText (f'Downloading Raster {self.mapset}')
 
             print('Starting thread')
-            thread = DownloadThread(bounding_box, self.mapset,
-                                    self.dlg.downloadFolderExplorer_2.filePath(),
-                                    self.dlg.outputRasterName_2.text(),
-                                    period)
-            thread.signals.finished.connect(self.thread_complete)
-            thread.signals.error.connect(self.thread_complete)
-            self.threadpool.start(thread)
+            self.startDownloadJob(bounding_box, self.mapset,
+                                  self.dlg.downloadFolderExplorer_2.filePath(),
+                                  self.dlg.outputRasterName_2.text(),
+                                  period, self.dlg.incrementalCheckBox_2.isChecked(),
+                                  dtype_policy=self.dtypePolicy(),
+                                  profile=self.dlg.profileComboBox_2.currentText())
             
+        elif self.dlg.perFeatureCheckBox_2.isChecked():
+
+            self.downloadPerFeature(self.dlg.shapeLayerComboBox_2.currentLayer(), period)
+
         else:
 
-            # Create a temporary directory using the tempfile module
-            with tempfile.TemporaryDirectory() as temp_dir:
-                layer = self.dlg.shapeLayerComboBox_2.currentLayer()
-
-                # Define the path for the output GeoJSON file within the temporary directory
-                geojson_path = f"{temp_dir}.geojson"
-
-                # Create a list to store the GeoJSON features
-                features = []
-
-                # Loop through the features in the shapefile
-                for feature in layer.getFeatures():
-                    # Convert the QGIS geometry to a Shapely object
-                    shapely_geom = loads(feature.geometry().asWkt())
-
-                    # Convert the Shapely object back to GeoJSON
-                    geojson_geom = mapping(shapely_geom)
-
-                    # Add the GeoJSON feature to the list
-                    features.append({
-                        "type": "Feature",
-                        "properties": feature.attributes(),
-                        "geometry": geojson_geom
-                    })
-
-                # Write the GeoJSON features to a file
-                with open(geojson_path, "w") as f:
-                    json.dump({"type": "FeatureCollection", "features": features}, f)
-
-                print(geojson_path)
-
-                # Download data
-                self.dlg.progressBar.setValue(10)
-                self.dlg.progressLabel.setText (f'Downloading Raster {self.mapset} . . .')
-               
-                print('Starting thread')
-                thread = DownloadThread(geojson_path, self.mapset,
-                                        self.dlg.downloadFolderExplorer_2.filePath(),
-                                        self.dlg.outputRasterName_2.text(),
-                                        period)
-                thread.signals.finished.connect(self.thread_complete)
-                thread.signals.error.connect(self.thread_complete)
-                self.threadpool.start(thread)
+            layer = self.dlg.shapeLayerComboBox_2.currentLayer()
+
+            # Pass the polygons of all the features as a single shapely geometry
+            geometries = [self.featureGeometry(feature) for feature in layer.getFeatures()]
+            region = shapely.multipolygons(shapely.get_parts(shapely.get_parts(geometries)))
+
+            # Download data
+            self.dlg.progressBar.setValue(10)
+            self.dlg.progressLabel.setText (f'Downloading Raster {self.mapset} . . .')
+
+            print('Starting thread')
+            self.startDownloadJob(region, self.mapset,
+                                  self.dlg.downloadFolderExplorer_2.filePath(),
+                                  self.dlg.outputRasterName_2.text(),
+                                  period, self.dlg.incrementalCheckBox_2.isChecked(),
+                                  dtype_policy=self.dtypePolicy(),
+                                  profile=self.dlg.profileComboBox_2.currentText())
+
+    def dtypePolicy(self):
+        """
+            Returns the data type policy of the downloaded files, compact
+            keeps them small, exact writes 64 bits floats.
+        """
+        return 'compact' if self.dlg.compactCheckBox_2.isChecked() else 'exact'
+
+    @staticmethod
+    def featureGeometry(feature):
+        """
+            Returns the geometry of a QGIS feature as a shapely geometry,
+            read from its WKB.
+        """
+        return shapely.from_wkb(bytes(feature.geometry().asWkb()))
+
+    def downloadPerFeature(self, layer, period):
+        """
+            Downloads each feature of a layer on its own extent, so the data
+            between scattered polygons is not downloaded. The downloads are
+            queued as batch jobs of the same owner, the output of each one is
+            named by the selected field, and they are optionally merged into
+            a VRT per date once all of them finished.
+        """
+        folder = self.dlg.downloadFolderExplorer_2.filePath()
+        base_name = self.dlg.outputRasterName_2.text()
+        field = self.dlg.featureFieldComboBox_2.currentField()
+        incremental = self.dlg.incrementalCheckBox_2.isChecked()
+        dtype_policy = self.dtypePolicy()
+        profile = self.dlg.profileComboBox_2.currentText()
+        requests = []
+        for feature in layer.getFeatures():
+            label = feature[field] if field else feature.id()
+            label = re.sub(r'[^\w.-]', '_', str(label))
+            file_name = '{}_{}'.format(base_name, label) if base_name else label
+            if file_name in [name for name, _ in requests]:
+                file_name = '{}_{}'.format(file_name, feature.id())
+
+            requests.append((file_name, self.featureGeometry(feature)))
+
+        print('Downloading {} features of {}'.format(len(requests), layer.name()))
+        self.dlg.progressBar.setValue(10)
+        self.dlg.progressLabel.setText('Downloading Raster {} for {} features'.format(self.mapset, len(requests)))
+
+        mapset = self.mapset
+        merge = self.dlg.mergeFeaturesCheckBox_2.isChecked()
+        remaining = [len(requests)]
+
+        def featureDone(*args):
+            remaining[0] -= 1
+            if remaining[0] == 0 and merge:
+                vrt_fns = sparse_vrt(folder, [name for name, _ in requests], mapset, base_name or layer.name())
+                print('Merged the features into {} VRT files'.format(len(vrt_fns)))
+                self.listRasterMemory()
+
+        owner = 'features {} {}'.format(layer.id(), base_name)
+        for file_name, geometry in requests:
+            thread = self.startDownloadJob(geometry, mapset, folder, file_name, period, incremental,
+                                           priority=BATCH, owner=owner, dtype_policy=dtype_policy,
+                                           profile=profile)
+            if thread is None:
+                featureDone()
+            else:
+                thread.signals.finished.connect(featureDone)
+                thread.signals.error.connect(featureDone)
+
+    def startDownloadJob(self, region, mapset, folder, file_name, period, incremental,
+                         priority=INTERACTIVE, owner=None, dtype_policy='exact', profile=DEFAULT_PROFILE):
+        """
+            Records a v3 download in the job journal, split in calendar years,
+            and starts a download thread that runs its pending years. The
+            region of a GeoJSON file is stored in the journal so the job can
+            be resumed after the temporary file is gone.
+
+            A request equal to one still running (same region geometry,
+            mapset, period, output settings and files) is not started again, the running
+            thread is returned so the caller can attach to its signals. In
+            incremental mode, a finished request whose files are all still
+            in the folder is reused without downloading, and None is returned.
+        """
+        inflight_key = (request_hash(region, mapset, period, seperate_unscale=True,
+                                     dtype_policy=dtype_policy, profile=profile), folder, file_name)
+        if inflight_key in self.inflight:
+            self.dlg.progressLabel.setText(f'Raster {mapset} is already being downloaded')
+            return self.inflight[inflight_key]
+
+        if isinstance(region, shapely.Geometry):
+            job_region = {'wkb': shapely.to_wkb(region, hex=True)}
+        elif isinstance(region, str):
+            with open(region, 'r', encoding='utf-8') as f:
+                job_region = {'geojson': f.read()}
+        else:
+            job_region = region
+        job_params = {'region': job_region, 'mapset': mapset, 'folder': folder,
+                      'file_name': file_name, 'period': period, 'incremental': incremental,
+                      'dtype_policy': dtype_policy, 'profile': profile}
+
+        outputs = self.journal.completed('wapor3-download', job_params) if incremental else None
+        if outputs is not None and all(detail is not None for detail in outputs):
+            files = [fp for detail in outputs for fp in json.loads(detail)]
+            if all(os.path.isfile(fp) for fp in files):
+                print('Reusing the {} files already downloaded'.format(len(files)))
+                self.thread_complete(file_name + ' ' + mapset)
+                return None
+
+        job_id = self.journal.open_job('wapor3-download', job_params)
+        self.journal.plan(job_id, DownloadThread.splitPeriod(period))
+
+        thread = DownloadThread(region, mapset, folder, file_name, period, incremental,
+                                journal=self.journal, job_id=job_id, token=self.cancel_token,
+                                dtype_policy=dtype_policy, profile=profile)
+        self.inflight[inflight_key] = thread
+        thread.signals.finished.connect(lambda _: self.inflight.pop(inflight_key, None))
+        thread.signals.error.connect(lambda _: self.inflight.pop(inflight_key, None))
+        self.startThread(thread, priority, owner)
+        return thread
+
+    def startThread(self, thread, priority, owner=None):
+        """
+            Connects the signals of a download thread to the progress bar and
+            queues it in the download scheduler.
+        """
+        thread.signals.progress.connect(self.thread_progress)
+        thread.signals.finished.connect(self.thread_complete)
+        thread.signals.error.connect(self.thread_error)
+        try:
+            self.scheduler.submit(thread, '{} {} {}'.format(thread.file_name, thread.mapset, '/'.join(thread.period)),
+                                  priority, host=source_host(thread.mapset), owner=owner)
+        except queue.Full as e:
+            thread.cancel()
+            self.thread_error(str(e))
+            return
+        self.dlg.cancelButton_2.setEnabled(True)
+
+    def resumeDownloadJobs(self):
+        """
+            Asks to resume the v3 downloads left unfinished by a previous
+            session, running only their pending years, or abandons them.
+        """
+        jobs = self.journal.unfinished('wapor3-download')
+        if len(jobs) == 0:
+            return
+        names = '<br>'.join('{} {} {}'.format(params['file_name'], params['mapset'], '/'.join(params['period']))
+                            for _, params in jobs)
+        answer = QMessageBox.question(self.dlg, 'Unfinished downloads',
+                                      '<html><head/><body><p>The following downloads were interrupted, '
+                                      'do you want to resume them?<br><br>{}</p></body></html>'.format(names))
+        for job_id, params in jobs:
+            if answer != QMessageBox.Yes:
+                self.journal.abandon(job_id)
+                continue
+            region = params['region']
+            region_path = None
+            if isinstance(region, dict) and 'wkb' in region:
+                region = shapely.from_wkb(region['wkb'])
+            elif isinstance(region, dict):
+                region_path = os.path.join(self.plugin_dir, 'cache', 'job_{}.geojson'.format(job_id))
+                with open(region_path, 'w', encoding='utf-8') as f:
+                    f.write(region['geojson'])
+                region = region_path
+            self.dlg.progressLabel.setText('Resuming Raster {}'.format(params['mapset']))
+            thread = DownloadThread(region, params['mapset'], params['folder'], params['file_name'],
+                                    params['period'], params['incremental'],
+                                    journal=self.journal, job_id=job_id, token=self.cancel_token,
+                                    dtype_policy=params.get('dtype_policy', 'exact'),
+                                    profile=params.get('profile', 'lzw'))
+            if region_path is not None:
+                thread.signals.finished.connect(lambda _, path=region_path: self.removeJobRegion(path))
+                thread.signals.error.connect(lambda _, path=region_path: self.removeJobRegion(path))
+            self.startThread(thread, BATCH, owner='resumed')
+
+    def removeJobRegion(self, region_path):
+        """
+            Removes the GeoJSON file written to resume the region of a job,
+            once its download thread is over.
+        """
+        try:
+            os.remove(region_path)
+        except OSError:
+            pass
+
+    def thread_progress(self, info):
+        self.dlg.progressBar.setValue(int(info['percent']))
+        self.dlg.progressLabel.setText ('Downloading Raster {} {:.0f}% ({:.1f} MB, {:.1f} MB/s)'.format(
+            info['mapset'], info['percent'], info['bytes'] / 1e6, info['mb_per_s']))
 
     def thread_error(self, msg):
         self.dlg.progressBar.setValue(0)
         self.dlg.progressLabel.setText (f'Error: {msg}!')
+        if self.scheduler.active() <= 1:
+            self.dlg.cancelButton_2.setEnabled(False)
 
     def thread_complete(self, msg):
         self.dlg.progressBar.setValue(100)
         self.dlg.progressLabel.setText (f'Downloaded Raster {msg}!')
         self.listRasterMemory()
+        if self.scheduler.active() <= 1:
+            self.dlg.cancelButton_2.setEnabled(False)
 
     def cancelAllProcesses(self):
-        self.dlg.progressLabel.setText (f'Cancelling all pending processes: {len(self.processes)}')
-
-        pass
+        """
+            Cancels the running and queued downloads of the scheduler through
+            their shared token, GDAL stops at its next progress call. The
+            downloads started afterwards get a new token.
+        """
+        self.dlg.progressLabel.setText (f'Cancelling all pending processes: {self.scheduler.active()}')
+        self.scheduler.cancel_all()
+        self.cancel_token.cancel()
+        self.cancel_token = CancelToken()
         self.dlg.progressLabel.setText (f'All processes cancelled')
         self.dlg.progressBar.setValue(100)
 
 
+    def updateQueueView(self):
+        """
+            Lists the running, queued and latest finished downloads of the
+            scheduler.
+        """
+        self.dlg.queueListWidget_2.clear()
+        for job in self.scheduler.snapshot():
+            item = QListWidgetItem('[{}] {}'.format(job['state'], job['name']))
+            item.setData(Qt.UserRole, job['job_id'])
+            self.dlg.queueListWidget_2.addItem(item)
+
+    def cancelQueueItem(self):
+        """
+            Cancels the downloads selected in the queue view.
+        """
+        for item in self.dlg.queueListWidget_2.selectedItems():
+            self.scheduler.cancel(item.data(Qt.UserRole))
+
     def updateRasterFolder(self):
         if self.dlg.tabManager.currentIndex() == 1:
             rasterFolder = self.dlg.rasterFolderExplorer.filePath()
@@ -1222,6 +1532,12 @@ class WAPlugin:
 
             self.dlg.shapeLayerComboBox.setFilters(QgsMapLayerProxyModel.PolygonLayer)
             self.dlg.shapeLayerComboBox_2.setFilters(QgsMapLayerProxyModel.PolygonLayer)
+            self.dlg.featureFieldComboBox_2.setLayer(self.dlg.shapeLayerComboBox_2.currentLayer())
+            self.dlg.shapeLayerComboBox_2.layerChanged.connect(self.dlg.featureFieldComboBox_2.setLayer)
+            self.dlg.perFeatureCheckBox_2.toggled.connect(self.dlg.featureFieldComboBox_2.setEnabled)
+            self.dlg.perFeatureCheckBox_2.toggled.connect(self.dlg.mergeFeaturesCheckBox_2.setEnabled)
+            self.dlg.profileComboBox_2.addItems(OUTPUT_PROFILES.keys())
+            self.dlg.profileComboBox_2.setCurrentText(DEFAULT_PROFILE)
 
             self.dlg.wapor2radioButton.clicked.connect(self.updateWaporParams)
             self.dlg.wapor3radioButton.clicked.connect(self.updateWaporParams)
@@ -1238,12 +1554,16 @@ class WAPlugin:
             self.dlg.downloadButton.clicked.connect(self.downloadCroppedRaster)
             self.dlg.cancelButton.clicked.connect(self.cancelCroppedRaster)
             self.dlg.cancelButton_2.clicked.connect(self.cancelAllProcesses)
+            self.dlg.cancelQueueItemButton_2.clicked.connect(self.cancelQueueItem)
+            self.scheduler_signals.changed.connect(self.updateQueueView)
             self.dlg.loadRasterButton.clicked.connect(self.loadRaster)
             self.dlg.loadRasterButton_2.clicked.connect(self.loadRaster)
             self.dlg.loadRasterButton_3.clicked.connect(self.loadRaster)
             self.dlg.RasterRefreshButton.clicked.connect(self.listRasterMemory)
             self.dlg.RasterRefreshButton_2.clicked.connect(self.listRasterMemory)
             self.dlg.RasterRefreshButton_3.clicked.connect(self.listRasterMemory)
+            self.dlg.refreshCatalogButton.clicked.connect(self.refreshCatalog)
+            self.dlg.refreshCatalogButton_2.clicked.connect(self.refreshCatalog)
 
             self.dlg.downloadFolderExplorer_2.setFilePath(self.layer_folder_dir)
             self.dlg.downloadButton_2.clicked.connect(self.download3CroppedRaster)
@@ -1295,6 +1615,8 @@ class WAPlugin:
             # Set the CRS of the QGIS canvas to the new CRS
             self.iface.mapCanvas().setDestinationCrs(new_crs)
 
+            self.resumeDownloadJobs()
+
 
         # show the dialog
         self.dlg.show()